@@ -11,15 +11,25 @@
 
 import re
 import os
+import json
 import configparser
-import requests
 import time
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-# Imports for LLMs. Note: anthropic and perplexity don't require special imports as they use requests
-from openai import OpenAI
-import google.generativeai as genai
-from groq import Groq
+# Provider SDKs (openai, google.generativeai, groq), requests, httpx and asyncio are
+# imported inside the functions that use them, so a run only pays the import time of
+# the providers it calls.
+
+from provider_stats import record_call, get_latency_percentile, record_vote_result
+from llm_router import choose_panel, get_model_for_role, record_usage, call_within_budget, plan_panel_request
+from text_transforms import add_blockquote_prefix
+from response_cache import get_response_cache_folder, compute_signature, find_similar_response, store_response
+from profiler import span
+from job_queue import get_job_queue_settings, get_job_queue, run_job
+from cassette import get_replay_settings, replay_call, record_call_log
+from consensus import find_consensus, record_consensus_result
 
 # Logging handler
 import logging
@@ -29,12 +39,50 @@ MAX_RETRIES    = 3
 INITIAL_DELAY  = 1
 BACKOFF_FACTOR = 2
 
+# Roles never answered from the response cache (see call_llm_with_response_cache)
+UNCACHED_ROLES = ('reflection', 'vote')
+
+# Least output allowed for a structured vote: a forced tool call (Anthropic) cut
+# short by the limit leaves no answer to parse
+MIN_VOTE_TOKENS = 64
+
+# Threads for hedged calls when the async adapters are off. A losing call can't be
+# interrupted mid-request, so it is left to finish and its result is discarded.
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+hedge_counts   = {'calls': 0, 'hedged': 0}
+hedge_lock     = threading.Lock()
+
+# Event loop for the async adapters, run in a background thread, and the clients
+# it reuses across calls (only used from the loop's own thread)
+adapter_loop      = None
+adapter_loop_lock = threading.Lock()
+async_clients     = {}
+
+# A thread may register a cancel event (eg the speculative architecture request).
+# Once it is set, the thread's calls stop at the next check and its call in flight
+# is cancelled.
+call_context         = threading.local()
+CANCEL_POLL_INTERVAL = 0.1   # Seconds between checks while waiting for a call
+
+# Raised in a thread whose calls were cancelled. It is not an Exception, like
+# KeyboardInterrupt, so the retry loops pass it on instead of retrying.
+class RequestCancelled(BaseException):
+    pass
+
+# Set by worker.py (see calls_on_workers)
+make_calls_locally = False
+
 ###############################################################################
 # Make requests and get responses using multiple LLMs.
 # Each LLM performs several iterations of reflection, after which panel of 
 # experts evaluates and scores the final response of each LLM.
+# If cache_phase is given, responses to near-identical earlier prompts for that
+# phase may be reused (see call_llm_with_response_cache). output_phase selects
+# the output limit from the [OutputLimits] section of config.txt. The panel
+# and the reflections are cut down when the run's budget would not cover them.
 ###############################################################################
-def multi_llm_request(request, logs_folder, include_markers, max_reflection_iterations=3, panel_size=3):
+def multi_llm_request(request, logs_folder, include_markers, max_reflection_iterations=3, panel_size=3, cache_phase=None, cache_anchor=None,
+                      output_phase=None):
 
     ###############################################################################
     # Make list of the LLMs available for use. If a key exists, we assume LLM is available.
@@ -45,18 +93,16 @@ def multi_llm_request(request, logs_folder, include_markers, max_reflection_iter
     get_all_llm_info()
 
     ###############################################################################
-    # Make list of LLMs to be used in the panel of experts
+    # Make list of LLMs to be used in the panel of experts, ranked by the router
+    # from our call history
     ###############################################################################
 
-    llm_count = 0
-
-    panel_list = []
-
-    for llm_name in all_llm_list:
+    panel_list = choose_panel(all_llm_list, logs_folder, panel_size)
 
-        if llm_count < panel_size: 
-            panel_list.append(llm_name)  
-            llm_count += 1
+    # Fewer reflections, then fewer LLMs, if the budget would not cover them all
+    max_output_tokens = get_output_limit_settings()['phases'].get(output_phase, 0)
+    planned_size, max_reflection_iterations = plan_panel_request(request, output_phase, len(panel_list), max_reflection_iterations, max_output_tokens)
+    panel_list = panel_list[:planned_size]
 
     ###############################################################################
     # Submit request to each LLM, and do several iterations of reflection
@@ -71,11 +117,19 @@ def multi_llm_request(request, logs_folder, include_markers, max_reflection_iter
     
     # Iterate through each LLM
     for llm_name in panel_list:
+
+        # Once the budget can't take another draft, vote among the candidates we have
+        if response_dict and not call_within_budget(request, output_phase, max_output_tokens):
+            logger.warning(f"Budget reached. Skipping the remaining panel LLMs from {llm_name}.")
+            break
    
         # Do reflection for several iterations on this LLM
         for request_number in range (1, max_reflection_iterations + 1):
-    
-            print(f"LLM: {llm_name} Request number: {request_number}")
+
+            # Drafts and reflections may use a fast model; the last iteration is the final generation
+            if request_number == max_reflection_iterations: role = 'final'
+            elif request_number == 1:                       role = 'draft'
+            else:                                           role = 'reflection'
 
             # For first iteration, use the original request
             if (request_number == 1): this_request = request
@@ -99,53 +153,92 @@ def multi_llm_request(request, logs_folder, include_markers, max_reflection_iter
                 reflected_request += "So, what I need you to do is this: Please reflect upon the original request, and the candidate solution, and try to produce an improved solution that is better that the proposed solution.\n"
     
                 this_request = reflected_request
+
+                # Once the budget is spent, keep the response we have instead of reflecting further
+                if not call_within_budget(this_request, output_phase, max_output_tokens):
+                    logger.warning(f"Budget reached. Skipping remaining reflection iterations for {llm_name}.")
+                    break
+
+            print(f"LLM: {llm_name} Request number: {request_number}")
     
-            # Make request to the LLM
-            response = call_llm_with_logging(this_request, logs_folder, llm_name, include_markers)
+            # Make request to the LLM. Only the request itself may be answered from the response cache.
+            response = call_llm_with_response_cache(this_request, logs_folder, llm_name, include_markers, get_model_for_role(llm_name, role),
+                                                    get_output_options(output_phase, llm_name), cache_phase=cache_phase if request_number == 1 else None,
+                                                    cache_anchor=cache_anchor, phase=output_phase, role=role)
+            completed_iterations = request_number
 
             # Sleep to avoid breaking speed limit on the LLM
             time.sleep(0.5)
             
         # Store the response and some metadata about the request in a container
         llm_number += 1
-        response_dict[llm_number] = {'llm_name': llm_name, 'response': response, 'reflection_iteration': request_number}
+        response_dict[llm_number] = {'llm_name': llm_name, 'response': response, 'reflection_iteration': completed_iterations}
+
+    panel_list = panel_list[:len(response_dict)]
+    llm_count  = len(panel_list)
+
+    # A single candidate needs no vote
+    if llm_count == 1: return response_dict[1]['response']
     
+    ###############################################################################
+    # If most candidates are effectively the same code, skip the vote
+    ###############################################################################
+
+    voting_settings = get_voting_settings()
+
+    if voting_settings['consensus']:
+        consensus_number = find_consensus(response_dict, voting_settings['consensus_similarity'])
+        record_consensus_result(logs_folder, output_phase, consensus_number is not None)
+
+        if consensus_number is not None:
+            print(f"\nThe candidates agree. Using solution {consensus_number} without a vote.")
+            return response_dict[consensus_number]['response']
+
     ###############################################################################
     # Bundle the candidate responses from each LLM into a request
     ###############################################################################
-    
-    # Take reflected output of each LLM, and show them to each LLM and ask for voting/ranking
-    voting_request = ""
-    voting_request += "I want to find the best possible solution to a task. I gave the same task to multiple LLMs and asked for their proposed solution.\n\n"
-    voting_request += "\n\n##################\n\n"
-    voting_request += "Here is the original task request:\n"
-
-    block_quoted_task = add_blockquote_prefix(request)
-    voting_request += block_quoted_task + "\n\n"
-    voting_request += "\n\n##################\n\n"
-
-    voting_request += "As mentioned, I asked multiple LLMs to do that task, and I have several possible solutions. But, I don't know which of the solutions is best. "
-    voting_request += "So, I need you to examine each candidate solution, and determine which in your judgement is the best solution from all of them.\n\n"
-    voting_request += "Here (below) are the candidate solutions, which I have assigned numbers so you can refer to them by their number:\n"
-    voting_request += "\n\n##################\n\n"
-    
-    for llm_number in range(1, llm_count + 1):
-    
-        dict_value = response_dict[llm_number]
-        response   = dict_value['response']
-        block_quoted_response = add_blockquote_prefix(response)
 
-        if response:
-            voting_request += f"Here is solution number {llm_number}:\n"
-            voting_request += block_quoted_response
-            voting_request += "\n\n##################\n\n"    
-    
-    voting_request += "Now, what I need you to do, is ruminate over the original request and also each of the numbered candidate solutions. Then choose which one of the solutions is the very best. "
-    voting_request += "Indicate your preference for which is the best solution by giving me the number for the best solution.\n\n"
-    voting_request += "Provide your response in the following format:\n"   
-    voting_request += "ANSWER: [number]\n"
-    voting_request += "Where [number] is 1, 2, 3, et cetera, corresponding to the correct answer. Do not include any other text or explanation in your response.\n\n"
-  
+    # Structured voting uses a short prompt and asks for a JSON answer, using the
+    # provider's native JSON mode / tool schema and a small output limit
+    if voting_settings['structured']:
+        voting_request = build_structured_voting_request(request, response_dict, llm_count)
+        vote_options   = {'json_schema': get_vote_schema(llm_count), 'max_tokens': voting_settings['max_vote_tokens']}
+
+    else:
+        vote_options = None
+
+        # Take reflected output of each LLM, and show them to each LLM and ask for voting/ranking
+        voting_request = ""
+        voting_request += "I want to find the best possible solution to a task. I gave the same task to multiple LLMs and asked for their proposed solution.\n\n"
+        voting_request += "\n\n##################\n\n"
+        voting_request += "Here is the original task request:\n"
+
+        block_quoted_task = add_blockquote_prefix(request)
+        voting_request += block_quoted_task + "\n\n"
+        voting_request += "\n\n##################\n\n"
+
+        voting_request += "As mentioned, I asked multiple LLMs to do that task, and I have several possible solutions. But, I don't know which of the solutions is best. "
+        voting_request += "So, I need you to examine each candidate solution, and determine which in your judgement is the best solution from all of them.\n\n"
+        voting_request += "Here (below) are the candidate solutions, which I have assigned numbers so you can refer to them by their number:\n"
+        voting_request += "\n\n##################\n\n"
+
+        for llm_number in range(1, llm_count + 1):
+
+            dict_value = response_dict[llm_number]
+            response   = dict_value['response']
+            block_quoted_response = add_blockquote_prefix(response)
+
+            if response:
+                voting_request += f"Here is solution number {llm_number}:\n"
+                voting_request += block_quoted_response
+                voting_request += "\n\n##################\n\n"
+
+        voting_request += "Now, what I need you to do, is ruminate over the original request and also each of the numbered candidate solutions. Then choose which one of the solutions is the very best. "
+        voting_request += "Indicate your preference for which is the best solution by giving me the number for the best solution.\n\n"
+        voting_request += "Provide your response in the following format:\n"
+        voting_request += "ANSWER: [number]\n"
+        voting_request += "Where [number] is 1, 2, 3, et cetera, corresponding to the correct answer. Do not include any other text or explanation in your response.\n\n"
+
     ###############################################################################
     # Ask each of the LLMs to examine the candidate responses and 
     # choose which is best
@@ -153,20 +246,29 @@ def multi_llm_request(request, logs_folder, include_markers, max_reflection_iter
     
     # Initialize a dictionary
     votes = {}
-    for llm_number in range(1, 10): votes[llm_number] = 0
+    for llm_number in range(1, llm_count + 1): votes[llm_number] = 0
     
     # Call each LLM and ask it to evaluate the bundle of candidate solutions, and choose which is best
     for llm_name in panel_list:
+
+        # Count the votes cast so far once the budget can't take another
+        if not call_within_budget(voting_request, output_phase, voting_settings['max_vote_tokens']):
+            logger.warning(f"Budget reached. Skipping the remaining votes from {llm_name}.")
+            break
     
-        # Make request to the LLM
-        response = call_llm_with_logging(voting_request, logs_folder, llm_name, include_markers)
+        # Make request to the LLM. A vote never contains file markers, so don't retry for lack of them.
+        response = call_llm_with_logging(voting_request, logs_folder, llm_name, False, get_model_for_role(llm_name, 'vote'), vote_options,
+                                         phase=output_phase, role='vote')
     
         # Parse the response
-        chosen_solution = extract_answer_number(response)
+        if voting_settings['structured']: chosen_solution = parse_structured_vote(response, llm_count)
+        else:                             chosen_solution = extract_answer_number(response)
   
-        # Increment the vote for the LLM number
-        if int(chosen_solution) > 0: 
+        # Increment the vote for the LLM number, ignoring numbers that aren't a candidate
+        if chosen_solution in votes: 
             votes[chosen_solution] += 1
+        else:
+            logger.warning(f"Vote from {llm_name} did not name a candidate: {response[:100]!r}")
 
     ###############################################################################
     # Determine which LLM response has most votes
@@ -189,31 +291,163 @@ def multi_llm_request(request, logs_folder, include_markers, max_reflection_iter
 
     print(f"\nSolution with most votes is: {best_solution_number} which has {max_votes} votes.")
 
+    # Remember which provider won, for routing future panels. Without a valid
+    # vote the first candidate is only a default, not a win.
+    if max_votes > 0: record_vote_result(logs_folder, panel_list, best_llm_name)
+
     return best_response
 
 ###############################################################################
-# We want a section of text to be preceived by the LLM as containing a quote, so we 
-# burst the string into lines, prefix each line with the > prefix on each line, 
-# then reassemble the lines into a string.
+# Read voting settings from the [Voting] section of config.txt
 ###############################################################################
-def add_blockquote_prefix(input_string):
+def get_voting_settings():
 
-    # Split the input string into a list of lines
-    lines = input_string.split('\n')
-    
-    # Prefix each line with '> '
-    prefixed_lines = ['> ' + line for line in lines]
-    
-    # Reassemble the list of lines into a single string with line feeds
-    result_string = '\n'.join(prefixed_lines)
-    
-    return result_string
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Voting'] if 'Voting' in config else {}
+
+    settings = {}
+    settings['structured']      = section.get('structured', 'yes').lower() in ['yes', '1']
+    settings['max_vote_tokens'] = max(int(section.get('max_vote_tokens', str(MIN_VOTE_TOKENS))), MIN_VOTE_TOKENS)
+    settings['consensus']            = section.get('consensus', 'yes').lower() in ['yes', '1']
+    settings['consensus_similarity'] = float(section.get('consensus_similarity', '0.95'))
+
+    return settings
+
+###############################################################################
+# JSON schema for a vote: {"answer": <candidate number>}
+###############################################################################
+def get_vote_schema(candidate_count):
+
+    return {
+        "type": "object",
+        "properties": {"answer": {"type": "integer", "minimum": 1, "maximum": candidate_count}},
+        "required": ["answer"],
+    }
+
+###############################################################################
+# Short voting prompt for structured voting. The answer is a JSON object, so
+# the reply costs a handful of output tokens.
+###############################################################################
+def build_structured_voting_request(request, response_dict, candidate_count):
+
+    voting_request = "Choose the best candidate solution to the task below.\n\n"
+    voting_request += "Task:\n"
+    voting_request += add_blockquote_prefix(request) + "\n\n"
+
+    for llm_number in range(1, candidate_count + 1):
+        response = response_dict[llm_number]['response']
+        if response:
+            voting_request += f"Candidate {llm_number}:\n"
+            voting_request += add_blockquote_prefix(response) + "\n\n"
+
+    voting_request += f'Reply with only a JSON object of the form {{"answer": N}}, where N is the number (1 to {candidate_count}) of the best candidate.\n'
+
+    return voting_request
+
+###############################################################################
+# Parses a structured vote. Only a JSON answer, or a reply that is nothing but
+# the number (optionally "ANSWER: n"), is accepted; anything else is 0.
+###############################################################################
+def parse_structured_vote(response, candidate_count):
+
+    text = (response or '').strip().strip('`').strip()
+    if text.lower().startswith('json'): text = text[4:].strip()
+
+    answer = None
+
+    try:
+        parsed = json.loads(text)
+        if isinstance(parsed, dict): answer = parsed.get('answer')
+        elif isinstance(parsed, int): answer = parsed
+    except ValueError:
+        match = re.fullmatch(r'(?:ANSWER:\s*)?(\d+)', text, re.IGNORECASE)
+        if match: answer = match.group(1)
+
+    try:
+        answer = int(answer)
+    except (TypeError, ValueError):
+        return 0
+
+    if 1 <= answer <= candidate_count: return answer
+
+    return 0
+
+###############################################################################
+# Read response cache settings from the [ResponseCache] section of config.txt
+###############################################################################
+def get_response_cache_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['ResponseCache'] if 'ResponseCache' in config else {}
+
+    settings = {}
+    settings['enabled']   = section.get('enabled', 'no').lower() in ['yes', '1']
+    settings['threshold'] = float(section.get('threshold', '0.9'))
+    settings['phases']    = [p.strip() for p in section.get('phases', 'understanding, architecture').split(',') if p.strip()]
+
+    return settings
+
+###############################################################################
+# Similarity lookup in front of call_llm_with_logging. For phases listed in
+# [ResponseCache], a prior response is reused when its prompt (and the anchor
+# text, normally the task wording) is similar enough. Reuse is written to the
+# log as a *_response_<llm>_reused.txt file and logged as a warning.
+# Responses are kept by role. Reflections and votes are never cached: their
+# prompts carry a draft, and with the same task and bundle they look like it.
+###############################################################################
+def call_llm_with_response_cache(prompt, logs_folder, llm_name, include_markers, model=None, call_options=None, cache_phase=None, cache_anchor=None,
+                                 phase=None, role=None):
+
+    settings = get_response_cache_settings()
+
+    if not settings['enabled'] or cache_phase not in settings['phases'] or role in UNCACHED_ROLES:
+        return call_llm_with_logging(prompt, logs_folder, llm_name, include_markers, model, call_options, phase, role)
+
+    cache_folder     = get_response_cache_folder(logs_folder)
+    signature        = compute_signature(prompt)
+    anchor_signature = compute_signature(cache_anchor) if cache_anchor else signature
+
+    response, similarity = find_similar_response(cache_folder, cache_phase, llm_name, signature, anchor_signature, settings['threshold'], role)
+
+    if response is not None:
+        logger.warning(f"Reusing cached {cache_phase} response for {llm_name} (similarity {similarity:.2f}).")
+
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S%f')
+        with open(os.path.join(logs_folder, f'{timestamp}_request_{llm_name}.txt'), 'w', encoding='utf-8') as file: file.write(prompt)
+        with open(os.path.join(logs_folder, f'{timestamp}_response_{llm_name}_reused.txt'), 'w', encoding='utf-8') as file:
+            file.write(f"[Reused cached {cache_phase} response, similarity {similarity:.2f}]\n\n{response}")
+
+        return response
+
+    response = call_llm_with_logging(prompt, logs_folder, llm_name, include_markers, model, call_options, phase, role)
+
+    if response: store_response(cache_folder, cache_phase, llm_name, prompt, signature, anchor_signature, response, role)
+
+    return response
 
 ###############################################################################
 # Given the prompt as input, this logs request, calls function to perform LLM 
-# request, gets response, logs response, then returns response
+# request, gets response, logs response, then returns response. The phase and
+# role of the call are noted in llm_logs/calls.jsonl for the log index.
 ###############################################################################
-def call_llm_with_logging(prompt, logs_folder, llm_name, include_markers):
+def call_llm_with_logging(prompt, logs_folder, llm_name, include_markers, model=None, call_options=None, phase=None, role=None):
+
+    global all_llm_list, all_api_keys, all_llm_models
+
+    raise_if_cancelled()
+
+    # In replay mode, a recorded response answers the call (see cassette.py)
+    replay_settings = get_replay_settings()
+    if replay_settings['enabled']:
+        response = replay_call(prompt, llm_name, logs_folder, replay_settings)
+        if response is not None:
+            if not model: get_all_llm_info()
+            record_usage(model or all_llm_models.get(llm_name, ''), prompt, response, phase, role)
+            return response
 
     # Log request
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S%f')  # Microseconds
@@ -222,22 +456,32 @@ def call_llm_with_logging(prompt, logs_folder, llm_name, include_markers):
 
     with open(request_file_path, 'w', encoding='utf-8') as file: file.write(prompt)
 
-    response = llm_request_with_retry(prompt, logs_folder, llm_name, include_markers)
+    start_time = time.perf_counter()
+    with span(f"llm:{llm_name}"):
+        response = llm_request_with_retry(prompt, logs_folder, llm_name, include_markers, model, call_options)
+    seconds = time.perf_counter() - start_time
 
     # In rare event that we don't have a response, set an empty string
     if response is None: response = '' 
 
+    # Count the call against the run budget
+    if not model: get_all_llm_info()
+    record_usage(model or all_llm_models.get(llm_name, ''), prompt, response, phase, role)
+
     # Log response
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S%f')  # Microseconds
     log_file_path = os.path.join(logs_folder, f'{timestamp}_response_{llm_name}.txt')
     with open(log_file_path, 'w', encoding='utf-8') as file: file.write(response)
 
+    record_call_log(logs_folder, request_file_path, log_file_path, llm_name, model or all_llm_models.get(llm_name, ''), prompt, seconds,
+                    phase, role, include_markers)
+
     return response
 
 ###############################################################################
 # Wrapper around LLM calls
 ###############################################################################
-def llm_request_with_retry(prompt, logs_folder, llm_name, include_markers):
+def llm_request_with_retry(prompt, logs_folder, llm_name, include_markers, model=None, call_options=None):
 
     retry_count = 0
     delay = INITIAL_DELAY
@@ -245,7 +489,7 @@ def llm_request_with_retry(prompt, logs_folder, llm_name, include_markers):
 
     while retry_count < MAX_RETRIES:
         try:
-            response = call_llm(prompt, llm_name)
+            response = call_llm_with_hedging(prompt, llm_name, logs_folder, model, call_options)
 
             if not response or not response.strip():
                 raise ValueError("Empty response returned. Retrying...")
@@ -273,36 +517,502 @@ def llm_request_with_retry(prompt, logs_folder, llm_name, include_markers):
     logger.error(f"Failed to find markers after {MAX_RETRIES} attempts.")
     return last_valid_response  # Return the last valid response, even without markers
 
+###############################################################################
+# Read hedging settings from the [Hedging] section of config.txt
+###############################################################################
+def get_hedging_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Hedging'] if 'Hedging' in config else {}
+
+    settings = {}
+    settings['enabled']            = section.get('enabled', 'no').lower() in ['yes', '1']
+    settings['percentile']         = float(section.get('percentile', '95'))
+    settings['min_samples']        = int(section.get('min_samples', '20'))
+    settings['max_hedge_fraction'] = float(section.get('max_hedge_fraction', '0.1'))
+    settings['fallbacks']          = {key[len('fallback_'):]: value for key, value in section.items() if key.startswith('fallback_')}
+
+    return settings
+
+###############################################################################
+# Where to send the duplicate of a slow call. A fallback is written as
+# 'provider' or 'provider:model'; without one, the same provider is used again.
+###############################################################################
+def get_hedge_target(llm_name, settings):
+
+    global all_llm_list, all_api_keys, all_llm_models
+
+    get_all_llm_info()
+
+    fallback = settings['fallbacks'].get(llm_name, '').strip()
+    if not fallback: return llm_name, None
+
+    fallback_llm, _, fallback_model = fallback.partition(':')
+    fallback_llm = fallback_llm.strip()
+
+    if fallback_llm not in all_api_keys:
+        logger.warning(f"Hedge fallback '{fallback_llm}' for {llm_name} has no API key. Hedging to {llm_name} instead.")
+        return llm_name, None
+
+    return fallback_llm, (fallback_model.strip() or None)
+
+###############################################################################
+# Calls the LLM and records the latency and outcome in the provider history
+###############################################################################
+def timed_call_llm(prompt, llm_name, logs_folder, model=None, call_options=None):
+
+    start_time = time.perf_counter()
+
+    try:
+        response = call_llm(prompt, llm_name, model, call_options)
+    except Exception:
+        record_call(logs_folder, llm_name, time.perf_counter() - start_time, success=False)
+        raise
+
+    record_call(logs_folder, llm_name, time.perf_counter() - start_time, success=bool(response and response.strip()))
+
+    return response
+
+# Same, on the adapter loop. A cancelled call (eg the loser of a hedge) raises
+# CancelledError, which is not an Exception, so it is not counted as an error.
+async def timed_call_llm_async(prompt, llm_name, logs_folder, model=None, call_options=None):
+
+    start_time = time.perf_counter()
+
+    try:
+        response = await async_call_llm(prompt, llm_name, model, call_options)
+    except Exception:
+        record_call(logs_folder, llm_name, time.perf_counter() - start_time, success=False)
+        raise
+
+    record_call(logs_folder, llm_name, time.perf_counter() - start_time, success=bool(response and response.strip()))
+
+    return response
+
+###############################################################################
+# Starts a timed call and returns its future. With the async adapters the call
+# runs on the adapter loop and cancelling the future aborts the request;
+# otherwise it runs in a hedge thread.
+###############################################################################
+def submit_timed_call(prompt, llm_name, logs_folder, model=None, call_options=None):
+
+    if get_timeout_settings()['async_adapters']:
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(timed_call_llm_async(prompt, llm_name, logs_folder, model, call_options), get_adapter_loop())
+
+    return hedge_executor.submit(timed_call_llm, prompt, llm_name, logs_folder, model, call_options)
+
+###############################################################################
+# Cancellation of the calls made by a thread
+###############################################################################
+
+def set_cancel_event(event):
+
+    call_context.cancel_event = event
+
+def raise_if_cancelled():
+
+    event = getattr(call_context, 'cancel_event', None)
+    if event is not None and event.is_set(): raise RequestCancelled()
+
+# Waits for a submitted call. An interrupt (eg Ctrl-C) or the thread's cancel
+# event while waiting cancels the request instead of leaving it running.
+def wait_for_call(future):
+
+    event = getattr(call_context, 'cancel_event', None)
+    try:
+        if event is None: return future.result()
+        while not wait([future], timeout=CANCEL_POLL_INTERVAL).done:
+            if event.is_set(): raise RequestCancelled()
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+# Waits until one of the submitted calls is done, or the timeout passes, like
+# wait(..., return_when=FIRST_COMPLETED). The thread's cancel event is checked
+# every CANCEL_POLL_INTERVAL; if it is set, or on an interrupt, the calls are
+# cancelled.
+def wait_for_first(futures, timeout=None):
+
+    event    = getattr(call_context, 'cancel_event', None)
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    try:
+        while True:
+            step = CANCEL_POLL_INTERVAL if deadline is None else max(min(CANCEL_POLL_INTERVAL, deadline - time.monotonic()), 0)
+            done, pending = wait(futures, timeout=step if event is not None else timeout, return_when=FIRST_COMPLETED)
+            if done or event is None: return done, pending
+            if event.is_set(): raise RequestCancelled()
+            if deadline is not None and time.monotonic() >= deadline: return done, pending
+    except BaseException:
+        for future in futures: future.cancel()
+        raise
+
+# Makes one timed call and waits for it. With llm_calls = queue in [JobQueue],
+# the call is made by a worker.
+def run_timed_call(prompt, llm_name, logs_folder, model=None, call_options=None):
+
+    raise_if_cancelled()
+
+    if calls_on_workers():
+        return run_call_on_worker(prompt, llm_name, logs_folder, model, call_options)
+
+    wait_for_rate_limit(llm_name)
+
+    if not get_timeout_settings()['async_adapters']:
+        return timed_call_llm(prompt, llm_name, logs_folder, model, call_options)
+
+    return wait_for_call(submit_timed_call(prompt, llm_name, logs_folder, model, call_options))
+
+###############################################################################
+# Calls through the job queue (see job_queue.py and worker.py)
+###############################################################################
+
+# True if calls go to the job queue. A worker makes its calls itself, including
+# those of the tasks it runs, instead of queueing them again.
+def calls_on_workers():
+
+    return not make_calls_locally and get_job_queue_settings()['llm_calls'] == 'queue'
+
+# Waits until the provider's rate limit, shared by every process on the job
+# queue, allows another request
+def wait_for_rate_limit(llm_name):
+
+    settings = get_job_queue_settings()
+    limit = settings['rate_limits'].get(llm_name)
+    if not limit: return
+
+    queue = get_job_queue(settings)
+    if queue is None: return
+
+    while True:
+        raise_if_cancelled()
+        wait_seconds = queue.acquire_rate(llm_name, limit)
+        if not wait_seconds: return
+        logger.debug(f"Rate limit for {llm_name} reached. Waiting {wait_seconds:.1f}s.")
+        time.sleep(min(wait_seconds, 1))
+
+# One provider call, not recorded in the provider stats (the caller does that).
+# Used by workers for 'llm_call' jobs.
+def call_provider(prompt, llm_name, model=None, call_options=None):
+
+    if not get_timeout_settings()['async_adapters']:
+        return call_llm(prompt, llm_name, model, call_options)
+
+    import asyncio
+    return wait_for_call(asyncio.run_coroutine_threadsafe(async_call_llm(prompt, llm_name, model, call_options), get_adapter_loop()))
+
+# Sends the call to a worker as a job and waits for the response. The latency
+# the worker measured is recorded here, in this project's provider stats.
+def run_call_on_worker(prompt, llm_name, logs_folder, model=None, call_options=None):
+
+    settings = get_job_queue_settings()
+    payload  = {'prompt': prompt, 'llm_name': llm_name, 'model': model, 'call_options': call_options}
+
+    start_time = time.perf_counter()
+    try:
+        result = run_job(get_job_queue(settings), 'llm_call', payload, settings['poll_interval'], should_stop=raise_if_cancelled)
+    except RuntimeError:
+        record_call(logs_folder, llm_name, time.perf_counter() - start_time, success=False)
+        raise
+
+    record_call(logs_folder, llm_name, result['seconds'], success=bool(result['response'] and result['response'].strip()))
+
+    return result['response']
+
+###############################################################################
+# Request hedging (opt-in). If a call has not returned by the provider's p95
+# latency from our own call history, a duplicate is sent to the same provider
+# or its configured fallback. The first good response wins. The fraction of
+# calls that get hedged is capped by max_hedge_fraction.
+###############################################################################
+def call_llm_with_hedging(prompt, llm_name, logs_folder, model=None, call_options=None):
+
+    settings = get_hedging_settings()
+
+    # Calls made by workers are not hedged
+    if not settings['enabled'] or calls_on_workers():
+        return run_timed_call(prompt, llm_name, logs_folder, model, call_options)
+
+    with hedge_lock: hedge_counts['calls'] += 1
+
+    hedge_after = get_latency_percentile(logs_folder, llm_name, settings['percentile'], settings['min_samples'])
+
+    # Not enough history yet to know what "slow" is for this provider
+    if hedge_after is None:
+        return run_timed_call(prompt, llm_name, logs_folder, model, call_options)
+
+    wait_for_rate_limit(llm_name)
+    primary = submit_timed_call(prompt, llm_name, logs_folder, model, call_options)
+
+    done, pending = wait_for_first([primary], timeout=hedge_after)
+    if done: return primary.result()
+
+    with hedge_lock:
+        hedge_allowed = hedge_counts['hedged'] + 1 <= settings['max_hedge_fraction'] * hedge_counts['calls']
+        if hedge_allowed: hedge_counts['hedged'] += 1
+
+    if not hedge_allowed: return wait_for_call(primary)
+
+    hedge_llm, hedge_model = get_hedge_target(llm_name, settings)
+    if hedge_llm == llm_name and not hedge_model: hedge_model = model
+    logger.info(f"{llm_name} has not responded after {hedge_after:.1f}s. Sending hedged request to {hedge_llm}.")
+
+    wait_for_rate_limit(hedge_llm)
+    hedge = submit_timed_call(prompt, hedge_llm, logs_folder, hedge_model, call_options)
+
+    # Take the first good response. The other call is cancelled: with the async adapters
+    # its request is aborted, otherwise it is only cancelled if it has not started yet.
+    pending    = {primary, hedge}
+    last_error = None
+    response   = None
+
+    while pending:
+        done, pending = wait_for_first(pending)
+
+        for future in done:
+            try:
+                response = future.result()
+            except Exception as e:
+                last_error = e
+                continue
+
+            if response and response.strip():
+                for other in pending: other.cancel()
+                if future is hedge: logger.info(f"Hedged request to {hedge_llm} won over {llm_name}.")
+                return response
+
+    if last_error and not response: raise last_error
+
+    return response
+
 ###############################################################################
 # Gets API key and model for the LLM, then calls function specific for the LLM.
+# The configured model can be overridden, eg for a hedge fallback model.
+# call_options are passed on to the adapter (json_schema, max_tokens).
+#
+# Each adapter returns the text and whether it stopped at the output limit. A
+# response cut off at the limit is continued: the adapter is called again with
+# the text so far, and the rest is appended, up to max_continuations times.
 ###############################################################################
-def call_llm(prompt, llm_name):
+def call_llm(prompt, llm_name, model=None, call_options=None):
 
     global all_llm_list, all_api_keys, all_llm_models
 
     get_all_llm_info()
 
-    api_key = all_api_keys[llm_name]
-    model   = all_llm_models[llm_name]
+    api_key  = all_api_keys[llm_name]
+    model    = model or all_llm_models[llm_name]
+    timeouts = get_timeout_settings()
+
+    adapters = {
+        'openai':     send_to_openai,
+        'gemini':     send_to_gemini,
+        'anthropic':  send_to_anthropic,
+        'perplexity': send_to_perplexity,
+        'groq':       send_to_groq,
+    }
 
-    if llm_name == "openai":
-        return send_to_openai(prompt, api_key, model)
+    if llm_name not in adapters:
+        raise ValueError(f"Unsupported LLM provider: {llm_name}")
 
-    elif llm_name == "gemini":
-        return send_to_gemini(prompt, api_key, model)
+    response, truncated = adapters[llm_name](prompt, api_key, model, timeouts, **(call_options or {}))
 
-    elif llm_name == "anthropic":
-        return send_to_anthropic(prompt, api_key, model)
+    for continuation in range(continuations_allowed(call_options)):
+        if not truncated: break
+        logger.info(f"{llm_name} response stopped at the output limit. Requesting continuation {continuation + 1}.")
+        response, truncated = join_continuation(response, adapters[llm_name](prompt, api_key, model, timeouts, partial=response, **(call_options or {})))
 
-    elif llm_name == "perplexity":
-        return send_to_perplexity(prompt, api_key, model)
+    if truncated: logger.warning(f"{llm_name} response is still cut off after the allowed continuations.")
 
-    elif llm_name == "groq":
-        return send_to_groq(prompt, api_key, model)
+    return response
 
-    else:
+# Async version of call_llm, run on the adapter loop. Each request, including
+# any retries inside the provider SDK, is limited to the total timeout.
+async def async_call_llm(prompt, llm_name, model=None, call_options=None):
+
+    global all_llm_list, all_api_keys, all_llm_models
+
+    import asyncio
+
+    get_all_llm_info()
+
+    api_key  = all_api_keys[llm_name]
+    model    = model or all_llm_models[llm_name]
+    timeouts = get_timeout_settings()
+
+    adapters = {
+        'openai':     async_send_to_openai,
+        'gemini':     async_send_to_gemini,
+        'anthropic':  async_send_to_anthropic,
+        'perplexity': async_send_to_perplexity,
+        'groq':       async_send_to_groq,
+    }
+
+    if llm_name not in adapters:
         raise ValueError(f"Unsupported LLM provider: {llm_name}")
 
+    response, truncated = await asyncio.wait_for(adapters[llm_name](prompt, api_key, model, timeouts, **(call_options or {})), timeouts['total'])
+
+    for continuation in range(continuations_allowed(call_options)):
+        if not truncated: break
+        logger.info(f"{llm_name} response stopped at the output limit. Requesting continuation {continuation + 1}.")
+        more = await asyncio.wait_for(adapters[llm_name](prompt, api_key, model, timeouts, partial=response, **(call_options or {})), timeouts['total'])
+        response, truncated = join_continuation(response, more)
+
+    if truncated: logger.warning(f"{llm_name} response is still cut off after the allowed continuations.")
+
+    return response
+
+###############################################################################
+# Output limits and continuation of cut-off responses
+###############################################################################
+
+# Asks for the rest of a cut-off response (providers that can't resume the
+# assistant's own message, see the adapters)
+CONTINUATION_REQUEST = ("Your previous response was cut off at the output limit. Continue it exactly where it stopped, "
+                        "without repeating any of it and without any remarks of your own.")
+
+###############################################################################
+# Output limits from the [OutputLimits] section of config.txt: the output
+# tokens per request for each phase, the largest output each provider accepts,
+# and the number of continuation requests for a cut-off response.
+###############################################################################
+def get_output_limit_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['OutputLimits'] if 'OutputLimits' in config else {}
+
+    settings = {}
+    settings['max_continuations'] = int(section.get('max_continuations', '3'))
+    settings['phases']    = {phase: int(section.get(phase) or 0)
+                             for phase in ('understanding', 'architecture', 'code', 'review', 'documentation', 'summary')}
+    settings['providers'] = {llm_name: int(section.get(llm_name) or 0)
+                             for llm_name in ('openai', 'gemini', 'anthropic', 'perplexity', 'groq')}
+
+    return settings
+
+# call_options for a phase on a provider: the phase's output limit, lowered to
+# the provider's. Empty if the phase has no limit (the provider default is used).
+def get_output_options(phase, llm_name):
+
+    settings = get_output_limit_settings()
+
+    max_tokens = settings['phases'].get(phase, 0)
+    if not max_tokens: return {}
+
+    provider_limit = settings['providers'].get(llm_name, 0)
+    if provider_limit: max_tokens = min(max_tokens, provider_limit)
+
+    return {'max_tokens': max_tokens}
+
+# Structured answers (json_schema) are short and can't be joined, so they are not continued
+def continuations_allowed(call_options):
+
+    if call_options and call_options.get('json_schema'): return 0
+    return get_output_limit_settings()['max_continuations']
+
+def join_continuation(response, continuation):
+
+    text, truncated = continuation
+    if not text: return response, False
+
+    return (response or '') + text, truncated
+
+###############################################################################
+# Timeouts for provider calls, from the [Timeouts] section of config.txt:
+# connect to open a connection, read for the longest wait for more data, and
+# total for the whole call.
+###############################################################################
+def get_timeout_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Timeouts'] if 'Timeouts' in config else {}
+
+    settings = {}
+    settings['async_adapters'] = section.get('async_adapters', 'no').lower() in ['yes', '1']
+    settings['connect']        = float(section.get('connect', '10'))
+    settings['read']           = float(section.get('read', '300'))
+    settings['total']          = float(section.get('total', '900'))
+
+    return settings
+
+def httpx_timeout(timeouts):
+
+    import httpx
+
+    return httpx.Timeout(timeouts['total'], connect=timeouts['connect'], read=timeouts['read'])
+
+# Starts the adapter event loop in a daemon thread the first time it is needed
+def get_adapter_loop():
+
+    global adapter_loop
+
+    with adapter_loop_lock:
+        if adapter_loop is None:
+            import asyncio
+            adapter_loop = asyncio.new_event_loop()
+            threading.Thread(target=adapter_loop.run_forever, name='llm-adapters', daemon=True).start()
+
+    return adapter_loop
+
+# Client for the async adapters, created once per kind, API key and timeouts so
+# connections are reused. Kinds: 'http' (plain httpx), 'openai', 'groq'.
+def get_async_client(kind, api_key, timeouts):
+
+    key = (kind, api_key, timeouts['connect'], timeouts['read'], timeouts['total'])
+
+    if key not in async_clients:
+        if kind == 'openai':
+            from openai import AsyncOpenAI
+            async_clients[key] = AsyncOpenAI(api_key=api_key, timeout=httpx_timeout(timeouts))
+        elif kind == 'groq':
+            from groq import AsyncGroq
+            async_clients[key] = AsyncGroq(api_key=api_key, timeout=httpx_timeout(timeouts))
+        else:
+            import httpx
+            async_clients[key] = httpx.AsyncClient(timeout=httpx_timeout(timeouts))
+
+    return async_clients[key]
+
+# Client kind of each provider's async adapter (gemini's SDK keeps its own)
+ASYNC_CLIENT_KINDS = {'openai': 'openai', 'groq': 'groq', 'anthropic': 'http', 'perplexity': 'http'}
+
+# Imports the SDKs of the available providers and creates their async clients
+# ahead of the first call. A long-running process (the daemon) does this once at
+# startup so its first task doesn't pay for them.
+def warm_up_clients():
+
+    get_all_llm_info()
+    timeouts = get_timeout_settings()
+
+    def warm_up(llm_name):
+        if llm_name == 'gemini':
+            import google.generativeai
+        elif not timeouts['async_adapters']:
+            if llm_name == 'openai':  import openai
+            elif llm_name == 'groq':  import groq
+            else:                     import requests
+        else:
+            import asyncio
+            kind    = ASYNC_CLIENT_KINDS[llm_name]
+            api_key = all_api_keys[llm_name] if kind != 'http' else None
+            async def create_client(): get_async_client(kind, api_key, timeouts)
+            asyncio.run_coroutine_threadsafe(create_client(), get_adapter_loop()).result()
+
+    for llm_name in all_llm_list:
+        try:
+            warm_up(llm_name)
+        except ImportError as e:
+            logger.warning(f"Could not load the client for {llm_name}: {e}")
+
 ###############################################################################
 # Get LLM model and API key for all LLMs. Populates values for
 # all_llm_list, all_api_keys, all_llm_models
@@ -324,6 +1034,10 @@ def get_all_llm_info():
     if os.getenv("ANTHROPIC_API_KEY"):  all_llm_list.append('anthropic')
     if os.getenv("GROQ_API_KEY"):       all_llm_list.append('groq')
 
+    # Replayed runs need no API keys: every LLM with a model in config.txt is listed
+    if get_replay_settings()['enabled']:
+        all_llm_list = [llm for llm in ['gemini', 'openai', 'perplexity', 'anthropic', 'groq'] if config['Models'].get(llm)]
+
     # Get models for each LLM service
     all_llm_models = {}
     for llm in all_llm_list:
@@ -345,31 +1059,108 @@ def get_all_llm_info():
 ###############################################################################
 # OpenAI
 ###############################################################################
-def send_to_openai(prompt, api_key, model):
 
-    client = OpenAI(api_key=api_key)
+# With a schema, JSON mode guarantees a parseable object (the prompt describes its shape)
+def openai_chat_options(json_schema, max_tokens):
+
+    options = {}
+    if json_schema: options['response_format'] = {"type": "json_object"}
+    if max_tokens:  options['max_tokens'] = max_tokens
+
+    return options
+
+# Chat messages for the prompt. A continuation adds the text so far and asks for the rest.
+def chat_messages(prompt, partial):
+
+    messages = [{"role": "user", "content": prompt}]
+    if partial:
+        messages.append({"role": "assistant", "content": partial})
+        messages.append({"role": "user", "content": CONTINUATION_REQUEST})
+
+    return messages
+
+# Text of a chat completion, and whether it stopped at the output limit
+def chat_completion_result(completion):
+
+    choice = completion.choices[0]
+    return choice.message.content, choice.finish_reason == 'length'
+
+def send_to_openai(prompt, api_key, model, timeouts, json_schema=None, max_tokens=None, partial=None):
+
+    from openai import OpenAI
+
+    client = OpenAI(api_key=api_key, timeout=httpx_timeout(timeouts))
     completion = client.chat.completions.create(
-        messages=[{"role": "user", "content": prompt}],
+        messages=chat_messages(prompt, partial),
         model=model,
+        **openai_chat_options(json_schema, max_tokens),
     )
-    return completion.choices[0].message.content
+    return chat_completion_result(completion)
+
+async def async_send_to_openai(prompt, api_key, model, timeouts, json_schema=None, max_tokens=None, partial=None):
+
+    client = get_async_client('openai', api_key, timeouts)
+    completion = await client.chat.completions.create(
+        messages=chat_messages(prompt, partial),
+        model=model,
+        **openai_chat_options(json_schema, max_tokens),
+    )
+    return chat_completion_result(completion)
 
 ###############################################################################
 # Google Gemini
 ###############################################################################
-def send_to_gemini(prompt, api_key, model):
+def gemini_generation_config(json_schema, max_tokens):
+
+    generation_config = {}
+    if json_schema: generation_config['response_mime_type'] = "application/json"
+    if max_tokens:  generation_config['max_output_tokens'] = max_tokens
+
+    return generation_config or None
+
+# The prompt, or for a continuation the conversation so far and a request for the rest
+def gemini_contents(prompt, partial):
+
+    if not partial: return prompt
+
+    return [{'role': 'user', 'parts': [prompt]},
+            {'role': 'model', 'parts': [partial]},
+            {'role': 'user', 'parts': [CONTINUATION_REQUEST]}]
+
+def gemini_result(response):
+
+    finish_reason = response.candidates[0].finish_reason if response.candidates else None
+    return response.text, getattr(finish_reason, 'name', '') == 'MAX_TOKENS'
+
+def send_to_gemini(prompt, api_key, model, timeouts, json_schema=None, max_tokens=None, partial=None):
+
+    import google.generativeai as genai
 
     genai.configure(api_key=api_key)
     model = genai.GenerativeModel(model)
-    response = model.generate_content(prompt)
-    return response.text
+    response = model.generate_content(gemini_contents(prompt, partial), generation_config=gemini_generation_config(json_schema, max_tokens),
+                                      request_options={'timeout': timeouts['total']})
+    return gemini_result(response)
+
+async def async_send_to_gemini(prompt, api_key, model, timeouts, json_schema=None, max_tokens=None, partial=None):
+
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel(model)
+    response = await model.generate_content_async(gemini_contents(prompt, partial), generation_config=gemini_generation_config(json_schema, max_tokens),
+                                                  request_options={'timeout': timeouts['total']})
+    return gemini_result(response)
 
 ###############################################################################
 # Anthropic
 ###############################################################################
-def send_to_anthropic(prompt, api_key, model):
+ANTHROPIC_API_URL = "https://api.anthropic.com/v1/messages"
+
+# A continuation ends the messages with the text so far as the assistant's turn,
+# which Claude carries on from directly. The API rejects trailing whitespace there.
+def anthropic_request(prompt, api_key, model, json_schema, max_tokens, partial=None):
 
-    api_url = "https://api.anthropic.com/v1/messages"
     headers = {
         "Content-Type": "application/json",
         "x-api-key": api_key,
@@ -377,33 +1168,82 @@ def send_to_anthropic(prompt, api_key, model):
     }
     data = {
         "model": model,
-        "max_tokens": 4096,  # Adjust as needed
+        "max_tokens": max_tokens or 4096,
         "messages": [{"role": "user", "content": prompt}]
     }
-    response = requests.post(api_url, headers=headers, json=data)
+
+    if partial: data["messages"].append({"role": "assistant", "content": partial.rstrip()})
+
+    # Structured output is a forced tool call whose input must match the schema
+    if json_schema:
+        data["tools"] = [{"name": "structured_answer", "description": "Record the answer.", "input_schema": json_schema}]
+        data["tool_choice"] = {"type": "tool", "name": "structured_answer"}
+
+    return headers, data
+
+# Text of the response, and whether it stopped at the output limit. A continuation
+# carries on from the text so far, so its leading whitespace is kept.
+def anthropic_result(result, json_schema, partial=None):
+
+    truncated = result.get('stop_reason') == 'max_tokens'
+
+    if json_schema:
+        for block in result['content']:
+            if block.get('type') == 'tool_use': return json.dumps(block['input']), truncated
+
+    response_text = result['content'][0]['text'] if result['content'] else ''
+    return (response_text.rstrip() if partial else response_text.strip()), truncated
+
+def send_to_anthropic(prompt, api_key, model, timeouts, json_schema=None, max_tokens=4096, partial=None):
+
+    headers, data = anthropic_request(prompt, api_key, model, json_schema, max_tokens, partial)
+
+    import requests
+
+    response = requests.post(ANTHROPIC_API_URL, headers=headers, json=data, timeout=(timeouts['connect'], timeouts['read']))
     response.raise_for_status()  # Check for HTTP errors
-    result = response.json()
-    response_text = result['content'][0]['text'].strip()
-    return response_text
+    return anthropic_result(response.json(), json_schema, partial)
+
+async def async_send_to_anthropic(prompt, api_key, model, timeouts, json_schema=None, max_tokens=4096, partial=None):
+
+    headers, data = anthropic_request(prompt, api_key, model, json_schema, max_tokens, partial)
+
+    client = get_async_client('http', None, timeouts)
+    response = await client.post(ANTHROPIC_API_URL, headers=headers, json=data)
+    response.raise_for_status()
+    return anthropic_result(response.json(), json_schema, partial)
 
 ###############################################################################
 # Groq
 ###############################################################################
-def send_to_groq(prompt, api_key, model):
+def send_to_groq(prompt, api_key, model, timeouts, json_schema=None, max_tokens=None, partial=None):
 
-    client = Groq(api_key=api_key)
+    from groq import Groq
+
+    client = Groq(api_key=api_key, timeout=httpx_timeout(timeouts))
     chat_completion = client.chat.completions.create(
-        messages=[{"role": "user", "content": prompt}],
+        messages=chat_messages(prompt, partial),
+        model=model,
+        **openai_chat_options(json_schema, max_tokens),
+    )
+    return chat_completion_result(chat_completion)
+
+async def async_send_to_groq(prompt, api_key, model, timeouts, json_schema=None, max_tokens=None, partial=None):
+
+    client = get_async_client('groq', api_key, timeouts)
+    chat_completion = await client.chat.completions.create(
+        messages=chat_messages(prompt, partial),
         model=model,
+        **openai_chat_options(json_schema, max_tokens),
     )
-    return chat_completion.choices[0].message.content
+    return chat_completion_result(chat_completion)
 
 ###############################################################################
 # Perplexity
 ###############################################################################
-def send_to_perplexity(prompt, api_key, model):
+PERPLEXITY_API_URL = "https://api.perplexity.ai/chat/completions"
 
-    PERPLEXITY_API_URL = "https://api.perplexity.ai/chat/completions"
+def perplexity_request(prompt, api_key, model, json_schema, max_tokens, partial=None):
 
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -411,12 +1251,39 @@ def send_to_perplexity(prompt, api_key, model):
     }
     data = {
         "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 20000  # Adjust as needed
+        "messages": chat_messages(prompt, partial),
+        "max_tokens": max_tokens or 20000
     }
-    response = requests.post(PERPLEXITY_API_URL, headers=headers, json=data)
+
+    # Perplexity takes the schema as a json_schema response format
+    if json_schema:
+        data["response_format"] = {"type": "json_schema", "json_schema": {"schema": json_schema}}
+
+    return headers, data
+
+def perplexity_result(result):
+
+    choice = result['choices'][0]
+    return choice['message']['content'], choice.get('finish_reason') == 'length'
+
+def send_to_perplexity(prompt, api_key, model, timeouts, json_schema=None, max_tokens=20000, partial=None):
+
+    headers, data = perplexity_request(prompt, api_key, model, json_schema, max_tokens, partial)
+
+    import requests
+
+    response = requests.post(PERPLEXITY_API_URL, headers=headers, json=data, timeout=(timeouts['connect'], timeouts['read']))
+    response.raise_for_status()
+    return perplexity_result(response.json())
+
+async def async_send_to_perplexity(prompt, api_key, model, timeouts, json_schema=None, max_tokens=20000, partial=None):
+
+    headers, data = perplexity_request(prompt, api_key, model, json_schema, max_tokens, partial)
+
+    client = get_async_client('http', None, timeouts)
+    response = await client.post(PERPLEXITY_API_URL, headers=headers, json=data)
     response.raise_for_status()
-    return response.json()['choices'][0]['message']['content']
+    return perplexity_result(response.json())
 
 ###############################################################################
 # Extracting answer number
@@ -0,0 +1,201 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Record and replay of LLM calls. Every call made by call_llm_with_logging
+# is already logged as a request and a response file in llm_logs; each call
+# is also listed in llm_logs/calls.jsonl with its files, model and latency.
+#
+# With replay on ([Replay] in config.txt), a recorded llm_logs folder (the
+# cassette) answers the calls instead of the providers, so a run needs no
+# API keys and no network. A call is matched by the hash of its prompt, or if
+# no prompt is the same, by the most similar recorded prompt above
+# fuzzy_threshold. The recorded latency, times latency_scale, is waited out
+# before answering. Older logs without calls.jsonl are paired by file order.
+###############################################################################
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import configparser
+from datetime import datetime
+
+from response_cache import compute_signature, estimate_similarity
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+CALLS_FILE   = 'calls.jsonl'
+LOG_FILE_RE  = re.compile(r'^(\d{8}_\d{12})_(request|response)_([a-z]+)(_reused)?\.txt$')
+TIMESTAMP_FORMAT = '%Y%m%d_%H%M%S%f'
+
+# Cassettes loaded by this process, by folder
+loaded_cassettes = {}
+cassette_lock    = threading.Lock()
+calls_file_lock  = threading.Lock()
+
+class ReplayMiss(RuntimeError):
+    pass
+
+def get_replay_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Replay'] if 'Replay' in config else {}
+
+    settings = {}
+    settings['enabled']         = section.get('enabled', 'no').lower() in ['yes', '1']
+    settings['cassette']        = section.get('cassette', '').strip()
+    settings['fuzzy_threshold'] = float(section.get('fuzzy_threshold', '0.9'))
+    settings['latency_scale']   = float(section.get('latency_scale', '0'))
+    settings['on_miss']         = section.get('on_miss', 'error').strip().lower()
+
+    return settings
+
+def prompt_hash(prompt):
+
+    return hashlib.sha256((prompt or '').encode('utf-8')).hexdigest()
+
+###############################################################################
+# Recording
+###############################################################################
+
+# Adds one call to llm_logs/calls.jsonl
+def record_call_log(logs_folder, request_file, response_file, llm_name, model, prompt, seconds, phase=None, role=None, include_markers=False):
+
+    entry = {'request': os.path.basename(request_file), 'response': os.path.basename(response_file), 'llm_name': llm_name,
+             'model': model, 'seconds': round(seconds, 3), 'prompt_hash': prompt_hash(prompt), 'phase': phase, 'role': role,
+             'include_markers': bool(include_markers)}
+
+    with calls_file_lock:
+        with open(os.path.join(logs_folder, CALLS_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+
+###############################################################################
+# Loading a cassette
+###############################################################################
+
+def read_log_file(folder, name):
+
+    with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+# Calls listed in calls.jsonl
+def load_listed_calls(folder):
+
+    calls = []
+    with open(os.path.join(folder, CALLS_FILE), 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                calls.append({'llm_name': entry['llm_name'], 'seconds': entry['seconds'],
+                              'prompt': read_log_file(folder, entry['request']), 'response': read_log_file(folder, entry['response'])})
+            except (ValueError, KeyError, OSError) as e:
+                logger.warning(f"Skipping a call in {CALLS_FILE}: {e}")
+
+    return calls
+
+# Calls paired from the request and response files alone. Each response closes
+# the oldest open request of its provider, which is right unless calls to one
+# provider overlapped. Reused (cached) responses are skipped.
+def pair_log_files(folder):
+
+    open_requests, calls = {}, []
+    for name in sorted(os.listdir(folder)):
+        match = LOG_FILE_RE.match(name)
+        if not match: continue
+
+        timestamp, kind, llm_name, reused = match.groups()
+        at = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        requests = open_requests.setdefault(llm_name, [])
+
+        if kind == 'request':
+            requests.append((at, name))
+        elif requests:
+            request_at, request_name = requests.pop(0)
+            if reused: continue
+            calls.append({'llm_name': llm_name, 'seconds': (at - request_at).total_seconds(),
+                          'prompt': read_log_file(folder, request_name), 'response': read_log_file(folder, name)})
+
+    return calls
+
+def load_cassette(folder):
+
+    with cassette_lock:
+        if folder in loaded_cassettes: return loaded_cassettes[folder]
+
+        if not os.path.isdir(folder):
+            raise ReplayMiss(f"Replay cassette {folder} does not exist.")
+
+        calls = load_listed_calls(folder) if os.path.exists(os.path.join(folder, CALLS_FILE)) else pair_log_files(folder)
+
+        cassette = {'calls': calls, 'by_hash': {}, 'served': {}}
+        for number, call in enumerate(calls):
+            cassette['by_hash'].setdefault(prompt_hash(call['prompt']), []).append(number)
+
+        logger.info(f"Replay cassette {folder}: {len(calls)} recorded calls")
+        loaded_cassettes[folder] = cassette
+
+        return cassette
+
+###############################################################################
+# Replaying
+###############################################################################
+
+# Picks the recording for a prompt: the same prompt to the same provider, then
+# the same prompt to any provider, then the most similar prompt. Recordings
+# of a repeated prompt are served in order, the last one again once used up.
+def find_recorded_call(cassette, prompt, llm_name, threshold):
+
+    numbers = cassette['by_hash'].get(prompt_hash(prompt), [])
+    same_llm = [number for number in numbers if cassette['calls'][number]['llm_name'] == llm_name]
+    candidates = same_llm or numbers
+
+    if candidates:
+        key = (prompt_hash(prompt), llm_name if same_llm else None)
+        served = cassette['served'].get(key, 0)
+        cassette['served'][key] = served + 1
+        return cassette['calls'][candidates[min(served, len(candidates) - 1)]], 1.0
+
+    if threshold <= 0 or threshold > 1: return None, 0.0
+
+    signature = compute_signature(prompt)
+    best, best_similarity = None, 0.0
+    for call in cassette['calls']:
+        if 'signature' not in call: call['signature'] = compute_signature(call['prompt'])
+        similarity = estimate_similarity(signature, call['signature'])
+        if call['llm_name'] == llm_name: similarity += 1e-6   # Prefer the same provider on a tie
+        if similarity > best_similarity: best, best_similarity = call, similarity
+
+    if best_similarity >= threshold: return best, min(best_similarity, 1.0)
+    return None, best_similarity
+
+# The recorded response for a call, after its recorded latency (scaled).
+# Returns None when nothing matches and on_miss is 'live'.
+def replay_call(prompt, llm_name, logs_folder, settings):
+
+    folder   = os.path.abspath(settings['cassette'] or logs_folder)
+    cassette = load_cassette(folder)
+
+    with cassette_lock:
+        call, similarity = find_recorded_call(cassette, prompt, llm_name, settings['fuzzy_threshold'])
+
+    if call is None:
+        if settings['on_miss'] == 'live': return None
+        if settings['on_miss'] == 'empty': return ''
+        raise ReplayMiss(f"No recorded call for this {llm_name} prompt (best similarity {similarity:.2f}).")
+
+    if similarity < 1.0: logger.info(f"Replaying a similar {call['llm_name']} call for {llm_name} (similarity {similarity:.2f}).")
+
+    if settings['latency_scale'] > 0: time.sleep(call['seconds'] * settings['latency_scale'])
+
+    return call['response']
@@ -0,0 +1,187 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Consensus check before the panel vote. The file blocks of each candidate
+# are normalized (Python by its syntax tree, without comments or docstrings;
+# other files by their text without comment lines or whitespace differences)
+# and compared pairwise. When most candidates are effectively the same, the
+# vote is skipped and the candidate closest to the others is the answer.
+#
+# How often the vote was skipped, per phase, is kept in
+# llm_logs/consensus_stats.json. Several processes may share the file, so each
+# update re-reads it under an OS file lock (see workspace.py), as
+# provider_stats.py does.
+###############################################################################
+
+import os
+import re
+import ast
+import json
+import tempfile
+import threading
+
+from response_cache import compute_signature, estimate_similarity
+from workspace import lock_file, unlock_file
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+STATS_FILE = 'consensus_stats.json'
+LOCK_FILE  = 'consensus_stats.lock'
+
+# The same block markers as parse_llm_response in main.py
+BLOCK_PATTERN   = re.compile(r'`?<<<(CODE|FILE|DOC) START: (.+?)>>>`?\s*(.*?)\s*`?<<<\1 END: \2>>>`?', re.DOTALL)
+COMMENT_LINE_RE = re.compile(r'^\s*(#|//|/?\*)')
+
+stats_lock = threading.Lock()
+
+###############################################################################
+# Normalization
+###############################################################################
+
+# The syntax tree of Python source without docstrings, or None if it doesn't parse
+def normalize_python(source):
+
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return None
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and node.body:
+            first = node.body[0]
+            if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+                node.body = node.body[1:] or [ast.Pass()]
+
+    return ast.dump(tree, annotate_fields=False)
+
+def normalize_text(text):
+
+    lines = (line for line in text.splitlines() if not COMMENT_LINE_RE.match(line))
+    return ' '.join(' '.join(lines).split())
+
+def normalize_block(filename, content):
+
+    if filename.endswith('.py'):
+        normalized = normalize_python(content)
+        if normalized is not None: return normalized
+
+    return normalize_text(content)
+
+# {filename: normalized content} for the file blocks of a response, or the
+# whole response under '' when it has no blocks
+def normalize_candidate(response):
+
+    blocks = {filename.strip(): normalize_block(filename.strip(), content) for _, filename, content in BLOCK_PATTERN.findall(response)}
+    if not blocks: blocks = {'': normalize_text(response)}
+
+    return blocks
+
+###############################################################################
+# Comparison
+###############################################################################
+
+# Similarity of two normalized candidates (0.0 to 1.0): the similarity of each
+# file, weighted by its size. A file only one of them has counts as 0.
+def candidate_similarity(blocks_a, blocks_b, signatures):
+
+    total, weighted = 0, 0.0
+    for filename in set(blocks_a) | set(blocks_b):
+        a, b = blocks_a.get(filename), blocks_b.get(filename)
+        size = max(len(a or ''), len(b or ''), 1)
+        total += size
+
+        if a is None or b is None: continue
+        if a == b:
+            weighted += size
+            continue
+
+        for text in (a, b):
+            if text not in signatures: signatures[text] = compute_signature(text)
+        weighted += size * estimate_similarity(signatures[a], signatures[b])
+
+    return weighted / total if total else 0.0
+
+###############################################################################
+# Returns the number of the consensus candidate in response_dict, or None.
+# A consensus needs more than half of the candidates to be at least
+# 'threshold' similar to one of them; of those, the one most similar to the
+# rest is chosen (the first on a tie). Empty responses agree with nothing.
+###############################################################################
+def find_consensus(response_dict, threshold):
+
+    numbers = sorted(response_dict)
+    blocks  = {number: normalize_candidate(response_dict[number]['response']) for number in numbers
+               if (response_dict[number]['response'] or '').strip()}
+
+    signatures, similarity = {}, {}
+    for a in blocks:
+        for b in blocks:
+            if a < b: similarity[a, b] = similarity[b, a] = candidate_similarity(blocks[a], blocks[b], signatures)
+
+    best, best_score = None, None
+    for number in blocks:
+        agreeing = [other for other in blocks if other == number or similarity[number, other] >= threshold]
+        if len(agreeing) * 2 <= len(numbers): continue
+
+        score = sum(similarity[number, other] for other in agreeing if other != number)
+        if best_score is None or score > best_score: best, best_score = number, score
+
+    return best
+
+###############################################################################
+# Metrics: panels checked and votes skipped, per phase
+###############################################################################
+
+def load_consensus_stats(stats_folder):
+
+    stats = {}
+    stats_path = os.path.join(stats_folder, STATS_FILE)
+    if os.path.exists(stats_path):
+        try:
+            with open(stats_path, 'r', encoding='utf-8') as f:
+                stats = json.load(f)
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not read {stats_path}: {e}. Starting new consensus stats.")
+
+    return stats
+
+def save_consensus_stats(stats_folder, stats):
+
+    stats_path = os.path.join(stats_folder, STATS_FILE)
+    descriptor, temp_path = tempfile.mkstemp(dir=stats_folder, prefix=STATS_FILE + '.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f: json.dump(stats, f, indent=2)
+        os.replace(temp_path, stats_path)
+    except BaseException:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        raise
+
+# The stats are re-read from the file for each update, under this process's
+# lock and the folder's file lock, so no other process's counts are lost. A
+# failed write is logged; it never stops the panel.
+def record_consensus_result(stats_folder, phase, vote_skipped):
+
+    try:
+        with stats_lock, open(os.path.join(stats_folder, LOCK_FILE), 'a+') as lock:
+            lock_file(lock, blocking=True)
+            try:
+                stats = load_consensus_stats(stats_folder)
+                entry = stats.setdefault(phase or 'other', {'panels': 0, 'votes_skipped': 0})
+                entry['panels'] += 1
+                if vote_skipped: entry['votes_skipped'] += 1
+
+                save_consensus_stats(stats_folder, stats)
+            finally:
+                unlock_file(lock)
+    except OSError as e:
+        logger.warning(f"Could not update the consensus stats in {stats_folder}: {e}")
+        return
+
+    logger.info(f"Consensus: vote skipped for {entry['votes_skipped']} of {entry['panels']} {phase or 'other'} panels.")
@@ -0,0 +1,376 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Daemon mode: `python daemon.py`. Stays resident and runs the tasks of all
+# projects in one process, so provider SDKs and clients, the adapter loop and
+# the symbol indexes stay loaded between tasks.
+#
+# Tasks come from projects/*/config/tasks.txt (polled; the file is emptied
+# once its task is queued, so tasks waiting when the daemon starts are queued
+# too) or from the local HTTP API. Each project has its own queue, and the projects take turns,
+# one task at a time. With tasks = queue in [JobQueue], the tasks go to the
+# workers of the job queue instead (worker.py), several at once but never two
+# of one project. Tasks run without the confirmation prompt.
+#
+# HTTP API (address in the [Daemon] section of config.txt):
+#   GET  /status       queued, running and recent tasks
+#   GET  /tasks/<id>   one task
+#   POST /tasks        {"project": "<name>", "task": "<text>"} queues a task
+# A POST must be sent as application/json with the header
+# "Authorization: Bearer <token>" (token in [Daemon]; one is made up and
+# printed at startup if it is blank). Requests from a web page of another
+# origin are refused, so a page open in a browser can't queue tasks.
+###############################################################################
+
+import os
+import re
+import json
+import glob
+import hmac
+import time
+import secrets
+import threading
+import itertools
+import configparser
+from collections import deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import main as firebird
+import api_caller
+from job_queue import get_job_queue_settings, get_job_queue, run_job
+from workspace import project_lock
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+PROJECT_NAME_PATTERN = re.compile(r'^[\w.-]+$')
+
+# Task records by id, the queue of each project, the projects with queued
+# tasks in the order they take turns, and the projects with a task running.
+# Guarded by queue_condition.
+tasks            = {}
+project_queues   = {}
+project_turns    = deque()
+running_projects = set()
+finished_tasks  = deque()
+task_ids        = itertools.count(1)
+queue_condition = threading.Condition()
+
+# API tasks whose archive entry waits for their project to be free
+pending_archives      = []
+pending_archives_lock = threading.Lock()
+
+def get_daemon_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Daemon'] if 'Daemon' in config else {}
+
+    settings = {}
+    settings['host']          = section.get('host', '127.0.0.1').strip()
+    settings['port']          = int(section.get('port', '8765'))
+    settings['poll_interval'] = float(section.get('poll_interval', '2'))
+    settings['history']       = int(section.get('history', '50'))
+    settings['token']         = section.get('token', '').strip()
+
+    return settings
+
+###############################################################################
+# Task queue
+###############################################################################
+
+# Same normalization as get_project_name in main.py. Returns None for a name
+# that can't be a project folder.
+def normalize_project_name(name):
+
+    name = str(name or '').lower().replace(" ", "")
+    if not PROJECT_NAME_PATTERN.match(name) or name in ('.', '..'): return None
+
+    return name
+
+# Adds a task to its project's queue and returns the task record
+def submit_task(project, task, source):
+
+    with queue_condition:
+        record = {'id': next(task_ids), 'project': project, 'task': task, 'source': source, 'status': 'queued',
+                  'queued_at': datetime.now().isoformat(timespec='seconds'), 'started_at': None, 'finished_at': None,
+                  'changes': None, 'error': None}
+        tasks[record['id']] = record
+
+        if not project_queues.get(project): project_turns.append(project)
+        project_queues.setdefault(project, deque()).append(record)
+
+        queue_condition.notify()
+
+    logger.info(f"Queued task {record['id']} for {project} (from {source}).")
+    return record
+
+# Waits for the next task. Projects take turns, so a long queue in one project
+# doesn't hold up the others, and a project's tasks run one after the other.
+def next_task():
+
+    with queue_condition:
+        while True:
+            project = next((project for project in project_turns if project not in running_projects), None)
+            if project: break
+            queue_condition.wait()
+
+        project_turns.remove(project)
+        record = project_queues[project].popleft()
+        if project_queues[project]: project_turns.append(project)
+        running_projects.add(project)
+
+        record['status']     = 'running'
+        record['started_at'] = datetime.now().isoformat(timespec='seconds')
+
+    return record
+
+def finish_task(record, status, history, changes=None, error=None):
+
+    with queue_condition:
+        record['status']      = status
+        record['finished_at'] = datetime.now().isoformat(timespec='seconds')
+        record['changes']     = changes
+        record['error']       = error
+
+        finished_tasks.append(record['id'])
+        while len(finished_tasks) > history: tasks.pop(finished_tasks.popleft(), None)
+
+        running_projects.discard(record['project'])
+        queue_condition.notify_all()
+
+# Same archive entry as read_tasks_file in main.py, for tasks sent to the API.
+# The daemon's threads never wait for a project a task is running on: if it is
+# busy, the entry is kept in pending_archives and the watcher retries it on
+# its next poll. Returns True once written.
+def archive_task(project, task, timestamp=None):
+
+    config_folder = os.path.join(os.getcwd(), 'projects', project, 'config')
+    os.makedirs(config_folder, exist_ok=True)
+    timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    with project_lock(os.path.dirname(config_folder), blocking=False) as held:
+        if not held:
+            with pending_archives_lock:
+                pending_archives.append((project, task, timestamp))
+            return False
+
+        with open(os.path.join(config_folder, 'tasks_archive.txt'), 'a') as archive_file:
+            for line in task.splitlines():
+                if line.strip(): archive_file.write(f"{timestamp} - {line.strip()}\n")
+
+    return True
+
+def archive_pending_tasks():
+
+    with pending_archives_lock:
+        entries = list(pending_archives)
+        pending_archives.clear()
+
+    for project, task, timestamp in entries:
+        archive_task(project, task, timestamp)
+
+# Claims the tasks in tasks.txt, or returns None without waiting if the
+# project is busy
+def try_claim_tasks(task_file):
+
+    with project_lock(os.path.dirname(os.path.dirname(task_file)), blocking=False) as held:
+        if not held: return None
+        return firebird.claim_tasks(task_file) or ''
+
+def run_queued_task(record, settings):
+
+    print(f"Running task {record['id']} for {record['project']}: {record['task']}")
+
+    queue_settings = get_job_queue_settings()
+
+    try:
+        if queue_settings['tasks'] == 'queue':
+            changes = run_job(get_job_queue(queue_settings), 'task', {'project': record['project'], 'task': record['task']},
+                              queue_settings['poll_interval'])
+        else:
+            project_settings = firebird.open_project(record['project'])
+            change_set = firebird.run_task(record['task'], project_settings, confirm=False)
+            changes = {kind: len(paths) for kind, paths in change_set.items()}
+    except (Exception, SystemExit) as e:
+        logger.error(f"Task {record['id']} for {record['project']} failed: {e!r}")
+        finish_task(record, 'failed', settings['history'], error=repr(e))
+        return
+
+    finish_task(record, 'done', settings['history'], changes=changes)
+    print(f"Task {record['id']} for {record['project']} done.")
+
+def run_worker(settings):
+
+    while True:
+        run_queued_task(next_task(), settings)
+
+###############################################################################
+# Watching tasks.txt. A changed file is queued once it has stayed the same for
+# one poll, so a file still being saved is not read half-written.
+###############################################################################
+def watch_task_files(settings):
+
+    def task_file_stats():
+        stats = {}
+        for task_file in glob.glob(os.path.join(os.getcwd(), 'projects', '*', 'config', 'tasks.txt')):
+            try:
+                stat = os.stat(task_file)
+            except OSError:
+                continue
+            stats[task_file] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    # A file is emptied when its task is claimed, so any text in it is a task not
+    # yet run, including tasks left there while the daemon was stopped
+    seen, changed = {}, {}
+
+    while True:
+        time.sleep(settings['poll_interval'])
+
+        archive_pending_tasks()
+
+        for task_file, stat in task_file_stats().items():
+            if seen.get(task_file) == stat: continue
+
+            if changed.get(task_file) != stat:
+                changed[task_file] = stat
+                continue
+
+            if not stat[0]:
+                del changed[task_file]
+                seen[task_file] = stat
+                continue
+
+            # The file is emptied, so the next edit holds only the next task. If a
+            # run holds the project, the file is left as it is for the next poll.
+            project = os.path.basename(os.path.dirname(os.path.dirname(task_file)))
+            task = try_claim_tasks(task_file)
+            if task is None: continue
+
+            del changed[task_file]
+            seen[task_file] = task_file_stats().get(task_file)
+
+            if task: submit_task(project, task, 'tasks.txt')
+
+###############################################################################
+# HTTP API
+###############################################################################
+
+def get_status():
+
+    with queue_condition:
+        return {'queued':  {project: [record['id'] for record in queue] for project, queue in project_queues.items() if queue},
+                'running': [dict(record) for record in tasks.values() if record['status'] == 'running'],
+                'tasks':   [dict(record) for record in tasks.values()]}
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, body):
+
+        data = json.dumps(body, indent=1).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Browsers send the Origin of the page making a request; only the API's own is accepted
+    def foreign_origin(self):
+
+        origin = self.headers.get('Origin')
+        return origin is not None and origin not in self.server.allowed_origins
+
+    def authorized(self):
+
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(token.strip().encode('utf-8'), self.server.token.encode('utf-8'))
+
+    def do_GET(self):
+
+        if self.foreign_origin():
+            return self.send_json(403, {'error': 'Requests from other origins are not accepted'})
+
+        if self.path == '/status':
+            return self.send_json(200, get_status())
+
+        match = re.match(r'^/tasks/(\d+)$', self.path)
+        if match:
+            with queue_condition:
+                record = dict(tasks[int(match.group(1))]) if int(match.group(1)) in tasks else None
+            if record: return self.send_json(200, record)
+            return self.send_json(404, {'error': 'No such task'})
+
+        self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+
+        if self.foreign_origin():
+            return self.send_json(403, {'error': 'Requests from other origins are not accepted'})
+
+        if self.path != '/tasks':
+            return self.send_json(404, {'error': 'Not found'})
+
+        if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+            return self.send_json(415, {'error': 'The body must be sent as application/json'})
+
+        if not self.authorized():
+            return self.send_json(401, {'error': 'Send the token from config.txt as "Authorization: Bearer <token>"'})
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except ValueError:
+            return self.send_json(400, {'error': 'The body must be JSON'})
+
+        project = normalize_project_name(body.get('project'))
+        task    = str(body.get('task') or '').strip()
+        if not project or not task:
+            return self.send_json(400, {'error': 'Give a project name and a task'})
+
+        archive_task(project, task)
+        record = submit_task(project, task, 'api')
+        self.send_json(202, record)
+
+    def log_message(self, format, *args):
+
+        logger.debug(f"API {self.address_string()} {format % args}")
+
+def run_daemon():
+
+    settings = get_daemon_settings()
+
+    print("Loading provider clients...")
+    api_caller.warm_up_clients()
+
+    # Tasks run here share main.py's module state, so only one runs at a time
+    queue_settings = get_job_queue_settings()
+    runners = queue_settings['remote_tasks'] if queue_settings['tasks'] == 'queue' else 1
+    for number in range(runners):
+        threading.Thread(target=run_worker, args=(settings,), name=f"daemon-worker-{number + 1}", daemon=True).start()
+    threading.Thread(target=watch_task_files, args=(settings,), name='daemon-watcher', daemon=True).start()
+
+    server = ThreadingHTTPServer((settings['host'], settings['port']), DaemonRequestHandler)
+    server.allowed_origins = {f"http://{host}:{server.server_port}" for host in (settings['host'], '127.0.0.1', 'localhost')}
+    server.token           = settings['token'] or secrets.token_urlsafe(24)
+    print(f"Firebird daemon listening on http://{settings['host']}:{server.server_port}, watching projects/*/config/tasks.txt")
+    if not settings['token']: print(f"No token in [Daemon] of config.txt. API token for this session: {server.token}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping the daemon.")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+
+    firebird.setup_logging()
+    run_daemon()
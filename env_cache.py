@@ -0,0 +1,392 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Cache of virtual environments for generated Python projects, so packaging
+# doesn't reinstall requirements.txt on every iteration. An environment is
+# keyed by the hash of the normalized requirements (package names, versions
+# and markers, sorted; "pip install" lines and standard library modules are
+# handled), the tools it needs (eg pyinstaller) and the Python version.
+#
+# Layout of the cache folder ([EnvCache] in config.txt):
+#   wheelhouse/         wheels of every package installed so far
+#   envs/<key>/         a ready environment, with env.json (its requirements,
+#                       size and last use)
+#   envs/<key>.lock     locked by the process building that environment
+#   envs/<key>.users/   one locked file for each build using the environment
+#   envs/evict.lock     held while marking an environment in use and while
+#                       evicting, so one is never removed as it is taken
+# The locks are OS file locks (see workspace.py), released by the OS if the
+# process dies. Packages are installed from the wheelhouse without the
+# network. Only what the wheelhouse lacks is downloaded (pip wheel), unless
+# offline = yes. When the cache grows past max_size_mb, the least recently
+# used environments not in use are removed, then the oldest wheels.
+###############################################################################
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import tempfile
+import contextlib
+import subprocess
+import configparser
+from datetime import datetime
+
+from workspace import lock_file, unlock_file
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+ENVS_FOLDER       = 'envs'
+WHEELHOUSE_FOLDER = 'wheelhouse'
+ENV_INFO_FILE     = 'env.json'
+EVICT_LOCK_FILE   = 'evict.lock'
+USERS_SUFFIX      = '.users'
+LOCK_WAIT         = 1      # Seconds between checks while another process builds an environment
+LOCK_TIMEOUT      = 1800   # Longest wait for another process's build
+
+REQUIREMENT_RE  = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$')
+PIP_INSTALL_RE  = re.compile(r'^(?:python[\d.]*\s+-m\s+)?pip3?\s+install\s+', re.IGNORECASE)
+STDLIB_MODULES  = getattr(sys, 'stdlib_module_names', frozenset())
+
+def get_env_cache_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['EnvCache'] if 'EnvCache' in config else {}
+
+    settings = {}
+    settings['enabled']     = section.get('enabled', 'no').lower() in ['yes', '1']
+    settings['folder']      = os.path.abspath(section.get('folder', 'env_cache').strip() or 'env_cache')
+    settings['max_size_mb'] = float(section.get('max_size_mb', '5000'))
+    settings['offline']     = section.get('offline', 'no').lower() in ['yes', '1']
+    settings['tools']       = [tool.strip() for tool in section.get('tools', 'pyinstaller').split(',') if tool.strip()]
+
+    return settings
+
+###############################################################################
+# Requirements
+###############################################################################
+
+# One requirement with its name in canonical form (PEP 503) and no spaces,
+# eg "Flask >= 2.0" -> "flask>=2.0". None for a standard library module.
+def normalize_requirement(requirement):
+
+    match = REQUIREMENT_RE.match(requirement.strip())
+    if not match: return None
+
+    name, rest = match.groups()
+    if name in STDLIB_MODULES or name.lower() in STDLIB_MODULES: return None
+
+    return re.sub(r'[-_.]+', '-', name).lower() + ''.join(rest.split())
+
+# The sorted requirements of a requirements.txt file. LLMs sometimes write it
+# as "pip install a b" commands, which are read as a list of packages.
+# Options (-r, --index-url, ...) are dropped.
+def normalize_requirements(text):
+
+    requirements = set()
+
+    for line in text.splitlines():
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith('#'): continue
+
+        if PIP_INSTALL_RE.match(line): items = [item for item in PIP_INSTALL_RE.sub('', line).split() if not item.startswith('-')]
+        elif line.startswith('-'):     items = []
+        else:                          items = [line]
+
+        for item in items:
+            requirement = normalize_requirement(item)
+            if requirement: requirements.add(requirement)
+
+    return sorted(requirements)
+
+def read_project_requirements(app_folder):
+
+    requirements_path = os.path.join(app_folder, 'requirements.txt')
+    if not os.path.exists(requirements_path): return []
+
+    with open(requirements_path, 'r', encoding='utf-8', errors='replace') as f:
+        return normalize_requirements(f.read())
+
+def python_tag():
+
+    return f"{sys.implementation.name}-{sys.version_info.major}.{sys.version_info.minor}-{sys.platform}-{platform.machine()}"
+
+def compute_env_key(requirements, tools):
+
+    data = json.dumps({'python': python_tag(), 'requirements': requirements, 'tools': sorted(tools)})
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+
+def env_python_path(env_folder):
+
+    if os.name == 'nt': return os.path.join(env_folder, 'Scripts', 'python.exe')
+    return os.path.join(env_folder, 'bin', 'python')
+
+###############################################################################
+# Environment info (env.json)
+###############################################################################
+
+def read_env_info(env_folder):
+
+    try:
+        with open(os.path.join(env_folder, ENV_INFO_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_env_info(env_folder, info):
+
+    # A unique temp name, as processes reusing the environment may update it at once
+    info_path = os.path.join(env_folder, ENV_INFO_FILE)
+    descriptor, temp_path = tempfile.mkstemp(dir=env_folder, prefix=ENV_INFO_FILE + '.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f: json.dump(info, f, indent=1)
+        os.replace(temp_path, info_path)
+    except BaseException:
+        remove_file(temp_path)
+        raise
+
+def folder_size(folder):
+
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+def remove_file(path):
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+###############################################################################
+# Locks. A lock is held on a file for the enclosed block, waiting up to
+# timeout seconds for it (None waits as long as it takes, 0 tries once). The
+# block is told whether the lock was taken.
+###############################################################################
+@contextlib.contextmanager
+def hold_lock(lock_path, timeout=None):
+
+    with open(lock_path, 'a+') as f:
+        if timeout is None:
+            lock_file(f, blocking=True)
+        else:
+            deadline = time.time() + timeout
+            while not lock_file(f, blocking=False):
+                if time.time() >= deadline:
+                    yield False
+                    return
+                time.sleep(LOCK_WAIT)
+
+        try:
+            yield True
+        finally:
+            unlock_file(f)
+
+# Marks an environment as in use for the enclosed block, so eviction leaves it
+# alone: the block holds the lock on its own file in envs/<key>.users/
+@contextlib.contextmanager
+def env_in_use(envs_folder, key):
+
+    users_folder = os.path.join(envs_folder, key + USERS_SUFFIX)
+
+    with hold_lock(os.path.join(envs_folder, EVICT_LOCK_FILE)):
+        os.makedirs(users_folder, exist_ok=True)
+        descriptor, user_path = tempfile.mkstemp(dir=users_folder, prefix=f'{os.getpid()}_')
+        f = os.fdopen(descriptor, 'a+')
+        lock_file(f, blocking=True)
+
+    try:
+        yield
+    finally:
+        unlock_file(f)
+        f.close()
+        remove_file(user_path)
+
+# Whether any process is using the environment. Files left by a process that
+# died are no longer locked, and are removed.
+def env_has_users(envs_folder, name):
+
+    users_folder = os.path.join(envs_folder, name + USERS_SUFFIX)
+    if not os.path.isdir(users_folder): return False
+
+    in_use = False
+    for user in os.listdir(users_folder):
+        user_path = os.path.join(users_folder, user)
+        with hold_lock(user_path, timeout=0) as locked:
+            if not locked:
+                in_use = True
+                continue
+        remove_file(user_path)
+
+    return in_use
+
+###############################################################################
+# Building an environment
+###############################################################################
+
+def run_pip(python_path, arguments):
+
+    subprocess.run([python_path, '-m', 'pip', '--disable-pip-version-check', '--no-input'] + arguments,
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+# Installs the packages from the wheelhouse, first filling it with whatever is
+# missing unless offline
+def install_packages(env_folder, packages, wheelhouse, offline):
+
+    python_path       = env_python_path(env_folder)
+    requirements_path = os.path.join(env_folder, 'requirements.txt')
+    with open(requirements_path, 'w', encoding='utf-8') as f: f.write('\n'.join(packages) + '\n')
+
+    install = ['install', '--no-index', '--find-links', wheelhouse, '-r', requirements_path]
+
+    try:
+        run_pip(python_path, install)
+        return
+    except subprocess.CalledProcessError as e:
+        if offline: raise
+        logger.info(f"Wheelhouse lacks some packages, downloading them: {e.stderr.strip()[-200:]}")
+
+    run_pip(python_path, ['wheel', '--wheel-dir', wheelhouse, '--find-links', wheelhouse, '-r', requirements_path])
+    run_pip(python_path, install)
+
+def build_env(env_folder, key, requirements, tools, settings):
+
+    if os.path.exists(env_folder): shutil.rmtree(env_folder, ignore_errors=True)
+
+    start_time = time.perf_counter()
+    print(f"Creating a Python environment for {len(requirements)} requirements (cache key {key})...")
+
+    wheelhouse = os.path.join(settings['folder'], WHEELHOUSE_FOLDER)
+    os.makedirs(wheelhouse, exist_ok=True)
+
+    subprocess.run([sys.executable, '-m', 'venv', env_folder], check=True, stdout=subprocess.DEVNULL)
+    install_packages(env_folder, requirements + tools, wheelhouse, settings['offline'])
+
+    now = datetime.now().isoformat(timespec='seconds')
+    write_env_info(env_folder, {'key': key, 'python': python_tag(), 'requirements': requirements, 'tools': tools,
+                                'created': now, 'last_used': now, 'size': folder_size(env_folder)})
+
+    print(f"Environment ready in {time.perf_counter() - start_time:.1f} seconds.")
+
+###############################################################################
+# Yields the Python of a ready environment for the project's requirements,
+# building it if needed, and keeps the environment marked in use until the
+# block ends (eg the whole packaging build). Yields None if the cache is off
+# or the environment can't be built (the caller then uses the tools installed
+# on this machine).
+###############################################################################
+@contextlib.contextmanager
+def project_python(app_folder, settings=None):
+
+    settings = settings or get_env_cache_settings()
+    if not settings['enabled']:
+        yield None
+        return
+
+    requirements = read_project_requirements(app_folder)
+    key          = compute_env_key(requirements, settings['tools'])
+    envs_folder  = os.path.join(settings['folder'], ENVS_FOLDER)
+    env_folder   = os.path.join(envs_folder, key)
+    os.makedirs(envs_folder, exist_ok=True)
+
+    with env_in_use(envs_folder, key):
+        yield prepare_env(env_folder, key, requirements, settings)
+
+def prepare_env(env_folder, key, requirements, settings):
+
+    info = read_env_info(env_folder)
+
+    if info is None:
+        with hold_lock(env_folder + '.lock', LOCK_TIMEOUT) as locked:
+            if not locked:
+                logger.error(f"Timed out waiting for another process to build environment {key}.")
+                return None
+
+            try:
+                # Another process may have built it while we waited
+                info = read_env_info(env_folder)
+                if info is None:
+                    build_env(env_folder, key, requirements, settings['tools'], settings)
+                    info = read_env_info(env_folder)
+            except (subprocess.CalledProcessError, OSError) as e:
+                details = getattr(e, 'stderr', '') or ''
+                print(f"Could not create the project environment: {e} {details.strip()[-500:]}")
+                shutil.rmtree(env_folder, ignore_errors=True)
+                return None
+    else:
+        logger.info(f"Reusing environment {key}.")
+
+    info['last_used'] = datetime.now().isoformat(timespec='seconds')
+    try:
+        write_env_info(env_folder, info)
+    except OSError as e:
+        logger.warning(f"Could not record the use of environment {key}: {e}")
+
+    evict_envs(settings, keep=key)
+
+    return env_python_path(env_folder)
+
+###############################################################################
+# LRU eviction. Environments are removed in order of last use, skipping the
+# one just used and any in use by a build (including one being created); if
+# the wheelhouse alone is over the limit, its oldest wheels go next.
+###############################################################################
+def evict_envs(settings, keep=None):
+
+    envs_folder = os.path.join(settings['folder'], ENVS_FOLDER)
+
+    with hold_lock(os.path.join(envs_folder, EVICT_LOCK_FILE)):
+        evict_unused_envs(settings, envs_folder, keep)
+
+def evict_unused_envs(settings, envs_folder, keep):
+
+    limit      = settings['max_size_mb'] * 1024 * 1024
+    wheelhouse = os.path.join(settings['folder'], WHEELHOUSE_FOLDER)
+
+    envs = []
+    for name in os.listdir(envs_folder):
+        env_folder = os.path.join(envs_folder, name)
+        if not os.path.isdir(env_folder): continue
+        info = read_env_info(env_folder)
+        if info: envs.append((info['last_used'], name, info['size']))
+
+    wheels = []
+    if os.path.isdir(wheelhouse):
+        for name in os.listdir(wheelhouse):
+            path = os.path.join(wheelhouse, name)
+            wheels.append((os.path.getmtime(path), path, os.path.getsize(path)))
+
+    total = sum(size for _, _, size in envs) + sum(size for _, _, size in wheels)
+
+    for last_used, name, size in sorted(envs):
+        if total <= limit: return
+        if name == keep or env_has_users(envs_folder, name): continue
+
+        logger.info(f"Removing environment {name} (last used {last_used}) to keep the cache under {settings['max_size_mb']:.0f} MB.")
+        shutil.rmtree(os.path.join(envs_folder, name), ignore_errors=True)
+        shutil.rmtree(os.path.join(envs_folder, name + USERS_SUFFIX), ignore_errors=True)
+        remove_file(os.path.join(envs_folder, name + '.lock'))
+        total -= size
+
+    for mtime, path, size in sorted(wheels):
+        if total <= limit: return
+        os.remove(path)
+        total -= size
@@ -0,0 +1,472 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module handles packaging the generated project into executables.
+# Each packaging target (PyInstaller onefile/onedir, zipapp, shiv, Nuitka) has
+# its own folder in a build cache next to the project files. A target is
+# skipped when the source files and requirements.txt have not changed since
+# its last successful build. Independent targets build in parallel processes.
+# With [EnvCache] enabled, PyInstaller runs inside a cached virtual environment
+# with the project's requirements installed (see env_cache.py).
+###############################################################################
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import zipapp
+import tempfile
+import contextlib
+import subprocess
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+from env_cache import get_env_cache_settings, project_python
+from workspace import lock_file, unlock_file
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+BUILD_CACHE_FOLDER  = 'build_cache'
+BUILD_HASH_FILE     = 'build_hash.txt'
+BUILD_LOCK_FILE     = 'build.lock'
+BUILD_LOG_FILE      = 'build.log'
+SOURCES_FOLDER      = 'sources'
+PACKAGE_REPORT_FILE = 'package_report.txt'
+
+DEFAULT_TARGETS     = ['pyinstaller_onefile']
+STARTUP_TIMEOUT     = 10  # Seconds to wait for an artifact during startup measurement
+
+###############################################################################
+# The build cache lives beside the 'files' folder (projects/<name>/build_cache),
+# so build output never ends up in the code bundle shown to the LLMs.
+###############################################################################
+def get_build_cache_folder(app_folder):
+
+    project_folder = os.path.dirname(os.path.normpath(app_folder))
+    cache_folder   = os.path.join(project_folder, BUILD_CACHE_FOLDER)
+    os.makedirs(cache_folder, exist_ok=True)
+
+    return cache_folder
+
+# Only Windows executables carry the .exe suffix
+def get_executable_name(main_file):
+
+    base_name = os.path.splitext(os.path.basename(main_file))[0]
+    if os.name == 'nt': return base_name + '.exe'
+    return base_name
+
+# Copying the project for a build leaves out backups, build output and the
+# executable copied into the project by an earlier build (no suffix on Linux)
+def ignore_build_output(main_file):
+
+    return shutil.ignore_patterns('code_history', '__pycache__', 'build', 'dist', '*.exe', get_executable_name(main_file))
+
+###############################################################################
+# Hash everything that affects the artifact: the name of the main script and
+# the files the target packages. PyInstaller and Nuitka bundle the Python
+# sources and the packages in requirements.txt; zipapp and shiv package every
+# file that stage_python_sources copies (all_files), data files included.
+###############################################################################
+def compute_source_hash(app_folder, main_file, all_files=False):
+
+    hasher = hashlib.sha256()
+    hasher.update(main_file.encode('utf-8'))
+
+    # Backups and build output are not part of the source
+    ignore = ignore_build_output(main_file)
+
+    for root, dirs, files in os.walk(app_folder):
+
+        ignored = ignore(root, dirs + files)
+        dirs[:] = sorted(d for d in dirs if d not in ignored)
+
+        for file in sorted(files):
+            if file in ignored: continue
+            if all_files or file.endswith('.py') or file == 'requirements.txt':
+                file_path = os.path.join(root, file)
+                hasher.update(os.path.relpath(file_path, app_folder).encode('utf-8'))
+                with open(file_path, 'rb') as f:
+                    hasher.update(f.read())
+
+    return hasher.hexdigest()
+
+def read_build_hash(target_folder):
+
+    hash_path = os.path.join(target_folder, BUILD_HASH_FILE)
+    if not os.path.exists(hash_path): return ''
+
+    with open(hash_path, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+def write_build_hash(target_folder, source_hash):
+
+    with open(os.path.join(target_folder, BUILD_HASH_FILE), 'w', encoding='utf-8') as f:
+        f.write(source_hash)
+
+###############################################################################
+# The process running a build holds an OS lock on build.lock in the build
+# cache (as workspace.py does for the project), so a second run does not start
+# a competing build in the same cache. The OS releases the lock if the build
+# dies, so there is no stale lock to clean up.
+###############################################################################
+@contextlib.contextmanager
+def hold_build_lock(cache_folder):
+
+    with open(os.path.join(cache_folder, BUILD_LOCK_FILE), 'a+') as f:
+        if not lock_file(f, blocking=False):
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            unlock_file(f)
+
+def build_in_progress(cache_folder):
+
+    with hold_build_lock(cache_folder) as locked:
+        return not locked
+
+###############################################################################
+# Packaging targets. Each builder takes the project folder, the main script,
+# the target's own folder in the build cache and the Python of the project's
+# cached environment (None without one), and returns the artifact path.
+###############################################################################
+
+# PyInstaller, as a single self-extracting file or as a folder. Onedir starts
+# faster because nothing is unpacked to a temp folder on each launch. We don't
+# pass --clean, so PyInstaller reuses its analysis from earlier builds. In the
+# project's environment, it sees exactly the packages of requirements.txt.
+def build_pyinstaller(app_folder, main_file, target_folder, python_path=None, onefile=True):
+
+    dist_path = os.path.join(target_folder, 'dist')
+    mode      = '--onefile' if onefile else '--onedir'
+    command   = [python_path, '-m', 'PyInstaller'] if python_path else ['pyinstaller']
+
+    subprocess.run(command + [mode, '--console', '--noconfirm',
+                    '--workpath', os.path.join(target_folder, 'build'),
+                    '--distpath', dist_path,
+                    '--specpath', target_folder,
+                    os.path.abspath(os.path.join(app_folder, main_file))],
+                   cwd=app_folder, check=True, stdout=subprocess.DEVNULL)
+
+    exe_name = get_executable_name(main_file)
+    if onefile: return os.path.join(dist_path, exe_name)
+
+    return os.path.join(dist_path, os.path.splitext(exe_name)[0], exe_name)
+
+def build_pyinstaller_onefile(app_folder, main_file, target_folder, python_path=None):
+    return build_pyinstaller(app_folder, main_file, target_folder, python_path, onefile=True)
+
+def build_pyinstaller_onedir(app_folder, main_file, target_folder, python_path=None):
+    return build_pyinstaller(app_folder, main_file, target_folder, python_path, onefile=False)
+
+# zipapp and shiv need an importable entry point, so we stage a copy of the
+# sources with a small module that runs the main script as __main__. Every
+# file is copied, so these targets are hashed with all_files.
+def stage_python_sources(app_folder, main_file, target_folder):
+
+    staging_folder = os.path.join(target_folder, 'staging')
+    if os.path.exists(staging_folder): shutil.rmtree(staging_folder)
+
+    shutil.copytree(app_folder, staging_folder, ignore=ignore_build_output(main_file))
+
+    main_module = os.path.splitext(main_file)[0].replace(os.sep, '.')
+    with open(os.path.join(staging_folder, '_firebird_entry.py'), 'w', encoding='utf-8') as f:
+        f.write("import runpy\n\n")
+        f.write("def run():\n")
+        f.write(f"    runpy.run_module('{main_module}', run_name='__main__', alter_sys=True)\n")
+
+    return staging_folder
+
+# Standard library zipapp. Third-party requirements are not bundled.
+def build_zipapp(app_folder, main_file, target_folder, python_path=None):
+
+    staging_folder = stage_python_sources(app_folder, main_file, target_folder)
+    artifact_path  = os.path.join(target_folder, os.path.splitext(os.path.basename(main_file))[0] + '.pyz')
+
+    zipapp.create_archive(staging_folder, artifact_path,
+                          interpreter='/usr/bin/env python3', main='_firebird_entry:run')
+
+    return artifact_path
+
+# shiv builds a zipapp that also carries the packages from requirements.txt
+def build_shiv(app_folder, main_file, target_folder, python_path=None):
+
+    staging_folder = stage_python_sources(app_folder, main_file, target_folder)
+    artifact_path  = os.path.join(target_folder, os.path.splitext(os.path.basename(main_file))[0] + '.shiv.pyz')
+
+    command = ['shiv', '--site-packages', staging_folder, '-e', '_firebird_entry:run', '-o', artifact_path]
+
+    requirements_path = os.path.join(app_folder, 'requirements.txt')
+    if os.path.exists(requirements_path): command += ['-r', requirements_path]
+
+    subprocess.run(command, cwd=target_folder, check=True, stdout=subprocess.DEVNULL)
+
+    return artifact_path
+
+# Nuitka compiles to C, so builds are slow but the artifact starts quickly
+def build_nuitka(app_folder, main_file, target_folder, python_path=None):
+
+    dist_path = os.path.join(target_folder, 'dist')
+    exe_name  = get_executable_name(main_file)
+
+    subprocess.run([sys.executable, '-m', 'nuitka', '--onefile', '--assume-yes-for-downloads',
+                    f'--output-dir={dist_path}', f'--output-filename={exe_name}',
+                    os.path.abspath(os.path.join(app_folder, main_file))],
+                   cwd=app_folder, check=True, stdout=subprocess.DEVNULL)
+
+    return os.path.join(dist_path, exe_name)
+
+PYINSTALLER_TARGETS = ('pyinstaller_onefile', 'pyinstaller_onedir')
+STAGED_TARGETS      = ('zipapp', 'shiv')  # Built from stage_python_sources
+
+PACKAGING_TARGETS = {
+    'pyinstaller_onefile': build_pyinstaller_onefile,
+    'pyinstaller_onedir':  build_pyinstaller_onedir,
+    'zipapp':              build_zipapp,
+    'shiv':                build_shiv,
+    'nuitka':              build_nuitka,
+}
+
+# Checks the tool behind a packaging target is installed. The environment
+# cache installs PyInstaller itself when it is one of the cache's tools.
+def target_available(target, env_settings=None):
+
+    if target in PYINSTALLER_TARGETS:
+        if env_settings and env_settings['enabled'] and 'pyinstaller' in env_settings['tools']: return True
+        return shutil.which('pyinstaller') is not None
+    if target == 'shiv':   return shutil.which('shiv') is not None
+    if target == 'nuitka': return importlib.util.find_spec('nuitka') is not None
+
+    return target in PACKAGING_TARGETS
+
+###############################################################################
+# Builds one target. This runs in a worker process, so it returns a plain dict
+# describing the outcome rather than raising.
+###############################################################################
+def build_target(target, app_folder, main_file, cache_folder, source_hash, python_path=None):
+
+    target_folder = os.path.join(cache_folder, target)
+    os.makedirs(target_folder, exist_ok=True)
+
+    result = {'target': target, 'status': 'failed', 'artifact': '', 'build_seconds': 0.0}
+
+    artifact_path_file = os.path.join(target_folder, 'artifact.txt')
+    if source_hash == read_build_hash(target_folder) and os.path.exists(artifact_path_file):
+        with open(artifact_path_file, 'r', encoding='utf-8') as f:
+            artifact_path = f.read().strip()
+        if os.path.exists(artifact_path):
+            result.update(status='cached', artifact=artifact_path)
+            return result
+
+    start_time = time.perf_counter()
+
+    try:
+        artifact_path = PACKAGING_TARGETS[target](app_folder, main_file, target_folder, python_path)
+
+        with open(artifact_path_file, 'w', encoding='utf-8') as f: f.write(artifact_path)
+        write_build_hash(target_folder, source_hash)
+
+        result.update(status='built', artifact=artifact_path)
+
+    except subprocess.CalledProcessError as e:
+        result['error'] = f"Error compiling to executable: {e}"
+    except FileNotFoundError as e:
+        result['error'] = f"Packaging tool not found: {e}"
+    except Exception as e:
+        result['error'] = f"An error occurred during packaging: {e}"
+
+    result['build_seconds'] = time.perf_counter() - start_time
+
+    return result
+
+###############################################################################
+# Measurements for the package report. Startup is timed by launching the
+# artifact with no input and waiting for it to exit (or time out), so it is
+# only meaningful for programs that run to completion without interaction.
+###############################################################################
+def get_artifact_size(artifact_path):
+
+    # For onedir builds, the whole folder ships with the executable
+    if os.path.basename(os.path.dirname(artifact_path)) == os.path.splitext(os.path.basename(artifact_path))[0]:
+        folder = os.path.dirname(artifact_path)
+        total  = 0
+        for root, dirs, files in os.walk(folder):
+            for file in files: total += os.path.getsize(os.path.join(root, file))
+        return total
+
+    return os.path.getsize(artifact_path)
+
+def measure_startup_time(artifact_path):
+
+    command = [artifact_path]
+    if artifact_path.endswith('.pyz'): command = [sys.executable, artifact_path]
+
+    start_time = time.perf_counter()
+    try:
+        subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, timeout=STARTUP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return None
+
+    return time.perf_counter() - start_time
+
+def write_package_report(cache_folder, results):
+
+    lines = [f"{'Target':<22}{'Status':<9}{'Build (s)':>10}{'Startup (s)':>13}{'Size (MB)':>11}  Artifact"]
+
+    for result in results:
+        startup = result.get('startup_seconds')
+        startup = f"{startup:.2f}" if startup is not None else '-'
+        size    = f"{result['size'] / (1024 * 1024):.1f}" if 'size' in result else '-'
+        lines.append(f"{result['target']:<22}{result['status']:<9}{result['build_seconds']:>10.1f}"
+                     f"{startup:>13}{size:>11}  {result['artifact'] or result.get('error', '')}")
+
+    report = '\n'.join(lines)
+
+    with open(os.path.join(cache_folder, PACKAGE_REPORT_FILE), 'w', encoding='utf-8') as f:
+        f.write(report + '\n')
+
+    return report
+
+###############################################################################
+# This handles the compile to an executable. If background is set, the build is
+# handed to a detached process and this function returns straight away.
+###############################################################################
+def compile_to_exe(app_folder, main_file, background=False, targets=None, measure_startup=False):
+
+    cache_folder = get_build_cache_folder(app_folder)
+    targets      = targets or DEFAULT_TARGETS
+
+    if background:
+        if build_in_progress(cache_folder):
+            print("A build is already running for this project. Skipping compilation.")
+            return
+
+        start_background_build(app_folder, main_file, cache_folder, targets, measure_startup)
+        return
+
+    with hold_build_lock(cache_folder) as locked:
+        if not locked:
+            print("A build is already running for this project. Skipping compilation.")
+            return
+
+        return run_package_build(app_folder, main_file, cache_folder, targets, measure_startup)
+
+###############################################################################
+# Builds every requested target in parallel, then measures the artifacts one
+# at a time so that startup figures are not skewed by concurrent builds.
+# The targets are built from source_folder (a copy of the project, for a
+# background build) if given, else from the project itself.
+###############################################################################
+def run_package_build(app_folder, main_file, cache_folder, targets, measure_startup=False, source_folder=None):
+
+    source_folder = source_folder or app_folder
+    env_settings  = get_env_cache_settings()
+
+    buildable = []
+    for target in targets:
+        if target not in PACKAGING_TARGETS:
+            print(f"Unknown packaging target '{target}'. Available targets: {', '.join(PACKAGING_TARGETS)}")
+        elif not target_available(target, env_settings):
+            print(f"Packaging tool for '{target}' is not installed. Skipping.")
+        else:
+            buildable.append(target)
+
+    if not buildable: return []
+
+    # Each target is hashed over the files it packages
+    source_hashes = {all_files: compute_source_hash(source_folder, main_file, all_files)
+                     for all_files in {target in STAGED_TARGETS for target in buildable}}
+
+    # PyInstaller targets run in the project's cached environment, which stays
+    # marked in use until the builds finish. If it can't be built, they fall
+    # back to the PyInstaller on this machine.
+    with contextlib.ExitStack() as stack:
+        python_path = None
+        if env_settings['enabled'] and any(target in PYINSTALLER_TARGETS for target in buildable):
+            python_path = stack.enter_context(project_python(source_folder, env_settings))
+            if python_path is None and not shutil.which('pyinstaller'):
+                print("PyInstaller is not installed and the project environment could not be built. Skipping PyInstaller targets.")
+                buildable = [target for target in buildable if target not in PYINSTALLER_TARGETS]
+                if not buildable: return []
+
+        with ProcessPoolExecutor(max_workers=len(buildable)) as executor:
+            futures = [executor.submit(build_target, target, source_folder, main_file, cache_folder, source_hashes[target in STAGED_TARGETS],
+                                       python_path if target in PYINSTALLER_TARGETS else None)
+                       for target in buildable]
+            results = [future.result() for future in futures]
+
+    for result in results:
+
+        if result['status'] == 'failed':
+            print(f"{result['target']}: {result['error']}")
+            continue
+
+        print(f"{result['target']}: {result['status']} {result['artifact']}")
+        result['size'] = get_artifact_size(result['artifact'])
+        if measure_startup: result['startup_seconds'] = measure_startup_time(result['artifact'])
+
+        # The single-file executable is also placed in the project folder, as before
+        if result['target'] == 'pyinstaller_onefile':
+            project_path = os.path.join(app_folder, get_executable_name(main_file))
+            shutil.copy2(result['artifact'], project_path)
+            print(f"Copied executable to {project_path}")
+
+    print(write_package_report(cache_folder, results))
+
+    return results
+
+###############################################################################
+# Starts the build in a detached process, with its output going to build.log in
+# the build cache. The sources are first copied into the build cache, so the
+# next iteration can change the project while the build runs: the artifact and
+# its stored source hash describe the same files. The child holds the build
+# lock while it builds; if another build took the lock first, the child exits
+# without building.
+###############################################################################
+def start_background_build(app_folder, main_file, cache_folder, targets, measure_startup=False):
+
+    log_path        = os.path.join(cache_folder, BUILD_LOG_FILE)
+    snapshot_folder = tempfile.mkdtemp(dir=cache_folder, prefix='snapshot_')
+    shutil.copytree(app_folder, snapshot_folder, ignore=ignore_build_output(main_file), dirs_exist_ok=True)
+
+    with open(log_path, 'a', encoding='utf-8') as log_file:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), app_folder, main_file,
+                                    ','.join(targets), 'yes' if measure_startup else 'no', snapshot_folder],
+                                   stdout=log_file, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL, start_new_session=True)
+
+    print(f"Started background build (PID {process.pid}). Output is logged to {log_path}")
+
+def run_background_build(app_folder, main_file, targets, measure_startup, snapshot_folder):
+
+    cache_folder = get_build_cache_folder(app_folder)
+
+    with hold_build_lock(cache_folder) as locked:
+        if not locked:
+            print("Another build is already running for this project. Skipping this one.")
+            shutil.rmtree(snapshot_folder, ignore_errors=True)
+            return
+
+        # The snapshot moves to a fixed path, so PyInstaller reuses its analysis from earlier builds
+        source_folder = os.path.join(cache_folder, SOURCES_FOLDER)
+        if os.path.exists(source_folder): shutil.rmtree(source_folder)
+        os.replace(snapshot_folder, source_folder)
+
+        run_package_build(app_folder, main_file, cache_folder, targets, measure_startup, source_folder)
+
+
+if __name__ == "__main__":
+
+    # Entry point for background builds: exe_builder.py <app_folder> <main_file> <targets> <yes|no> <snapshot_folder>
+    run_background_build(sys.argv[1], sys.argv[2], sys.argv[3].split(','), sys.argv[4] == 'yes', sys.argv[5])
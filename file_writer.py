@@ -0,0 +1,139 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module writes the files extracted from an LLM response into the project
+# folder. Files whose content is unchanged are not touched. Changed files are
+# written to a temp file and moved into place with os.replace, so an
+# interrupted run never leaves a half-written file. Large outputs are written
+# from a thread pool. The caller gets back a change set listing which files
+# were added, modified or left unchanged.
+###############################################################################
+
+import os
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from profiler import profiled
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+PARALLEL_MIN_FILES = 8  # Below this, files are written one by one
+MAX_WRITE_WORKERS  = 8
+
+# Mode for new files, as plain open() would create them under the umask. The
+# umask can only be read by setting it, which affects every thread, so it is
+# read once here, at import, rather than for each write.
+def read_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+NEW_FILE_MODE = 0o666 & ~read_umask()
+
+def new_change_set():
+    return {'added': [], 'modified': [], 'unchanged': []}
+
+# Adds the entries of one change set to another. A file added earlier in the
+# run stays 'added' if a later phase modifies it again.
+def merge_change_sets(change_set, other):
+
+    for kind in ('added', 'modified'):
+        for filename in other[kind]:
+            if filename in change_set['added'] or filename in change_set['modified']: continue
+            change_set[kind].append(filename)
+            if filename in change_set['unchanged']: change_set['unchanged'].remove(filename)
+
+    for filename in other['unchanged']:
+        if filename not in change_set['added'] + change_set['modified'] + change_set['unchanged']:
+            change_set['unchanged'].append(filename)
+
+    return change_set
+
+# Files the change set says were written (added or modified)
+def changed_files(change_set):
+    return change_set['added'] + change_set['modified']
+
+def file_hash(file_path):
+
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+###############################################################################
+# Writes one file, unless it already has this content. Returns 'added',
+# 'modified' or 'unchanged'. The file is written in text mode, so with the
+# default newline=None each '\n' becomes os.linesep (CRLF on Windows), the
+# same as a plain open(file_path, 'w'). Pass newline='' to write the content
+# as is. The unchanged check compares against the bytes text mode would write.
+###############################################################################
+def write_file_if_changed(file_path, content, new_file_mode, newline=None):
+
+    line_end = os.linesep if newline is None else (newline or '\n')
+    data = (content.replace('\n', line_end) if line_end != '\n' else content).encode('utf-8')
+
+    exists = os.path.exists(file_path)
+    if exists and os.path.getsize(file_path) == len(data) and file_hash(file_path) == hashlib.sha256(data).hexdigest():
+        return 'unchanged'
+
+    folder = os.path.dirname(file_path)
+    os.makedirs(folder, exist_ok=True)
+
+    # Write to a temp file in the same folder, so os.replace is an atomic rename
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline=newline) as f:
+            f.write(content)
+
+        # mkstemp creates the file as 0600; keep the mode of the file being replaced
+        os.chmod(temp_path, os.stat(file_path).st_mode & 0o7777 if exists else new_file_mode)
+
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        raise
+
+    return 'modified' if exists else 'added'
+
+###############################################################################
+# Writes a set of extracted files ({filename: content}) into the project folder
+# and returns the change set. Filenames that would land outside the project
+# folder are skipped.
+###############################################################################
+@profiled()
+def write_extracted_files(app_folder, blocks):
+
+    change_set = new_change_set()
+
+    app_root = os.path.realpath(app_folder)
+
+    targets = []
+    for filename, content in blocks.items():
+        file_path = os.path.realpath(os.path.join(app_folder, filename))
+        if os.path.commonpath([app_root, file_path]) != app_root:
+            logger.warning(f"Skipping {filename}: path is outside the project folder.")
+            continue
+        targets.append((os.path.relpath(file_path, app_root), file_path, content))
+
+    if len(targets) >= PARALLEL_MIN_FILES:
+        with ThreadPoolExecutor(max_workers=MAX_WRITE_WORKERS) as executor:
+            results = list(executor.map(lambda target: write_file_if_changed(target[1], target[2], NEW_FILE_MODE), targets))
+    else:
+        results = [write_file_if_changed(file_path, content, NEW_FILE_MODE) for _, file_path, content in targets]
+
+    for (relative_path, file_path, content), result in zip(targets, results):
+        change_set[result].append(relative_path)
+        if result == 'unchanged': print(f"Unchanged: {file_path}")
+        else:                     print(f"Saved file to {file_path}")
+
+    return change_set
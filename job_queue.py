@@ -0,0 +1,366 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module is the job queue shared by a coordinator (main.py or daemon.py)
+# and its workers (worker.py). A job is one LLM call ('llm_call') or one whole
+# task of a project ('task'). Workers lease a job for lease_seconds, renew the
+# lease with heartbeats while they work, and report the result. A job whose
+# lease runs out (its worker died) is queued again, up to max_attempts.
+#
+# The queue also keeps the request rate of each provider, so rate limits hold
+# across all the processes and machines that share it.
+#
+# Backends, set in the [JobQueue] section of config.txt (imported when used):
+#   sqlite  a SQLite file, for workers on one host
+#   redis   a Redis server (or anything that speaks its protocol), for
+#           workers on several hosts. Needs the redis package.
+###############################################################################
+
+import os
+import json
+import time
+import uuid
+import threading
+import configparser
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+JOB_KINDS   = ('llm_call', 'task')
+RATE_WINDOW = 60   # Seconds; rate limits are requests per minute
+
+# Backend opened by this process, and the settings it was opened with
+open_queue      = None
+open_queue_key  = None
+open_queue_lock = threading.Lock()
+
+def get_job_queue_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['JobQueue'] if 'JobQueue' in config else {}
+
+    settings = {}
+    settings['backend']           = section.get('backend', 'none').strip().lower()
+    settings['sqlite_path']       = section.get('sqlite_path', 'job_queue.sqlite').strip()
+    settings['redis_url']         = section.get('redis_url', 'redis://127.0.0.1:6379/0').strip()
+    settings['llm_calls']         = section.get('llm_calls', 'local').strip().lower()
+    settings['tasks']             = section.get('tasks', 'local').strip().lower()
+    settings['remote_tasks']      = int(section.get('remote_tasks', '4'))
+    settings['worker_threads']    = int(section.get('worker_threads', '4'))
+    settings['lease_seconds']     = float(section.get('lease_seconds', '60'))
+    settings['max_attempts']      = int(section.get('max_attempts', '3'))
+    settings['poll_interval']     = float(section.get('poll_interval', '0.5'))
+    settings['rate_limits']       = {llm_name: int(section.get(f'rate_limit_{llm_name}') or 0)
+                                     for llm_name in ('openai', 'gemini', 'anthropic', 'perplexity', 'groq')}
+
+    return settings
+
+# The job queue backend from config.txt, or None if there is none
+def get_job_queue(settings=None):
+
+    global open_queue, open_queue_key
+
+    settings = settings or get_job_queue_settings()
+    if settings['backend'] == 'none': return None
+
+    key = (settings['backend'], settings['sqlite_path'], settings['redis_url'], settings['lease_seconds'], settings['max_attempts'])
+
+    with open_queue_lock:
+        if open_queue_key != key:
+            if settings['backend'] == 'sqlite':
+                open_queue = SQLiteJobQueue(settings['sqlite_path'], settings['lease_seconds'], settings['max_attempts'])
+            elif settings['backend'] == 'redis':
+                open_queue = RedisJobQueue(settings['redis_url'], settings['lease_seconds'], settings['max_attempts'])
+            else:
+                raise ValueError(f"Unknown job queue backend: {settings['backend']}")
+            open_queue_key = key
+
+    return open_queue
+
+# Submits a job and waits for its result. An error on the worker is raised
+# here as a RuntimeError. should_stop() is checked while waiting; an interrupt
+# or an exception from it cancels the job.
+def run_job(queue, kind, payload, poll_interval, should_stop=None):
+
+    job_id = queue.submit(kind, payload)
+    try:
+        while True:
+            if should_stop: should_stop()
+            job = queue.get(job_id)
+            if job['status'] == 'done':   return job['result']
+            if job['status'] == 'failed': raise RuntimeError(f"Job {job_id} ({kind}) failed on {job['worker']}: {job['error']}")
+            time.sleep(poll_interval)
+    except BaseException:
+        queue.cancel(job_id)
+        raise
+
+###############################################################################
+# SQLite backend. Every operation opens its own connection and takes the
+# write lock first (BEGIN IMMEDIATE), so leases can't be handed out twice.
+###############################################################################
+class SQLiteJobQueue:
+
+    def __init__(self, path, lease_seconds, max_attempts):
+        import sqlite3
+
+        self.path          = os.path.abspath(path)
+        self.lease_seconds = lease_seconds
+        self.max_attempts  = max_attempts
+
+        # WAL lets readers (eg a coordinator polling for results) work while a worker writes
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.close()
+
+        with self.connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                      id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL,
+                                      status TEXT NOT NULL, worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0,
+                                      result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)""")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, kind, id)")
+            connection.execute("CREATE TABLE IF NOT EXISTS rate_events (provider TEXT NOT NULL, at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS rate_events_provider ON rate_events (provider, at)")
+
+    def connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return ClosingTransaction(connection)
+
+    def submit(self, kind, payload):
+        now = time.time()
+        with self.connect() as connection:
+            cursor = connection.execute("INSERT INTO jobs (kind, payload, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+                                        (kind, json.dumps(payload), now, now))
+            return cursor.lastrowid
+
+    def requeue_expired(self, connection, now):
+        connection.execute("UPDATE jobs SET status = 'queued', worker = NULL, updated_at = ? "
+                           "WHERE status = 'leased' AND lease_until < ? AND attempts < ?", (now, now, self.max_attempts))
+        connection.execute("UPDATE jobs SET status = 'failed', error = 'Lease expired too many times', updated_at = ? "
+                           "WHERE status = 'leased' AND lease_until < ?", (now, now))
+
+    # Leases the oldest queued job of the given kinds. Returns the job, or None.
+    def lease(self, worker, kinds):
+        now = time.time()
+        with self.connect() as connection:
+            self.requeue_expired(connection, now)
+            row = connection.execute(f"SELECT id FROM jobs WHERE status = 'queued' AND kind IN ({','.join('?' * len(kinds))}) "
+                                     "ORDER BY id LIMIT 1", tuple(kinds)).fetchone()
+            if row is None: return None
+            connection.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                               "WHERE id = ?", (worker, now + self.lease_seconds, now, row['id']))
+            return self.job_from_row(connection.execute("SELECT * FROM jobs WHERE id = ?", (row['id'],)).fetchone())
+
+    # Renews a lease. False if the worker no longer holds it.
+    def heartbeat(self, job_id, worker):
+        now = time.time()
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                        (now + self.lease_seconds, now, job_id, worker))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result):
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = 'done', result = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                        (json.dumps(result), time.time(), job_id, worker))
+            return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error):
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                                        (error, time.time(), job_id, worker))
+            return cursor.rowcount == 1
+
+    # A cancelled job is not leased again; a worker running it finds its lease gone
+    def cancel(self, job_id):
+        with self.connect() as connection:
+            connection.execute("UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE id = ? AND status IN ('queued', 'leased')",
+                               (time.time(), job_id))
+
+    def get(self, job_id):
+        with self.connect() as connection:
+            return self.job_from_row(connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def job_from_row(self, row):
+        if row is None: return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result']  = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    # Takes one request from the provider's rate limit. Returns 0 if it was
+    # taken, otherwise the seconds until one frees up.
+    def acquire_rate(self, provider, limit):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute("DELETE FROM rate_events WHERE at < ?", (now - RATE_WINDOW,))
+            rows = connection.execute("SELECT at FROM rate_events WHERE provider = ? ORDER BY at", (provider,)).fetchall()
+            if len(rows) >= limit: return max(0.05, rows[len(rows) - limit]['at'] + RATE_WINDOW - now)
+            connection.execute("INSERT INTO rate_events (provider, at) VALUES (?, ?)", (provider, now))
+            return 0
+
+# Runs the block as one write transaction on the connection, then closes it
+class ClosingTransaction:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.connection.close()
+
+###############################################################################
+# Redis backend. Each job is a hash; queued job ids wait in one list per kind,
+# and leased ones in a sorted set by lease expiry. Steps that must not be
+# split run as Lua scripts, which Redis runs atomically.
+###############################################################################
+REDIS_PREFIX = 'firebird:'
+
+REDIS_LEASE = """
+local id = redis.call('LPOP', KEYS[1])
+if not id then return false end
+local job = ARGV[4] .. 'job:' .. id
+if redis.call('HGET', job, 'status') ~= 'queued' then return false end
+redis.call('HSET', job, 'status', 'leased', 'worker', ARGV[1], 'lease_until', ARGV[2], 'updated_at', ARGV[3])
+redis.call('HINCRBY', job, 'attempts', 1)
+redis.call('ZADD', KEYS[2], ARGV[2], id)
+return id
+"""
+
+REDIS_REQUEUE_EXPIRED = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, id in ipairs(ids) do
+    local job = ARGV[3] .. 'job:' .. id
+    redis.call('ZREM', KEYS[1], id)
+    if redis.call('HGET', job, 'status') == 'leased' then
+        if tonumber(redis.call('HGET', job, 'attempts')) < tonumber(ARGV[2]) then
+            redis.call('HSET', job, 'status', 'queued', 'worker', '', 'updated_at', ARGV[1])
+            redis.call('RPUSH', ARGV[3] .. 'queue:' .. redis.call('HGET', job, 'kind'), id)
+        else
+            redis.call('HSET', job, 'status', 'failed', 'error', 'Lease expired too many times', 'updated_at', ARGV[1])
+        end
+    end
+end
+return #ids
+"""
+
+# Sets fields of a leased job if the worker still holds it. ARGV: worker, job id,
+# new lease expiry ('' when the job is finished), then field/value pairs.
+REDIS_UPDATE_LEASED = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'leased' or redis.call('HGET', KEYS[1], 'worker') ~= ARGV[1] then return 0 end
+for i = 4, #ARGV, 2 do redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1]) end
+if ARGV[3] == '' then redis.call('ZREM', KEYS[2], ARGV[2]) else redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2]) end
+return 1
+"""
+
+REDIS_CANCEL = """
+local status = redis.call('HGET', KEYS[1], 'status')
+if status ~= 'queued' and status ~= 'leased' then return 0 end
+redis.call('HSET', KEYS[1], 'status', 'cancelled', 'updated_at', ARGV[2])
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 1
+"""
+
+REDIS_ACQUIRE_RATE = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1] - ARGV[2])
+local count = redis.call('ZCARD', KEYS[1])
+if count >= tonumber(ARGV[3]) then
+    local oldest = redis.call('ZRANGE', KEYS[1], count - tonumber(ARGV[3]), count - tonumber(ARGV[3]), 'WITHSCORES')
+    return tostring(oldest[2] + ARGV[2] - ARGV[1])
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[2] * 2)
+return '0'
+"""
+
+class RedisJobQueue:
+
+    def __init__(self, url, lease_seconds, max_attempts):
+        import redis
+
+        self.redis         = redis.Redis.from_url(url, decode_responses=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts  = max_attempts
+
+        self.lease_script           = self.redis.register_script(REDIS_LEASE)
+        self.requeue_expired_script = self.redis.register_script(REDIS_REQUEUE_EXPIRED)
+        self.update_leased_script   = self.redis.register_script(REDIS_UPDATE_LEASED)
+        self.cancel_script          = self.redis.register_script(REDIS_CANCEL)
+        self.acquire_rate_script    = self.redis.register_script(REDIS_ACQUIRE_RATE)
+
+    def job_key(self, job_id):
+        return f"{REDIS_PREFIX}job:{job_id}"
+
+    def submit(self, kind, payload):
+        now = time.time()
+        job_id = self.redis.incr(f"{REDIS_PREFIX}next_job_id")
+        pipeline = self.redis.pipeline()
+        pipeline.hset(self.job_key(job_id), mapping={'id': job_id, 'kind': kind, 'payload': json.dumps(payload), 'status': 'queued',
+                                                     'worker': '', 'attempts': 0, 'created_at': now, 'updated_at': now})
+        pipeline.rpush(f"{REDIS_PREFIX}queue:{kind}", job_id)
+        pipeline.execute()
+        return job_id
+
+    def lease(self, worker, kinds):
+        now = time.time()
+        self.requeue_expired_script(keys=[f"{REDIS_PREFIX}leases"], args=[now, self.max_attempts, REDIS_PREFIX])
+
+        for kind in kinds:
+            # Ids of cancelled jobs are skipped; keep popping until a queued one or none is left
+            while self.redis.llen(f"{REDIS_PREFIX}queue:{kind}"):
+                job_id = self.lease_script(keys=[f"{REDIS_PREFIX}queue:{kind}", f"{REDIS_PREFIX}leases"],
+                                           args=[worker, now + self.lease_seconds, now, REDIS_PREFIX])
+                if job_id: return self.get(job_id)
+
+        return None
+
+    def update_leased(self, job_id, worker, lease_until, fields):
+        args = [worker, job_id, lease_until]
+        for field, value in fields.items(): args += [field, value]
+        return self.update_leased_script(keys=[self.job_key(job_id), f"{REDIS_PREFIX}leases"], args=args) == 1
+
+    def heartbeat(self, job_id, worker):
+        now = time.time()
+        return self.update_leased(job_id, worker, now + self.lease_seconds, {'lease_until': now + self.lease_seconds, 'updated_at': now})
+
+    def complete(self, job_id, worker, result):
+        return self.update_leased(job_id, worker, '', {'status': 'done', 'result': json.dumps(result), 'updated_at': time.time()})
+
+    def fail(self, job_id, worker, error):
+        return self.update_leased(job_id, worker, '', {'status': 'failed', 'error': error, 'updated_at': time.time()})
+
+    def cancel(self, job_id):
+        self.cancel_script(keys=[self.job_key(job_id), f"{REDIS_PREFIX}leases"], args=[job_id, time.time()])
+
+    def get(self, job_id):
+        job = self.redis.hgetall(self.job_key(job_id))
+        if not job: return None
+
+        job['id']       = int(job['id'])
+        job['attempts'] = int(job.get('attempts', 0))
+        job['worker']   = job.get('worker') or None
+        job['payload']  = json.loads(job['payload'])
+        job['result']   = json.loads(job['result']) if job.get('result') else None
+        job['error']    = job.get('error')
+        return job
+
+    def acquire_rate(self, provider, limit):
+        wait = float(self.acquire_rate_script(keys=[f"{REDIS_PREFIX}rate:{provider}"],
+                                              args=[time.time(), RATE_WINDOW, limit, uuid.uuid4().hex]))
+        return max(0.05, wait) if wait > 0 else 0
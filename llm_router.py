@@ -0,0 +1,343 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module decides which LLMs sit on the panel of experts and which model
+# each of them uses for each step. Providers are ranked from our own call
+# history (latency, error rate, vote wins), with the preferred LLM from
+# config.txt always on the panel. Reflections and voting can use cheap, fast
+# models (drafts too, if fast_drafts is set), while the final generation uses
+# the stronger model from [Models]. Spending for the run is tracked against a budget of time, cost,
+# calls and tokens, for the whole run and for each phase; a request that would
+# go over it is made with fewer reflections or a smaller panel.
+###############################################################################
+
+import time
+import threading
+import configparser
+
+from provider_stats import get_provider_summary
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4  # Rough estimate, good enough for budgeting
+
+# Steps that may use the fast model: reflections and votes of multi_llm_request, and
+# project summaries. Drafts join them when [Routing] fast_drafts is set.
+FAST_ROLES = ('reflection', 'vote', 'summary')
+
+# Budget limits counted in calls and estimated tokens, for the run ([Routing], max_run_<limit>)
+# and for each phase ([PhaseBudgets], <phase>_<limit>)
+BUDGET_LIMITS   = ('calls', 'input_tokens', 'output_tokens')
+RUN_BUDGET_KEYS = ('max_run_seconds', 'max_run_cost', 'max_run_calls', 'max_run_input_tokens', 'max_run_output_tokens')
+
+DEFAULT_OUTPUT_TOKENS = 2000  # Expected response size until the run has responses to go by
+
+# Usage for this run (process, or daemon task). Summaries are requested from several threads.
+# 'phases' has the calls and tokens of each phase, and the size of its responses other than votes.
+run_usage = {'start_time': time.time(), 'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0, 'phases': {}}
+usage_lock = threading.Lock()
+
+# Budget keys from the open project's project_params.txt, over those of config.txt
+project_budgets = {}
+
+###############################################################################
+# Read routing settings from config.txt
+###############################################################################
+def get_routing_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Routing'] if 'Routing' in config else {}
+
+    settings = {}
+    settings['preferred_llm']   = config['Preferences'].get('preferred_llm', '').strip() if 'Preferences' in config else ''
+    settings['latency_weight']  = float(section.get('latency_weight', '0.3'))
+    settings['error_weight']    = float(section.get('error_weight', '1.0'))
+    settings['win_weight']      = float(section.get('win_weight', '1.0'))
+    settings['fast_drafts']     = section.get('fast_drafts', 'no').lower() in ['yes', '1']
+
+    # Run budget; 0 means no limit
+    budget = {key: section.get(key, '0') for key in RUN_BUDGET_KEYS}
+    budget.update({key: value for key, value in project_budgets.items() if key in RUN_BUDGET_KEYS})
+
+    settings['max_run_seconds']       = float(budget['max_run_seconds'] or 0)
+    settings['max_run_cost']          = float(budget['max_run_cost'] or 0)
+    settings['max_run_calls']         = int(float(budget['max_run_calls'] or 0))
+    settings['max_run_input_tokens']  = int(float(budget['max_run_input_tokens'] or 0))
+    settings['max_run_output_tokens'] = int(float(budget['max_run_output_tokens'] or 0))
+
+    settings['phase_budgets'] = parse_phase_budgets(config['PhaseBudgets'].items() if 'PhaseBudgets' in config else [])
+    for phase, limits in parse_phase_budgets(project_budgets.items()).items():
+        settings['phase_budgets'].setdefault(phase, {}).update(limits)
+
+    settings['fast_models']     = dict(config['FastModels']) if 'FastModels' in config else {}
+    settings['models']          = dict(config['Models']) if 'Models' in config else {}
+    settings['pricing']         = dict(config['Pricing']) if 'Pricing' in config else {}
+
+    return settings
+
+# The (phase, limit) a budget key sets, eg "code_input_tokens" -> ('code', 'input_tokens'), or None
+def phase_budget_key(key):
+
+    if key.startswith('max_run_'): return None
+
+    for limit in BUDGET_LIMITS:
+        if key.endswith('_' + limit) and len(key) > len(limit) + 1:
+            return key[:-len(limit) - 1], limit
+
+    return None
+
+# {phase: {limit: value}} from (key, value) pairs, ignoring other keys. 0 means no limit.
+def parse_phase_budgets(items):
+
+    budgets = {}
+    for key, value in items:
+        phase_limit = phase_budget_key(key)
+        if phase_limit and value:
+            phase, limit = phase_limit
+            budgets.setdefault(phase, {})[limit] = int(float(value))
+
+    return budgets
+
+# Takes the budget keys of a project's parameters (project_params.txt), which
+# override those of config.txt until another project is opened
+def set_project_budgets(params):
+
+    project_budgets.clear()
+    project_budgets.update({key: value for key, value in params.items() if key in RUN_BUDGET_KEYS or phase_budget_key(key)})
+
+###############################################################################
+# Scores a provider from its call history. Higher is better.
+###############################################################################
+def score_provider(summary, slowest_latency, settings):
+
+    score  = settings['win_weight'] * summary['win_rate']
+    score -= settings['error_weight'] * summary['error_rate']
+
+    # Latency counts relative to the slowest provider; with no samples yet, assume middling
+    if summary['mean_latency'] is not None and slowest_latency:
+        score -= settings['latency_weight'] * summary['mean_latency'] / slowest_latency
+    else:
+        score -= settings['latency_weight'] * 0.5
+
+    return score
+
+###############################################################################
+# Chooses the panel of experts. The preferred LLM (if available) always takes
+# the first seat; the others are ranked by score, with the discovery order from
+# get_all_llm_info breaking ties.
+###############################################################################
+def choose_panel(available_llms, stats_folder, panel_size):
+
+    settings = get_routing_settings()
+
+    summaries = {llm_name: get_provider_summary(stats_folder, llm_name) for llm_name in available_llms}
+
+    latencies = [s['mean_latency'] for s in summaries.values() if s['mean_latency'] is not None]
+    slowest_latency = max(latencies) if latencies else None
+
+    scores = {llm_name: score_provider(summaries[llm_name], slowest_latency, settings) for llm_name in available_llms}
+
+    ranked = sorted(available_llms, key=lambda llm_name: (-scores[llm_name], available_llms.index(llm_name)))
+
+    preferred_llm = settings['preferred_llm']
+    if preferred_llm in ranked:
+        ranked.remove(preferred_llm)
+        ranked.insert(0, preferred_llm)
+
+    panel_list = ranked[:panel_size]
+
+    logger.info("Panel: " + ', '.join(f"{llm_name} ({scores[llm_name]:.2f})" for llm_name in panel_list))
+
+    return panel_list
+
+###############################################################################
+# Returns the model an LLM should use for a step: 'draft', 'reflection',
+# 'final', 'vote' or 'summary'. Fast roles use [FastModels] when a model is configured
+# there (drafts only with fast_drafts), and every role uses it once the run
+# budget has been spent.
+###############################################################################
+def get_model_for_role(llm_name, role):
+
+    settings = get_routing_settings()
+
+    model      = settings['models'].get(llm_name, '')
+    fast_model = settings['fast_models'].get(llm_name, '').strip()
+
+    fast_role = role in FAST_ROLES or (role == 'draft' and settings['fast_drafts'])
+
+    if fast_model and (fast_role or run_budget_exceeded(settings)):
+        return fast_model
+
+    return model
+
+###############################################################################
+# Run budget. Cost is estimated from prompt and response sizes and the
+# per-1k-token prices in [Pricing] ("model = input_price, output_price").
+###############################################################################
+def estimate_tokens(text):
+    return len(text or '') // CHARS_PER_TOKEN
+
+def estimate_cost(model, input_tokens, output_tokens, settings):
+
+    price = settings['pricing'].get(model.lower(), '')
+    if not price: return 0.0
+
+    input_price, _, output_price = price.partition(',')
+    return (input_tokens * float(input_price) + output_tokens * float(output_price or input_price)) / 1000
+
+def record_usage(model, prompt, response, phase=None, role=None):
+
+    settings = get_routing_settings()
+
+    input_tokens  = estimate_tokens(prompt)
+    output_tokens = estimate_tokens(response)
+
+    cost = estimate_cost(model, input_tokens, output_tokens, settings)
+
+    with usage_lock:
+        run_usage['calls']         += 1
+        run_usage['input_tokens']  += input_tokens
+        run_usage['output_tokens'] += output_tokens
+        run_usage['cost']          += cost
+
+        phase_usage = run_usage['phases'].setdefault(phase or 'other', {'calls': 0, 'input_tokens': 0, 'output_tokens': 0,
+                                                                        'responses': 0, 'response_tokens': 0})
+        phase_usage['calls']         += 1
+        phase_usage['input_tokens']  += input_tokens
+        phase_usage['output_tokens'] += output_tokens
+        if role != 'vote':
+            phase_usage['responses']       += 1
+            phase_usage['response_tokens'] += output_tokens
+
+# Starts the usage count for a new run, eg each task of the daemon
+def reset_run_usage():
+
+    with usage_lock:
+        run_usage.update({'start_time': time.time(), 'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0, 'phases': {}})
+
+# True once the run has spent its time, cost, calls or tokens
+def run_budget_exceeded(settings=None):
+
+    settings = settings or get_routing_settings()
+
+    if settings['max_run_seconds'] and time.time() - run_usage['start_time'] > settings['max_run_seconds']:
+        return True
+
+    if settings['max_run_cost'] and run_usage['cost'] > settings['max_run_cost']:
+        return True
+
+    return any(left is not None and left <= 0 for left in remaining_budget(None, settings).values())
+
+###############################################################################
+# Budget checks before a call. Calls and tokens are estimated locally (tokens
+# from the prompt size; a response is expected to be as long as the phase's
+# responses so far, within its output limit), and checked against what is
+# left of the run's budget and the phase's.
+###############################################################################
+
+# {limit: calls or tokens left} of the run's budget and the phase's, None where there is no limit
+def remaining_budget(phase, settings=None):
+
+    settings     = settings or get_routing_settings()
+    phase_limits = settings['phase_budgets'].get(phase, {})
+    phase_usage  = run_usage['phases'].get(phase, {})
+
+    remaining = {}
+    for limit in BUDGET_LIMITS:
+        left = []
+        if settings['max_run_' + limit]: left.append(settings['max_run_' + limit] - run_usage[limit])
+        if phase_limits.get(limit):      left.append(phase_limits[limit] - phase_usage.get(limit, 0))
+        remaining[limit] = min(left) if left else None
+
+    return remaining
+
+def usage_fits(usage, remaining):
+
+    return all(remaining[limit] is None or usage[limit] <= remaining[limit] for limit in BUDGET_LIMITS)
+
+def expected_output_tokens(phase, max_tokens=0):
+
+    phase_usage = run_usage['phases'].get(phase)
+
+    if phase_usage and phase_usage['responses']: tokens = phase_usage['response_tokens'] // phase_usage['responses']
+    else:                                        tokens = DEFAULT_OUTPUT_TOKENS
+
+    return min(tokens, max_tokens) if max_tokens else tokens
+
+# Calls and tokens of a multi_llm_request: each panelist drafts and reflects
+# (a reflection carries the request and the previous response), then, with
+# more than one candidate, each votes on all of them
+def estimate_panel_usage(request_tokens, output_tokens, panel_size, reflections, vote_tokens=16):
+
+    answers = panel_size * reflections
+    votes   = panel_size if panel_size > 1 else 0
+
+    input_tokens  = panel_size * (request_tokens + (reflections - 1) * (request_tokens + output_tokens))
+    input_tokens += votes * (request_tokens + panel_size * output_tokens)
+
+    return {'calls': answers + votes, 'input_tokens': input_tokens, 'output_tokens': answers * output_tokens + votes * vote_tokens}
+
+# Whether one more call with this prompt fits the budget
+def call_within_budget(prompt, phase, max_output_tokens=0):
+
+    settings = get_routing_settings()
+    if run_budget_exceeded(settings): return False
+
+    usage = {'calls': 1, 'input_tokens': estimate_tokens(prompt), 'output_tokens': expected_output_tokens(phase, max_output_tokens)}
+    return usage_fits(usage, remaining_budget(phase, settings))
+
+###############################################################################
+# Fits a panel request to the budget: fewer reflections first, then a smaller
+# panel, down to one LLM answering once. Returns (panel_size, reflections).
+###############################################################################
+def plan_panel_request(request, phase, panel_size, reflections, max_output_tokens=0):
+
+    settings = get_routing_settings()
+    if panel_size < 1: return panel_size, reflections
+
+    if run_budget_exceeded(settings):
+        if (panel_size, reflections) != (1, 1): logger.warning(f"Run budget spent. Making one {phase or 'other'} call instead of a panel.")
+        return 1, 1
+
+    remaining = remaining_budget(phase, settings)
+    if all(left is None for left in remaining.values()): return panel_size, reflections
+
+    request_tokens = estimate_tokens(request)
+    output_tokens  = expected_output_tokens(phase, max_output_tokens)
+
+    plans = [(panel_size, iterations) for iterations in range(reflections, 0, -1)] + [(size, 1) for size in range(panel_size - 1, 0, -1)]
+    for size, iterations in plans:
+        if usage_fits(estimate_panel_usage(request_tokens, output_tokens, size, iterations), remaining):
+            if (size, iterations) != (panel_size, reflections):
+                logger.warning(f"Budget: {phase or 'other'} request reduced to {size} LLMs with {iterations} iterations (from {panel_size} with {reflections}).")
+            return size, iterations
+
+    logger.warning(f"Budget: not enough left for a {phase or 'other'} request. Making one call.")
+    return 1, 1
+
+# Whether a context of this size (eg the code bundle) can go in every prompt
+# of these phases, with a full panel, within the input tokens left
+def context_fits_budget(context_tokens, phases, panel_size=3, reflections=3):
+
+    settings = get_routing_settings()
+
+    # The input tokens of the context alone, repeated in each draft, reflection and vote
+    input_tokens = estimate_panel_usage(context_tokens, 0, panel_size, reflections)['input_tokens']
+
+    total = 0
+    for phase in phases:
+        left = remaining_budget(phase, settings)['input_tokens']
+        if left is not None and input_tokens > left: return False
+        total += input_tokens
+
+    left = remaining_budget(None, settings)['input_tokens']
+    return left is None or total <= left
@@ -0,0 +1,327 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Full-text index of a project's LLM logs, kept in llm_logs/log_index.sqlite
+# (SQLite FTS5). Each request and response file is one row, with the
+# provider, timestamp, size and, where llm_logs/calls.jsonl has them, the
+# phase, role, model, latency and whether markers were expected. Older logs
+# are paired request-to-response by file order, for their latency.
+#
+# The index is brought up to date before every query, reading only the files
+# and calls.jsonl lines added since the last update.
+#
+# Usage: python log_index.py [query] [--project NAME] [--llm NAME] [--phase NAME]
+#                            [--kind request|response] [--since DATE] [--until DATE]
+#                            [--limit N] [--stats] [--rebuild]
+# The query uses FTS5 syntax (words, "phrases", AND/OR/NOT, prefix*). A query
+# that isn't valid FTS5, eg a line of code, is searched as a phrase.
+###############################################################################
+
+import os
+import glob
+import time
+import json
+import argparse
+from datetime import datetime
+
+from cassette import CALLS_FILE, LOG_FILE_RE, TIMESTAMP_FORMAT
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+INDEX_FILE   = 'log_index.sqlite'
+BATCH_SIZE   = 500   # Files indexed per transaction
+SNIPPET_SIZE = 16    # Tokens shown around a match
+
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS logs (
+                 id INTEGER PRIMARY KEY, file TEXT UNIQUE NOT NULL, kind TEXT NOT NULL, llm_name TEXT NOT NULL,
+                 logged_at TEXT NOT NULL, size INTEGER NOT NULL, reused INTEGER NOT NULL DEFAULT 0,
+                 call_id INTEGER, answered INTEGER NOT NULL DEFAULT 0, phase TEXT, role TEXT, model TEXT,
+                 seconds REAL, include_markers INTEGER, has_markers INTEGER)""",
+          "CREATE INDEX IF NOT EXISTS logs_llm ON logs (llm_name, kind, logged_at)",
+          "CREATE INDEX IF NOT EXISTS logs_open_requests ON logs (llm_name, kind, answered, file)",
+          "CREATE INDEX IF NOT EXISTS logs_call ON logs (call_id)",
+          "CREATE VIRTUAL TABLE IF NOT EXISTS log_text USING fts5(text)",
+          "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"]
+
+def open_log_index(logs_folder):
+    import sqlite3
+
+    connection = sqlite3.connect(os.path.join(logs_folder, INDEX_FILE), timeout=30)
+    connection.row_factory = sqlite3.Row
+
+    try:
+        for statement in SCHEMA: connection.execute(statement)
+    except sqlite3.OperationalError as e:
+        connection.close()
+        raise RuntimeError(f"Could not create the log index (this Python's SQLite may lack FTS5): {e}")
+
+    connection.commit()
+    return connection
+
+###############################################################################
+# Updating
+###############################################################################
+
+def file_time(timestamp):
+
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+# Adds one log file. A response is paired with the oldest unanswered request
+# of its provider; calls.jsonl corrects the pairing where it has the call.
+def index_log_file(connection, logs_folder, name, match):
+
+    timestamp, kind, llm_name, reused = match.groups()
+
+    with open(os.path.join(logs_folder, name), 'r', encoding='utf-8', errors='replace') as f:
+        text = f.read()
+
+    logged_at   = file_time(timestamp)
+    has_markers = int('<<' in text and '>>' in text) if kind == 'response' else None
+
+    cursor = connection.execute("INSERT INTO logs (file, kind, llm_name, logged_at, size, reused, has_markers) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (name, kind, llm_name, logged_at.isoformat(sep=' '), len(text.encode('utf-8')), int(bool(reused)), has_markers))
+    row_id = cursor.lastrowid
+    connection.execute("INSERT INTO log_text (rowid, text) VALUES (?, ?)", (row_id, text))
+
+    if kind == 'request':
+        connection.execute("UPDATE logs SET call_id = id WHERE id = ?", (row_id,))
+        return
+
+    request = connection.execute("SELECT id, file FROM logs WHERE llm_name = ? AND kind = 'request' AND answered = 0 AND file <= ? "
+                                 "ORDER BY file LIMIT 1", (llm_name, name)).fetchone()
+    if request is None: return
+
+    seconds = (logged_at - file_time(LOG_FILE_RE.match(request['file']).group(1))).total_seconds()
+    connection.execute("UPDATE logs SET answered = 1 WHERE id = ?", (request['id'],))
+    connection.execute("UPDATE logs SET call_id = ?, seconds = ? WHERE id = ?", (request['id'], None if reused else seconds, row_id))
+
+# Applies the calls.jsonl lines added since the last update. A line whose
+# files were written after this update scanned the folder can't be applied
+# yet: the offset stops before it, so the next update reads it again. Lines
+# whose files no longer exist are passed over.
+def index_call_list(connection, logs_folder):
+
+    calls_path = os.path.join(logs_folder, CALLS_FILE)
+    if not os.path.exists(calls_path): return 0
+
+    row    = connection.execute("SELECT value FROM meta WHERE key = 'calls_offset'").fetchone()
+    offset = int(row['value']) if row else 0
+
+    with open(calls_path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+
+    # A line still being written is left for the next update
+    data = data[:data.rfind(b'\n') + 1]
+
+    count, consumed = 0, 0
+    for line in data.splitlines(keepends=True):
+        try:
+            entry = json.loads(line.decode('utf-8', errors='replace'))
+        except ValueError:
+            consumed += len(line)
+            continue
+
+        request  = connection.execute("SELECT id FROM logs WHERE file = ?", (entry.get('request'),)).fetchone()
+        response = connection.execute("SELECT id, call_id FROM logs WHERE file = ?", (entry.get('response'),)).fetchone()
+
+        if request is None or response is None:
+            unindexed = [entry.get(key) for key, row in (('request', request), ('response', response)) if row is None]
+            if any(name and os.path.exists(os.path.join(logs_folder, name)) for name in unindexed): break
+            consumed += len(line)
+            continue
+
+        # Undo a different pairing made from file order
+        if response['call_id'] not in (None, request['id']):
+            connection.execute("UPDATE logs SET answered = 0 WHERE id = ?", (response['call_id'],))
+
+        connection.execute("UPDATE logs SET answered = 1 WHERE id = ?", (request['id'],))
+        connection.execute("UPDATE logs SET call_id = ?, phase = ?, role = ?, model = ?, include_markers = ? WHERE id IN (?, ?)",
+                           (request['id'], entry.get('phase'), entry.get('role'), entry.get('model'), int(bool(entry.get('include_markers'))),
+                            request['id'], response['id']))
+        connection.execute("UPDATE logs SET seconds = ? WHERE id = ?", (entry.get('seconds'), response['id']))
+        consumed += len(line)
+        count += 1
+
+    connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('calls_offset', ?)", (str(offset + consumed),))
+    return count
+
+# Indexes the log files added since the last update. Returns how many.
+def update_log_index(logs_folder, connection=None):
+
+    own_connection = connection is None
+    if own_connection: connection = open_log_index(logs_folder)
+
+    try:
+        indexed = {row['file'] for row in connection.execute("SELECT file FROM logs")}
+
+        new_files = []
+        with os.scandir(logs_folder) as entries:
+            for entry in entries:
+                if entry.name in indexed: continue
+                match = LOG_FILE_RE.match(entry.name)
+                if match: new_files.append((entry.name, match))
+
+        # File names sort by time, so requests are indexed before their responses
+        new_files.sort()
+        for number, (name, match) in enumerate(new_files, 1):
+            try:
+                index_log_file(connection, logs_folder, name, match)
+            except OSError as e:
+                logger.warning(f"Could not index {name}: {e}")
+            if number % BATCH_SIZE == 0: connection.commit()
+
+        index_call_list(connection, logs_folder)
+        connection.commit()
+    finally:
+        if own_connection: connection.close()
+
+    return len(new_files)
+
+###############################################################################
+# Queries
+###############################################################################
+
+def filter_clauses(filters):
+
+    clauses, values = [], []
+    for column, key in (('logs.llm_name', 'llm'), ('logs.phase', 'phase'), ('logs.kind', 'kind')):
+        if filters.get(key):
+            clauses.append(f"{column} = ?")
+            values.append(filters[key])
+    if filters.get('since'):
+        clauses.append("logs.logged_at >= ?")
+        values.append(filters['since'])
+    if filters.get('until'):
+        clauses.append("logs.logged_at < ?")
+        values.append(filters['until'])
+
+    return clauses, values
+
+# Runs a statement with an FTS5 query, searching the query as a phrase if it
+# is not valid FTS5 syntax
+def execute_match(connection, sql, query, values):
+    import sqlite3
+
+    try:
+        return connection.execute(sql, [query] + values).fetchall()
+    except sqlite3.OperationalError:
+        phrase = '"' + query.replace('"', '""') + '"'
+        return connection.execute(sql, [phrase] + values).fetchall()
+
+# Matching log entries, best match first (newest first without a query)
+def search_log_index(connection, query, filters, limit):
+
+    clauses, values = filter_clauses(filters)
+    columns = "logs.file, logs.kind, logs.llm_name, logs.logged_at, logs.size, logs.reused, logs.phase, logs.role, logs.model, logs.seconds"
+
+    if not query:
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        return connection.execute(f"SELECT {columns}, '' AS snippet, 0 AS rank FROM logs {where} ORDER BY logs.file DESC LIMIT ?",
+                                  values + [limit]).fetchall()
+
+    where = ' AND '.join(['log_text MATCH ?'] + clauses)
+    sql = (f"SELECT {columns}, snippet(log_text, 0, '[', ']', ' ... ', {SNIPPET_SIZE}) AS snippet, log_text.rank AS rank "
+           f"FROM log_text JOIN logs ON logs.id = log_text.rowid WHERE {where} ORDER BY log_text.rank LIMIT ?")
+
+    return execute_match(connection, sql, query, values + [limit])
+
+# Responses per provider and phase: how many, how many lacked the file markers
+# they were asked for, how many were reused, their latency and size
+def log_index_stats(connection, query, filters):
+
+    clauses, values = filter_clauses(dict(filters, kind='response'))
+    sql = ("SELECT logs.llm_name, COALESCE(logs.phase, '') AS phase, COUNT(*) AS responses, "
+           "SUM(logs.include_markers = 1 AND logs.has_markers = 0) AS missing_markers, SUM(logs.reused) AS reused, "
+           "AVG(logs.seconds) AS average_seconds, MAX(logs.seconds) AS max_seconds, SUM(logs.size) AS bytes FROM ")
+
+    if query:
+        sql += f"log_text JOIN logs ON logs.id = log_text.rowid WHERE {' AND '.join(['log_text MATCH ?'] + clauses)} "
+        sql += "GROUP BY logs.llm_name, phase ORDER BY logs.llm_name, phase"
+        return execute_match(connection, sql, query, values)
+
+    sql += f"logs {'WHERE ' + ' AND '.join(clauses) if clauses else ''} GROUP BY logs.llm_name, phase ORDER BY logs.llm_name, phase"
+    return connection.execute(sql, values).fetchall()
+
+###############################################################################
+# Command line
+###############################################################################
+
+def print_search_results(results):
+
+    for project, row in results:
+        seconds = f"{row['seconds']:.1f}s" if row['seconds'] is not None else '-'
+        label   = '/'.join(part for part in (row['phase'], row['role']) if part) or '-'
+        reused  = ' reused' if row['reused'] else ''
+        print(f"{project}  {row['logged_at'][:19]}  {row['llm_name']:<10} {row['kind']:<8}{reused}  {label:<20} {seconds:>7}  {row['size']:>8} B  {row['file']}")
+        if row['snippet']: print(f"    {' '.join(row['snippet'].split())}")
+
+def print_stats(results):
+
+    print(f"{'project':<16} {'llm':<10} {'phase':<14} {'responses':>9} {'no markers':>10} {'reused':>6} {'avg s':>7} {'max s':>7} {'MB':>8}")
+    for project, row in results:
+        average = f"{row['average_seconds']:.1f}" if row['average_seconds'] is not None else '-'
+        maximum = f"{row['max_seconds']:.1f}" if row['max_seconds'] is not None else '-'
+        print(f"{project:<16} {row['llm_name']:<10} {row['phase'] or '-':<14} {row['responses']:>9} {row['missing_markers'] or 0:>10} "
+              f"{row['reused'] or 0:>6} {average:>7} {maximum:>7} {(row['bytes'] or 0) / 1e6:>8.2f}")
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Search the LLM logs of Firebird projects.")
+    parser.add_argument('query', nargs='?', default='', help="FTS5 query (words, \"phrases\", AND/OR/NOT, prefix*)")
+    parser.add_argument('--project', action='append', help="Project to search (default: all). May be repeated.")
+    parser.add_argument('--llm',   help="Only this provider, eg groq")
+    parser.add_argument('--phase', help="Only this phase, eg code")
+    parser.add_argument('--kind',  choices=['request', 'response'], help="Only requests or only responses")
+    parser.add_argument('--since', help="Logged at or after this date/time (YYYY-MM-DD[ HH:MM])")
+    parser.add_argument('--until', help="Logged before this date/time")
+    parser.add_argument('--limit', type=int, default=20, help="Results shown (default 20)")
+    parser.add_argument('--stats', action='store_true', help="Count responses per provider and phase instead of listing them")
+    parser.add_argument('--rebuild', action='store_true', help="Rebuild the index from scratch")
+    args = parser.parse_args()
+
+    projects_folder = os.path.join(os.getcwd(), 'projects')
+    names = args.project or sorted(os.path.basename(os.path.dirname(path)) for path in glob.glob(os.path.join(projects_folder, '*', 'llm_logs')))
+    filters = {'llm': args.llm, 'phase': args.phase, 'kind': args.kind, 'since': args.since, 'until': args.until}
+
+    start_time = time.perf_counter()
+    results, indexed = [], 0
+
+    for name in names:
+        logs_folder = os.path.join(projects_folder, name, 'llm_logs')
+        if not os.path.isdir(logs_folder):
+            print(f"No llm_logs folder for project {name}.")
+            continue
+
+        if args.rebuild and os.path.exists(os.path.join(logs_folder, INDEX_FILE)): os.remove(os.path.join(logs_folder, INDEX_FILE))
+
+        connection = open_log_index(logs_folder)
+        try:
+            indexed += update_log_index(logs_folder, connection)
+            if args.stats: rows = log_index_stats(connection, args.query, filters)
+            else:          rows = search_log_index(connection, args.query, filters, args.limit)
+        finally:
+            connection.close()
+
+        results.extend((name, row) for row in rows)
+
+    if args.stats:
+        print_stats(results)
+    else:
+        if args.query: results.sort(key=lambda result: result[1]['rank'])
+        else:          results.sort(key=lambda result: result[1]['file'], reverse=True)
+        results = results[:args.limit]
+        print_search_results(results)
+
+    print(f"\n{len(results)} results in {(time.perf_counter() - start_time) * 1000:.0f} ms ({indexed} new log files indexed)")
+
+if __name__ == "__main__":
+
+    main()
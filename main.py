@@ -8,7 +8,6 @@
 from datetime import datetime
 import os
 import sys
-import subprocess
 import shutil
 import configparser
 import logging
@@ -17,6 +16,17 @@ import configparser
 from datetime import datetime
 from typing import Optional
 from api_caller import *
+from exe_builder import *
+from prompt_builder import PromptBuilder
+from text_transforms import add_blockquote_prefix, clean_content
+from file_writer import new_change_set, merge_change_sets, changed_files, write_extracted_files
+from review_scope import get_review_settings, create_review_bundle
+from symbol_index import get_symbol_index_settings, update_symbol_index, create_task_slice, check_plan_symbols
+from project_summary import get_summarization_settings, create_project_summary
+from speculation import get_speculation_settings, start_speculative_request
+from workspace import get_workspace_settings, project_lock, create_workspace, finish_workspace, remove_workspace
+from llm_router import estimate_tokens, reset_run_usage, set_project_budgets, context_fits_budget
+from profiler import span, profiled, enter_phase, get_profile_mode, start_profile, stop_profile
 
 ###############################################################################
 # Logging Setup
@@ -85,47 +95,36 @@ def read_tasks_file(file_path):
 
     return "\n".join(new_tasks)
 
+# Takes the tasks waiting in tasks.txt for this run: they are archived and the
+# file is emptied under the project lock, so two runs never take the same task.
+def claim_tasks(file_path):
+
+    with project_lock(os.path.dirname(os.path.dirname(file_path))):
+        task = read_tasks_file(file_path)
+        if task:
+            with open(file_path, 'w') as file:
+                pass
+
+    return task
+
+# Puts a declined task back at the top of tasks.txt, for the next run
+def restore_tasks(file_path, task):
+
+    with project_lock(os.path.dirname(os.path.dirname(file_path))):
+        existing = ''
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file: existing = file.read()
+
+        with open(file_path, 'w') as file:
+            file.write(task + "\n" + existing)
+
 def create_subfolder(folder_name):
     if not os.path.exists(folder_name):
         os.makedirs(folder_name)
         print(f"Created subfolder: {folder_name}")
     return
 
-# This removes backticks ```` from files extracted from LLM response.
-def clean_content(content):
-    """
-    Clean the content by removing surrounding and internal backticks,
-    as well as language specifiers.
-    """
-    lines = content.split('\n')
-    cleaned_lines = []
-    skip_next = False
-
-    for line in lines:
-        if skip_next:
-            skip_next = False
-            continue
-        
-        # Remove lines that are just backticks
-        if line.strip() == '```' or line.strip() == '`':
-            continue
-        
-        # Remove language specifier lines
-        if line.strip().startswith('```'):
-            skip_next = True
-            continue
-        
-        # Remove leading and trailing backticks from each line
-        line = line.strip('`')
-        
-        cleaned_lines.append(line)
-
-    # Remove any trailing empty lines
-    while cleaned_lines and not cleaned_lines[-1].strip():
-        cleaned_lines.pop()
-
-    return '\n'.join(cleaned_lines)
-
+@profiled()
 def parse_llm_response(response):
     code_blocks = {}
     doc_blocks = {}
@@ -170,6 +169,7 @@ def get_preferred_llm():
     preferred_llm_name = config['Preferences']['preferred_llm']
 
 
+@profiled()
 def create_code_history_backup(project_folder):
     """Create a backup of all files in the project folder before making any changes."""
     
@@ -189,7 +189,7 @@ def create_code_history_backup(project_folder):
         return
 
     # If code files exist, proceed with the backup
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")  # Microseconds, so runs merging in the same second get their own backup
     backup_folder = os.path.join(project_folder, 'code_history', timestamp)
     os.makedirs(backup_folder, exist_ok=True)
 
@@ -212,6 +212,7 @@ def create_code_history_backup(project_folder):
 # This reads all the project code and document files and concatenates them into a text bundle
 # to put into context for the LLM prompt.
 ###############################################################################
+@profiled()
 def create_file_bundle(project_folder, prompt, language):
 
     code_bundle = ''
@@ -230,61 +231,258 @@ def create_file_bundle(project_folder, prompt, language):
     
     return code_bundle  # Return the code bundle without sending it to LLM yet
 
+###############################################################################
+# Prompt sections shared by several phases. Each adds a named section to a
+# PromptBuilder; the code bundle and architecture plan are added by reference.
+###############################################################################
+
+# Request LLM to use highly decomposed coding
+def add_coding_style_section(builder):
+
+    builder.section('coding_style')
+    builder.add(f"**Coding Style Preference: Modular and Highly Decomposed**\n")
+    builder.add(f"\n")
+    builder.add(f"I prefer a coding style that breaks down tasks into very small, focused functions. Here's what I expect:\n")
+    builder.add(f"\n")
+    builder.add(f"- **Single-Purpose Functions:** Each function should perform only one task. If a task involves multiple steps, break it down into separate functions, each handling one step.\n")
+    builder.add(f"- **Modularity:** Functions should be small, self-contained, and easy to understand.\n")
+    builder.add(f"- **Clear Structure:** Avoid long, complex functions. Instead, use sequences of short functions to accomplish complex tasks.\n")
+    builder.add(f"\n")
+    builder.add(f"The benefits of this approach include:\n")
+    builder.add(f"- **Fewer Errors:** Smaller functions are easier for the LLM to generate correctly.\n")
+    builder.add(f"- **Simpler Debugging:** Isolated functions make it easier to find and fix issues.\n")
+    builder.add(f"- **Better Documentation:** Clear, focused functions are easier to describe and understand.\n")
+    builder.add(f"- **Flexible Code:** Modular code is easier to modify and extend.\n")
+    builder.add(f"\n")
+    builder.add(f"Please ensure the code you generate follows this highly modular and functionally decomposed approach.\n")
+    builder.add(f"#########################\n")
+
+# Prompt regarding indicators of file boundaries
+def add_file_delimiters_section(builder, extension, intro):
+
+    builder.section('file_delimiters')
+    builder.add(f"**File delimiters in your response**\n")
+    builder.add(intro)
+    builder.add(f"For code, mark the start and end using the format <<<CODE START: filename.{extension}>>> and <<<CODE END: filename.{extension}>>>.\n")
+    builder.add(f"For documentation, use <<<DOC START: filename.md>>> and <<<DOC END: filename.md>>>`.\n")
+    builder.add(f"For other text-based files (e.g., .txt, .csv, .json, .xml, .sql, .tsv, et cetera), use <<<FILE START: filename.extension>>> and <<<FILE END: filename.extension>>>.\n")
+    builder.add(f"#########################\n\n")
+
+# Inform LLM to use existing code as baseline for any subsequent code changes, and show code bundle
+def add_code_bundle_section(builder, code_bundle, intro=None):
+
+    builder.section('code_bundle')
+    builder.add(f"**Refer to existing code as baseline for any changes**\n")
+    builder.add(f"Any changes you make must be made to the existing code files and any supporting files as the starting baseline for subsequent changes.\n")
+
+    if code_bundle:
+        builder.add(intro or f"Here is all the source code and all supporting files in the form as they currently exist prior to any subsequents changes you may make:\n")
+        builder.add(code_bundle).add("\n")
+        builder.add(f"#########################\n")
+
+# Request for requirements.txt, if Python
+def add_python_requirements_section(builder, language):
+
+    if (language == 'python'):
+        builder.section('python_requirements')
+        builder.add(f"**Installing Python libraries**\n")
+        builder.add("If libraries are needed that are not part of the standard Python libraries, please create a requirements.txt file, using the pip command with syntax for installing the libraries.\n")
+        builder.add(f"#########################\n")
+
+# Task assignment in original wording
+def add_task_wording_section(builder, blockquoted_prompt):
+
+    builder.section('task_wording')
+    builder.add(f"**Details about the specific task assignment**\n")
+    builder.add(f"Previously, in our chat, I shared the task assignment worded in my own words, and I asked you to reword it in your words, so I could ascertain if our understanding is aligned.\n")
+    builder.add(f"Thank you for confirming your understanding. It is aligned with my own understanding and expectations.\n\n")
+    builder.add(f"**My wording of the task**\n")
+    builder.add(f"Here is the specific task assignment as worded using my words:\n\n")
+    builder.add(blockquoted_prompt).add("\n\n")
+
+# Summary of an existing project too large to include in full
+def add_project_summary_section(builder, project_summary):
+
+    builder.section('project_summary')
+    builder.add(f"Any changes you make must be made to the existing code files and any supporting files as the starting baseline for subsequent changes. ")
+    builder.add(f"The existing project is too large to show in full, so for context, here is a summary of it:\n")
+    builder.add(project_summary).add("\n")
+    builder.add(f"#########################\n\n")
+
+# Existing code symbols related to the task, from the symbol index
+def add_existing_symbols_section(builder, symbol_slice):
+
+    builder.section('existing_symbols')
+    builder.add(f"**Existing code related to the task**\n")
+    builder.add(f"These functions and classes in the existing code are named in the task, together with the functions they call. Use the existing names and signatures where the plan relies on them:\n")
+    builder.add(symbol_slice).add("\n")
+    builder.add(f"#########################\n\n")
+
+# Technical architecture
+def add_architecture_plan_section(builder, architecture_plan):
+
+    builder.section('architecture_plan')
+    builder.add(f"**Technical architecture for the task**\n")
+    builder.add(f"To guide you in specifics of the solution, here is the detailed technical architecture for the code solution, which represents the coding plan for the task assignment:\n")
+    builder.add(architecture_plan).add("\n")
+    builder.add(f"#########################\n\n")
+
+# Prompt for the technical architecture document
+def create_architecture_prompt(prompt, llm_explanation, language, project_summary, symbol_slice):
+
+    blockquoted_prompt = add_blockquote_prefix(prompt)
+    blockquoted_llm_explanation = add_blockquote_prefix(llm_explanation)
+    architecture_prompt = PromptBuilder('architecture')
+    architecture_prompt.section('task')
+    architecture_prompt.add(f"I am preparing to do some computer programming with your assistance, using the {language} programming language.\n")
+    architecture_prompt.add(f"#########################\n")
+    architecture_prompt.add(f"However, I don't want to start performing any coding tasks yet. First, we need to prepare an architecture document, so I can examine your proposed architecture. But, for your awareness, here is the task that was requested:\n\n")
+    architecture_prompt.add(f"{blockquoted_prompt}\n")
+    architecture_prompt.add(f"#########################\n\n")
+    architecture_prompt.add(f"As a reminder, here is how you described the current task assignment, in your own words, in our previous chat response in a conversation we are having:\n")
+    architecture_prompt.add(blockquoted_llm_explanation).add("\n")
+    architecture_prompt.add(f"#########################\n\n")
+
+    # Request LLM to use highly decomposed coding
+    add_coding_style_section(architecture_prompt)
+
+    # Summary of a large existing project
+    if project_summary: add_project_summary_section(architecture_prompt, project_summary)
+
+    # Existing functions named in the task, and the functions they call
+    if symbol_slice: add_existing_symbols_section(architecture_prompt, symbol_slice)
+
+    # Request for technical architecture document
+    architecture_prompt.section('architecture_request')
+    architecture_prompt.add(f"**Architectural document**\n")
+    architecture_prompt.add(f"Before any actual coding is performed, first, it is necessary to create a highly detailed techical architecture document that describes a technical solution for accomplishing the task.\n")
+    architecture_prompt.add(f"So, based on the requested task, please generate a highly detailed technical architecture document.\n")
+    architecture_prompt.add(f"The document will contain the following:\n")
+    architecture_prompt.add(f"For all code modules, the name of the module, the purpose of the module, and list of all functions inside the module.\n")
+    architecture_prompt.add(f"For all functions, the name of the function, the purpose of the function, and the parameters for the function, what the function returns, and a step-by-step description of what the function does.\n")
+    architecture_prompt.add(f"List all function-to-function relationships that show which functions call what.\n")
+    architecture_prompt.add(f"List any supporting files.\n")
+    architecture_prompt.add(f"Save the technical architecture document in a file named technical_architecture.txt\n")
+    architecture_prompt.add(f"\n")
+    architecture_prompt.add(f"When designing the technical architecture, please remember that it is intended for a highly modular and functionally decomposed approach as previously mentioned.\n")
+    architecture_prompt.add(f"#########################\n\n")
+
+    # Prompt regarding indicators of file boundaries
+    architecture_prompt.section('file_delimiters')
+    architecture_prompt.add(f"**File delimiters**\n")
+    architecture_prompt.add(f"When generating the technical architecture file, use these markers in your response to indicate beginning and end of the file contents:\n")
+    architecture_prompt.add(f"<<<FILE START: technical_architecture.txt>>> and <<<FILE END: technical_architecture.txt>>>.\n")
+    architecture_prompt.add(f"#########################\n\n")
+
+    # Clarify again the specific current task
+    architecture_prompt.section('task_clarification')
+    architecture_prompt.add(f"**Specific task assignment**\n")
+    architecture_prompt.add(f"So, what I need you to do now is create the technical architecture document.\n")
+
+    architecture_prompt.log_section_sizes()
+
+    return architecture_prompt
+
 ###############################################################################
 # Code Generation and Compilation
 ###############################################################################
 
-# Build prompts and call LLMs
-def generate_code_for_project(app_folder, prompt, language, main_file):
+# Build prompts and call LLMs. confirm=False skips asking the user to confirm the
+# LLM's understanding of the task. backup=False skips the code_history backup
+# (a workspace is backed up when it is merged back instead).
+def generate_code_for_project(app_folder, prompt, language, main_file, confirm=True, backup=True, project_folder=None):
+
+    enter_phase('context')
+
+    # The symbol index and summary cache belong to the project, also for a run in a workspace
+    project_folder = project_folder or os.path.dirname(os.path.normpath(app_folder))
 
     # Reads all existing project code and bundles into a string for inclusion in LLM context
-    create_code_history_backup(app_folder)
+    if backup: create_code_history_backup(app_folder)
     code_bundle = create_file_bundle(app_folder, prompt, language)
 
+    # Symbol index of the existing code, for targeted prompt slices and the plan check
+    symbol_settings = get_symbol_index_settings()
+    symbol_index = update_symbol_index(app_folder, project_folder) if symbol_settings['enabled'] else None
+
+    # Existing functions named in the task, and the functions they call
+    symbol_slice = ''
+    if symbol_index:
+        symbol_slice = create_task_slice(symbol_index, prompt, symbol_settings['slice_depth'], symbol_settings['max_symbols'])
+
+    # A project too large for one prompt, or for the input tokens left in the budget, is
+    # summarized (file, folder, project) for the understanding and architecture phases
+    project_summary = ''
+    summary_settings = get_summarization_settings()
+    bundle_tokens = estimate_tokens(code_bundle)
+    if summary_settings['enabled'] and bundle_tokens and (bundle_tokens > summary_settings['min_bundle_tokens'] or
+                                                          not context_fits_budget(bundle_tokens, ('understanding', 'architecture'))):
+        project_summary = create_project_summary(app_folder, logs_folder, project_folder=project_folder)
+
     ###############################################################################
     # Get LLM's understanding of the task
     ###############################################################################
 
     llm_explanation = ""
+    architecture_prompt = None
+    speculative_architecture = None
     while True:
+        enter_phase('understanding')
 
         # Create a prompt to ask LLM if it understands the task
         blockquoted_prompt = add_blockquote_prefix(prompt)
-        understanding_prompt = ""
-        understanding_prompt += f"**Specific task assignment**\n"
-        understanding_prompt += f"I am preparing to code a program using the {language} programming language\n"
-        understanding_prompt += f"However, before beginning any actual coding, is it important to first clarify the specifics of the intended programming task.\n"
-        understanding_prompt += f"Therefore, please summarize your understanding of the requested programming task described below:\n\n"
-        understanding_prompt += f"{blockquoted_prompt}\n\n"
-        understanding_prompt += f"#########################\n\n"
-        understanding_prompt += f"Just to clarify: I do not want code or code snippets at this point. The focus at this point must be on describing the functional features of the program, not actual code.\n"
-
-        # If code bundle exists, add it to context
-        if code_bundle:
-
-            understanding_prompt += f'Any changes you make must be made to the existing code files and any supporting files as the starting baseline for subsequent changes. '
-            understanding_prompt += f"For context, here is a bundle of all the source code and all supporting files as they currently exist:\n"
-            understanding_prompt += f"{code_bundle}\n"
-            understanding_prompt += f"#########################\n\n"
+        understanding_prompt = PromptBuilder('understanding')
+        understanding_prompt.section('task')
+        understanding_prompt.add(f"**Specific task assignment**\n")
+        understanding_prompt.add(f"I am preparing to code a program using the {language} programming language\n")
+        understanding_prompt.add(f"However, before beginning any actual coding, is it important to first clarify the specifics of the intended programming task.\n")
+        understanding_prompt.add(f"Therefore, please summarize your understanding of the requested programming task described below:\n\n")
+        understanding_prompt.add(f"{blockquoted_prompt}\n\n")
+        understanding_prompt.add(f"#########################\n\n")
+        understanding_prompt.add(f"Just to clarify: I do not want code or code snippets at this point. The focus at this point must be on describing the functional features of the program, not actual code.\n")
+
+        # If code bundle exists, add it to context, or the summary if it is too large
+        if project_summary:
+            add_project_summary_section(understanding_prompt, project_summary)
+
+        elif code_bundle:
+
+            understanding_prompt.section('code_bundle')
+            understanding_prompt.add(f'Any changes you make must be made to the existing code files and any supporting files as the starting baseline for subsequent changes. ')
+            understanding_prompt.add(f"For context, here is a bundle of all the source code and all supporting files as they currently exist:\n")
+            understanding_prompt.add(code_bundle).add("\n")
+            understanding_prompt.add(f"#########################\n\n")
 
         # Instruction to not include additional remarks/comments
-        understanding_prompt += f"I prefer to have only your description of the task, and no other preliminary or concluding remarks/comments.\n\n"
+        understanding_prompt.section('instructions')
+        understanding_prompt.add(f"I prefer to have only your description of the task, and no other preliminary or concluding remarks/comments.\n\n")
 
-        response = multi_llm_request(understanding_prompt, logs_folder, include_markers=False)
+        understanding_prompt.log_section_sizes()
+        response = multi_llm_request(understanding_prompt.render(), logs_folder, include_markers=False, cache_phase='understanding', cache_anchor=prompt,
+                                     output_phase='understanding')
 
         llm_explanation = response
 
         print("Response received from LLM.")
         print(f"LLM's understanding:\n{llm_explanation}\n")
 
+        if not confirm: break
+
+        # Optionally start the architecture request while the user reads the understanding
+        if get_speculation_settings()['architecture']:
+            architecture_prompt = create_architecture_prompt(prompt, llm_explanation, language, project_summary, symbol_slice)
+            speculative_architecture = start_speculative_request('architecture', multi_llm_request, architecture_prompt.render(), logs_folder,
+                                                                 include_markers=False, cache_phase='architecture', cache_anchor=prompt,
+                                                                 output_phase='architecture')
+
+        enter_phase('user_confirmation')
         user_input = input("If the LLM's understanding aligns with your expectations, press [Y]es to confirm, or [N]o to cancel: ").strip().upper()
 
         if user_input == 'Y':
-            # Clear the tasks.txt file only after the user confirms
-            with open('tasks.txt', 'w') as file:
-                pass  # This will create an empty tasks.txt file
             break
         else:
+            if speculative_architecture: speculative_architecture.cancel()
+            restore_tasks(os.path.join(config_folder, 'tasks.txt'), prompt)
             sys.exit(0)
 
     # Determine file extension for the language
@@ -294,62 +492,16 @@ def generate_code_for_project(app_folder, prompt, language, main_file):
     # Request LLM to create a detailed architecture document
     ###############################################################################
 
-    blockquoted_prompt = add_blockquote_prefix(prompt)
-    blockquoted_llm_explanation = add_blockquote_prefix(llm_explanation)
-    architecture_prompt = ""
-    architecture_prompt += f"I am preparing to do some computer programming with your assistance, using the {language} programming language.\n"
-    architecture_prompt += f"#########################\n"
-    architecture_prompt += f"However, I don't want to start performing any coding tasks yet. First, we need to prepare an architecture document, so I can examine your proposed architecture. But, for your awareness, here is the task that was requested:\n\n"
-    architecture_prompt += f"{blockquoted_prompt}\n"
-    architecture_prompt += f"#########################\n\n"
-    architecture_prompt += f"As a reminder, here is how you described the current task assignment, in your own words, in our previous chat response in a conversation we are having:\n"
-    architecture_prompt += f"{blockquoted_llm_explanation}\n"
-    architecture_prompt += f"#########################\n\n"
+    enter_phase('architecture')
 
-    # Request LLM to use highly decomposed coding
-    architecture_prompt += f"**Coding Style Preference: Modular and Highly Decomposed**\n"
-    architecture_prompt += f"\n"
-    architecture_prompt += f"I prefer a coding style that breaks down tasks into very small, focused functions. Here's what I expect:\n"
-    architecture_prompt += f"\n"
-    architecture_prompt += f"- **Single-Purpose Functions:** Each function should perform only one task. If a task involves multiple steps, break it down into separate functions, each handling one step.\n"
-    architecture_prompt += f"- **Modularity:** Functions should be small, self-contained, and easy to understand.\n"
-    architecture_prompt += f"- **Clear Structure:** Avoid long, complex functions. Instead, use sequences of short functions to accomplish complex tasks.\n"
-    architecture_prompt += f"\n"
-    architecture_prompt += f"The benefits of this approach include:\n"
-    architecture_prompt += f"- **Fewer Errors:** Smaller functions are easier for the LLM to generate correctly.\n"
-    architecture_prompt += f"- **Simpler Debugging:** Isolated functions make it easier to find and fix issues.\n"
-    architecture_prompt += f"- **Better Documentation:** Clear, focused functions are easier to describe and understand.\n"
-    architecture_prompt += f"- **Flexible Code:** Modular code is easier to modify and extend.\n"
-    architecture_prompt += f"\n"
-    architecture_prompt += f"Please ensure the code you generate follows this highly modular and functionally decomposed approach.\n"
-    architecture_prompt += f"#########################\n"
+    if architecture_prompt is None:
+        architecture_prompt = create_architecture_prompt(prompt, llm_explanation, language, project_summary, symbol_slice)
 
-    # Request for technical architecture document
-    architecture_prompt += f"**Architectural document**\n"
-    architecture_prompt += f"Before any actual coding is performed, first, it is necessary to create a highly detailed techical architecture document that describes a technical solution for accomplishing the task.\n"
-    architecture_prompt += f"So, based on the requested task, please generate a highly detailed technical architecture document.\n"
-    architecture_prompt += f"The document will contain the following:\n"
-    architecture_prompt += f"For all code modules, the name of the module, the purpose of the module, and list of all functions inside the module.\n"
-    architecture_prompt += f"For all functions, the name of the function, the purpose of the function, and the parameters for the function, what the function returns, and a step-by-step description of what the function does.\n"
-    architecture_prompt += f"List all function-to-function relationships that show which functions call what.\n"
-    architecture_prompt += f"List any supporting files.\n"
-    architecture_prompt += f"Save the technical architecture document in a file named technical_architecture.txt\n"
-    architecture_prompt += f"\n"
-    architecture_prompt += f"When designing the technical architecture, please remember that it is intended for a highly modular and functionally decomposed approach as previously mentioned.\n"
-    architecture_prompt += f"#########################\n\n"
-
-    # Prompt regarding indicators of file boundaries
-    architecture_prompt += f"**File delimiters**\n"
-    architecture_prompt += f"When generating the technical architecture file, use these markers in your response to indicate beginning and end of the file contents:\n"
-    architecture_prompt += f"<<<FILE START: technical_architecture.txt>>> and <<<FILE END: technical_architecture.txt>>>.\n"
-    architecture_prompt += f"#########################\n\n"
-
-    # Clarify again the specific current task
-    architecture_prompt += f"**Specific task assignment**\n"
-    architecture_prompt += f"So, what I need you to do now is create the technical architecture document.\n"
-
-    # Call LLM and request architecture document
-    response = multi_llm_request(architecture_prompt, logs_folder, include_markers=False)
+    # Call LLM and request architecture document, or wait for the request started during confirmation
+    response = speculative_architecture.result() if speculative_architecture else None
+    if response is None:
+        response = multi_llm_request(architecture_prompt.render(), logs_folder, include_markers=False, cache_phase='architecture', cache_anchor=prompt,
+                                     output_phase='architecture')
 
     architecture_text = response.strip()
 
@@ -359,169 +511,129 @@ def generate_code_for_project(app_folder, prompt, language, main_file):
 
     code_blocks, doc_blocks, file_blocks = parse_llm_response(architecture_text)
 
+    # Files written during this run, for the later phases
+    change_set = new_change_set()
+
+    architecture_plan = ''
     if file_blocks:
-        for filename, file_content in file_blocks.items():
-            file_path = os.path.join(app_folder, filename)
-            with open(file_path, 'w', encoding='utf-8') as file:
-                file.write(file_content)
-            print(f"Saved file to {file_path}")  # Debugging line
+        merge_change_sets(change_set, write_extracted_files(app_folder, file_blocks))
 
+        for filename, file_content in file_blocks.items():
             architecture_plan = ''
             if (filename == 'technical_architecture.txt'): architecture_plan = file_content
 
+    # Check the functions the plan calls against the symbols in the existing code
+    if symbol_index and architecture_plan:
+        found, unknown = check_plan_symbols(symbol_index, architecture_plan)
+        print(f"Architecture plan references {len(found)} existing symbols.")
+        if unknown: print(f"Not in the existing code (new, or a wrong reference): {', '.join(unknown)}")
+
     ###############################################################################
     # Request LLM to generate the code
     ###############################################################################
 
+    enter_phase('code')
+
     while True:
-        code_prompt = "";
+        code_prompt = PromptBuilder('code')
 
         # Role prompt
-        code_prompt += f"You are an expert professional computer programmer with experience in the {language} language. You follow best practices.\n"
-        code_prompt += f"#########################\n"
-
-        code_prompt += f"I need you to generate the code.\n"
-        code_prompt += f"#########################\n"
-        code_prompt += f"But before you begin coding, there are several important details I need to clarify.\n"
-        code_prompt += f"#########################\n"
-        code_prompt += f"Here are some guidelines for the program code:\n"
-        code_prompt += f"Code must be in the {language} programming language.\n"
-        code_prompt += f"The main script must be named '{main_file}'. \n"
-        code_prompt += f"#########################\n"
-
-        code_prompt += f"**File encoding preference**\n"
-        code_prompt += f"Regarding file encodings, I prefer ASCII, although UTF8 is okay if necessary to have some special characters. But always avoid Unicode.\n"
-        code_prompt += f"#########################\n"
+        code_prompt.section('role')
+        code_prompt.add(f"You are an expert professional computer programmer with experience in the {language} language. You follow best practices.\n")
+        code_prompt.add(f"#########################\n")
+
+        code_prompt.add(f"I need you to generate the code.\n")
+        code_prompt.add(f"#########################\n")
+        code_prompt.add(f"But before you begin coding, there are several important details I need to clarify.\n")
+        code_prompt.add(f"#########################\n")
+        code_prompt.add(f"Here are some guidelines for the program code:\n")
+        code_prompt.add(f"Code must be in the {language} programming language.\n")
+        code_prompt.add(f"The main script must be named '{main_file}'. \n")
+        code_prompt.add(f"#########################\n")
+
+        code_prompt.section('guidelines')
+        code_prompt.add(f"**File encoding preference**\n")
+        code_prompt.add(f"Regarding file encodings, I prefer ASCII, although UTF8 is okay if necessary to have some special characters. But always avoid Unicode.\n")
+        code_prompt.add(f"#########################\n")
 
         # Request LLM to use highly decomposed coding
-        code_prompt += f"**Coding Style Preference: Modular and Highly Decomposed**\n"
-        code_prompt += f"\n"
-        code_prompt += f"I prefer a coding style that breaks down tasks into very small, focused functions. Here's what I expect:\n"
-        code_prompt += f"\n"
-        code_prompt += f"- **Single-Purpose Functions:** Each function should perform only one task. If a task involves multiple steps, break it down into separate functions, each handling one step.\n"
-        code_prompt += f"- **Modularity:** Functions should be small, self-contained, and easy to understand.\n"
-        code_prompt += f"- **Clear Structure:** Avoid long, complex functions. Instead, use sequences of short functions to accomplish complex tasks.\n"
-        code_prompt += f"\n"
-        code_prompt += f"The benefits of this approach include:\n"
-        code_prompt += f"- **Fewer Errors:** Smaller functions are easier for the LLM to generate correctly.\n"
-        code_prompt += f"- **Simpler Debugging:** Isolated functions make it easier to find and fix issues.\n"
-        code_prompt += f"- **Better Documentation:** Clear, focused functions are easier to describe and understand.\n"
-        code_prompt += f"- **Flexible Code:** Modular code is easier to modify and extend.\n"
-        code_prompt += f"\n"
-        code_prompt += f"Please ensure the code you generate follows this highly modular and functionally decomposed approach.\n"
-        code_prompt += f"#########################\n"
+        add_coding_style_section(code_prompt)
 
         # Request for extensive comments in code
-        code_prompt += f"**Comments in the code**\n"
-        code_prompt += f"Include extensive comments in the code. Use the # symbol to preceed single-line comments. Use docstrings for multi-line comments\n"
-        code_prompt += f"Comments are extremely helpful. They assist the LLM to understand the purpose of the code when I ask the LLM to review the code to either make improvements or fix problems. I like having comments on three levels: 1. for each module, describing the purpose of the module; 2. for each function, describing the purpose of the function; 3. for each operation inside a function, which is normally ever few lines of code, describing the operation.\n"
-        code_prompt += f"#########################\n"
+        code_prompt.section('coding_guidelines')
+        code_prompt.add(f"**Comments in the code**\n")
+        code_prompt.add(f"Include extensive comments in the code. Use the # symbol to preceed single-line comments. Use docstrings for multi-line comments\n")
+        code_prompt.add(f"Comments are extremely helpful. They assist the LLM to understand the purpose of the code when I ask the LLM to review the code to either make improvements or fix problems. I like having comments on three levels: 1. for each module, describing the purpose of the module; 2. for each function, describing the purpose of the function; 3. for each operation inside a function, which is normally ever few lines of code, describing the operation.\n")
+        code_prompt.add(f"#########################\n")
 
         # Avoid backticks in code or any other files
-        code_prompt += f"**Avoid backticks in the code and other files**\n"
-        code_prompt += f"Backticks almost always cause serious problems when they appear in code and other files. It is best to avoid them altogether. Please don't include backticks in code or any other files.\n"
+        code_prompt.add(f"**Avoid backticks in the code and other files**\n")
+        code_prompt.add(f"Backticks almost always cause serious problems when they appear in code and other files. It is best to avoid them altogether. Please don't include backticks in code or any other files.\n")
 
         # No stubbing
-        code_prompt += f"**Provide complete code, not partial code excerpts**\n"
-        code_prompt += f"Please provide the complete code module, not just a partial code snippet. Avoid showing only the relevant part; I need the entire code with the changes. Do not provide stubs or partial code. Show the full code after applying the changes.\n"
-        code_prompt += f"#########################\n"
+        code_prompt.add(f"**Provide complete code, not partial code excerpts**\n")
+        code_prompt.add(f"Please provide the complete code module, not just a partial code snippet. Avoid showing only the relevant part; I need the entire code with the changes. Do not provide stubs or partial code. Show the full code after applying the changes.\n")
+        code_prompt.add(f"#########################\n")
 
         # Don't just focus on the lines of code to be changed. Consider impact on other related parts of the complete solution
-        code_prompt += f"**Reflect on all relationships and aspects of the code**\n"
-        code_prompt += f"When making code changes such as improving existing code or fixing a bug, a common type of mistake I want to avoid is just focusing on the specific affected lines of code without considering impacts the code change that is being contemplated might have elsewhere in related parts of the system, which can sometimes be very remote.\n"
-        code_prompt += f"Therefore, when making changes to existing code, always reflect on all aspects of the code. Consider relationships between functions, and parameters, and external files.\n"
-        code_prompt += f"#########################\n"
+        code_prompt.add(f"**Reflect on all relationships and aspects of the code**\n")
+        code_prompt.add(f"When making code changes such as improving existing code or fixing a bug, a common type of mistake I want to avoid is just focusing on the specific affected lines of code without considering impacts the code change that is being contemplated might have elsewhere in related parts of the system, which can sometimes be very remote.\n")
+        code_prompt.add(f"Therefore, when making changes to existing code, always reflect on all aspects of the code. Consider relationships between functions, and parameters, and external files.\n")
+        code_prompt.add(f"#########################\n")
 
         # Things to do or check to prevent errors when code executes
-        code_prompt += f"**Some things to do and check in the code to prevent possible problems**\n"
-        code_prompt += f"Verify the correct usage of data structures and their methods.\n"
-        code_prompt += f"Double-check all loop conditions and array indexing.\n"
-        code_prompt += f"Ensure all necessary imports are included and correctly specified.\n"
-        code_prompt += f"Implement robust input validation for all function parameters.\n"
-        code_prompt += f"Include comprehensive error handling with try-except blocks.\n"
-        code_prompt += f"Ensure proper type checking.\n"
-        code_prompt += f"Include checks for input types, ranges, and validity before processing data, particularly for function parameters and user inputs.\n"
-        code_prompt += f"When making REST API calls, ensure the response is checked for validity and completeness before processing.\n"
-        code_prompt += f"Use type hints and include runtime type checks can prevent many type-related errors.\n"
-        code_prompt += f"When working with lists and dictionaries, include checks to ensure indices or keys exist before accessing them.\n"
-        code_prompt += f"Include checks for None or null values before accessing object properties or calling methods, especially when dealing with API responses or database queries.\n"
-        code_prompt += f"Implement comprehensive try-except blocks, especially around API calls, file operations, and any code that interacts with external resources.\n"
+        code_prompt.add(f"**Some things to do and check in the code to prevent possible problems**\n")
+        code_prompt.add(f"Verify the correct usage of data structures and their methods.\n")
+        code_prompt.add(f"Double-check all loop conditions and array indexing.\n")
+        code_prompt.add(f"Ensure all necessary imports are included and correctly specified.\n")
+        code_prompt.add(f"Implement robust input validation for all function parameters.\n")
+        code_prompt.add(f"Include comprehensive error handling with try-except blocks.\n")
+        code_prompt.add(f"Ensure proper type checking.\n")
+        code_prompt.add(f"Include checks for input types, ranges, and validity before processing data, particularly for function parameters and user inputs.\n")
+        code_prompt.add(f"When making REST API calls, ensure the response is checked for validity and completeness before processing.\n")
+        code_prompt.add(f"Use type hints and include runtime type checks can prevent many type-related errors.\n")
+        code_prompt.add(f"When working with lists and dictionaries, include checks to ensure indices or keys exist before accessing them.\n")
+        code_prompt.add(f"Include checks for None or null values before accessing object properties or calling methods, especially when dealing with API responses or database queries.\n")
+        code_prompt.add(f"Implement comprehensive try-except blocks, especially around API calls, file operations, and any code that interacts with external resources.\n")
 
         # Prompt regarding indicators of file boundaries
-        code_prompt += f"**File delimiters in your response**\n"
-        code_prompt += f"Generate the project code, documentation, and any other required text-based files, always using markers in your response to indicate beginning and ending of the file contents thusly:\n"
-        code_prompt += f"For code, mark the start and end using the format <<<CODE START: filename.{extension}>>> and <<<CODE END: filename.{extension}>>>.\n"
-        code_prompt += f"For documentation, use <<<DOC START: filename.md>>> and <<<DOC END: filename.md>>>`.\n"
-        code_prompt += f"For other text-based files (e.g., .txt, .csv, .json, .xml, .sql, .tsv, et cetera), use <<<FILE START: filename.extension>>> and <<<FILE END: filename.extension>>>.\n"
-        code_prompt += f"#########################\n\n"
-
-        # Inform LLM to use existing code as baseline for any subsequent code changes
-        code_prompt += f"**Refer to existing code as baseline for any changes**\n"
-        code_prompt += f"Any changes you make must be made to the existing code files and any supporting files as the starting baseline for subsequent changes.\n"
-
-        # Show code bundle, if it exists
-        if code_bundle:
-            code_prompt += f"Here is all the source code and all supporting files in the form as they currently exist prior to any subsequents changes you may make:\n"
-            code_prompt += f"{code_bundle}\n"
-            code_prompt += f"#########################\n"
+        add_file_delimiters_section(code_prompt, extension, "Generate the project code, documentation, and any other required text-based files, always using markers in your response to indicate beginning and ending of the file contents thusly:\n")
+
+        # Inform LLM to use existing code as baseline for any subsequent code changes, and show code bundle, if it exists
+        add_code_bundle_section(code_prompt, code_bundle)
 
         # Request for requirements.txt, if Python
-        if (language == 'python'):
-           code_prompt += f"**Installing Python libraries**\n"
-           code_prompt += "If libraries are needed that are not part of the standard Python libraries, please create a requirements.txt file, using the pip command with syntax for installing the libraries.\n"
-           code_prompt += f"#########################\n"
+        add_python_requirements_section(code_prompt, language)
 
         # Task assignment in original wording
         blockquoted_prompt = add_blockquote_prefix(prompt)
         blockquoted_llm_explanation = add_blockquote_prefix(prompt)
-        code_prompt += f"**Details about the specific task assignment**\n"
-        code_prompt += f"Previously, in our chat, I shared the task assignment worded in my own words, and I asked you to reword it in your words, so I could ascertain if our understanding is aligned.\n"
-        code_prompt += f"Thank you for confirming your understanding. It is aligned with my own understanding and expectations.\n\n"
-        code_prompt += f"**My wording of the task**\n"
-        code_prompt += f"Here is the specific task assignment as worded using my words:\n\n"
-        code_prompt += f"{blockquoted_prompt}\n\n"
+        add_task_wording_section(code_prompt, blockquoted_prompt)
 
         # Task assignment wording by LLM
-        code_prompt += f"**Your wording of the task**\n"
-        code_prompt += f"Now, as a reminder, here (below) is how you described the current task assignment, in your own words, in our previous chat response in a conversation we are having:\n"
-        code_prompt += f"{blockquoted_llm_explanation}\n"
-        code_prompt += f"#########################\n"
+        code_prompt.add(f"**Your wording of the task**\n")
+        code_prompt.add(f"Now, as a reminder, here (below) is how you described the current task assignment, in your own words, in our previous chat response in a conversation we are having:\n")
+        code_prompt.add(blockquoted_llm_explanation).add("\n")
+        code_prompt.add(f"#########################\n")
 
         # Technical architecture
-        code_prompt += f"**Technical architecture for the task**\n"
-        code_prompt += f"To guide you in specifics of the solution, here is the detailed technical architecture for the code solution, which represents the coding plan for the task assignment:\n"
-        code_prompt += f"{architecture_plan}\n"
-        code_prompt += f"#########################\n\n"
+        add_architecture_plan_section(code_prompt, architecture_plan)
 
         # Imports
-        code_prompt += f"**Instructions for imports to functions from modules**\n"
-        code_prompt += f"Always include complete and correct import statements at the beginning of each script.\n"
-        code_prompt += f"When referencing functions from other modules, use fully qualified names (module_name.function_name) or ensure proper imports are in place.\n"
-        code_prompt += f"#########################\n\n"
+        code_prompt.section('imports')
+        code_prompt.add(f"**Instructions for imports to functions from modules**\n")
+        code_prompt.add(f"Always include complete and correct import statements at the beginning of each script.\n")
+        code_prompt.add(f"When referencing functions from other modules, use fully qualified names (module_name.function_name) or ensure proper imports are in place.\n")
+        code_prompt.add(f"#########################\n\n")
 
         # Get response from LLM. This response contains the code.
-        response = multi_llm_request(code_prompt, logs_folder, include_markers=True)
+        code_prompt.log_section_sizes()
+        response = multi_llm_request(code_prompt.render(), logs_folder, include_markers=True, output_phase='code')
 
         code_blocks, doc_blocks, file_blocks = parse_llm_response(response)
 
-        if code_blocks:
-            for filename, code in code_blocks.items():
-                code_file_path = os.path.join(app_folder, filename)
-                with open(code_file_path, 'w', encoding='utf-8') as file:
-                    file.write(code)
-
-        if doc_blocks:
-            for filename, doc in doc_blocks.items():
-                doc_file_path = os.path.join(app_folder, filename)
-                with open(doc_file_path, 'w', encoding='utf-8') as file:
-                    file.write(doc)
-
-        if file_blocks:
-            for filename, file_content in file_blocks.items():
-                file_path = os.path.join(app_folder, filename)
-                with open(file_path, 'w', encoding='utf-8') as file:
-                    file.write(file_content)
-                print(f"Saved file to {file_path}")  # Debugging line
+        # Write code, docs and other files together; unchanged files are not touched
+        merge_change_sets(change_set, write_extracted_files(app_folder, {**code_blocks, **doc_blocks, **file_blocks}))
 
         break
 
@@ -529,58 +641,53 @@ def generate_code_for_project(app_folder, prompt, language, main_file):
     # Request LLM to review code
     ###############################################################################
 
-    # Fetch code bundle
-    code_bundle = create_file_bundle(app_folder, prompt, language)
+    enter_phase('review')
+
+    # Fetch code bundle. By default the review sees only the files changed by this task
+    # and their direct importers in full, with the other files as signatures.
+    review_scope = get_review_settings()['scope']
+    if review_scope == 'changed':
+        code_bundle, review_files = create_review_bundle(app_folder, changed_files(change_set), project_folder)
+    else:
+        code_bundle, review_files = create_file_bundle(app_folder, prompt, language), None
 
     while True:
-        code_prompt = "";
+        if review_files == []:
+            print("No files changed by this task. Skipping code review.")
+            break
+
+        code_prompt = PromptBuilder('review')
 
         # Role prompt
-        code_prompt += f"You are an expert professional computer programmer with experience in the {language} language. You follow best practices.\n"
-        code_prompt += f"#########################\n"
+        code_prompt.section('role')
+        code_prompt.add(f"You are an expert professional computer programmer with experience in the {language} language. You follow best practices.\n")
+        code_prompt.add(f"#########################\n")
 
-        code_prompt += f"I need you to review some existing code.\n"
-        code_prompt += f"#########################\n"
-        code_prompt += f"But before you begin coding, there are some details I need to clarify.\n"
-        code_prompt += f"#########################\n"
-        code_prompt += f"Here are some guidelines for the program code:\n"
-        code_prompt += f"Code must be in the {language} programming language.\n"
-        code_prompt += f"#########################\n"
+        code_prompt.add(f"I need you to review some existing code.\n")
+        code_prompt.add(f"#########################\n")
+        code_prompt.add(f"But before you begin coding, there are some details I need to clarify.\n")
+        code_prompt.add(f"#########################\n")
+        code_prompt.add(f"Here are some guidelines for the program code:\n")
+        code_prompt.add(f"Code must be in the {language} programming language.\n")
+        code_prompt.add(f"#########################\n")
 
 
         # Prompt regarding indicators of file boundaries
-        code_prompt += f"**File delimiters in your response**\n"
-        code_prompt += f"When generating file output, use markers in your response to indicate beginning and ending of the file contents thusly:\n"
-        code_prompt += f"For code, mark the start and end using the format <<<CODE START: filename.{extension}>>> and <<<CODE END: filename.{extension}>>>.\n"
-        code_prompt += f"For documentation, use <<<DOC START: filename.md>>> and <<<DOC END: filename.md>>>`.\n"
-        code_prompt += f"For other text-based files (e.g., .txt, .csv, .json, .xml, .sql, .tsv, et cetera), use <<<FILE START: filename.extension>>> and <<<FILE END: filename.extension>>>.\n"
-        code_prompt += f"#########################\n\n"
-
-        # Inform LLM to use existing code as baseline for any subsequent code changes
-        code_prompt += f"**Refer to existing code as baseline for any changes**\n"
-        code_prompt += f"Any changes you make must be made to the existing code files and any supporting files as the starting baseline for subsequent changes.\n"
-
-        # Show code bundle
-        if code_bundle:
-            code_prompt += f"Here is all the source code and all supporting files in the form as they currently exist prior to any subsequents changes you may make:\n"
-            code_prompt += f"{code_bundle}\n"
-            code_prompt += f"#########################\n"
+        add_file_delimiters_section(code_prompt, extension, "When generating file output, use markers in your response to indicate beginning and ending of the file contents thusly:\n")
+
+        # Inform LLM to use existing code as baseline for any subsequent code changes, and show code bundle
+        if review_files is None:
+            add_code_bundle_section(code_prompt, code_bundle)
+        else:
+            add_code_bundle_section(code_prompt, code_bundle, f"Here are the files changed for this task and the files that import them, in full, followed by the signatures of the other project files:\n")
 
         # Request for requirements.txt, if Python
-        if (language == 'python'):
-           code_prompt += f"**Installing Python libraries**\n"
-           code_prompt += "If libraries are needed that are not part of the standard Python libraries, please create a requirements.txt file, using the pip command with syntax for installing the libraries.\n"
-           code_prompt += f"#########################\n"
+        add_python_requirements_section(code_prompt, language)
 
         # Task assignment in original wording
         blockquoted_prompt = add_blockquote_prefix(prompt)
         blockquoted_llm_explanation = add_blockquote_prefix(prompt)
-        code_prompt += f"**Details about the specific task assignment**\n"
-        code_prompt += f"Previously, in our chat, I shared the task assignment worded in my own words, and I asked you to reword it in your words, so I could ascertain if our understanding is aligned.\n"
-        code_prompt += f"Thank you for confirming your understanding. It is aligned with my own understanding and expectations.\n\n"
-        code_prompt += f"**My wording of the task**\n"
-        code_prompt += f"Here is the specific task assignment as worded using my words:\n\n"
-        code_prompt += f"{blockquoted_prompt}\n\n"
+        add_task_wording_section(code_prompt, blockquoted_prompt)
 
 #        # Task assignment wording by LLM
 #        code_prompt += f"**Your wording of the task**\n"
@@ -589,51 +696,36 @@ def generate_code_for_project(app_folder, prompt, language, main_file):
 #        code_prompt += f"#########################\n"
 
         # Technical architecture
-        code_prompt += f"**Technical architecture for the task**\n"
-        code_prompt += f"To guide you in specifics of the solution, here is the detailed technical architecture for the code solution, which represents the coding plan for the task assignment:\n"
-        code_prompt += f"{architecture_plan}\n"
-        code_prompt += f"#########################\n\n"
+        add_architecture_plan_section(code_prompt, architecture_plan)
 
         # Instructions
-        code_prompt += f"**Instructions for code review**\n"
-        code_prompt += f"Check the code for bugs. Often, it's simple things that cause problems. So, check all the obvious things, such as:\n"
-        code_prompt += f"When referencing functions from other modules, use fully qualified names (module_name.function_name) or ensure proper imports are in place.\n"
-        code_prompt += f"Always include complete and correct import statements at the beginning of each script.\n"
-        code_prompt += f"Verify the correct usage of data structures and their methods.\n"
-        code_prompt += f"Double-check all loop conditions and array indexing.\n"
+        code_prompt.section('review_instructions')
+        code_prompt.add(f"**Instructions for code review**\n")
+        code_prompt.add(f"Check the code for bugs. Often, it's simple things that cause problems. So, check all the obvious things, such as:\n")
+        code_prompt.add(f"When referencing functions from other modules, use fully qualified names (module_name.function_name) or ensure proper imports are in place.\n")
+        code_prompt.add(f"Always include complete and correct import statements at the beginning of each script.\n")
+        code_prompt.add(f"Verify the correct usage of data structures and their methods.\n")
+        code_prompt.add(f"Double-check all loop conditions and array indexing.\n")
+        if review_files is not None:
+            code_prompt.add(f"Review only the files shown in full. The other files are listed by signature so you can check calls into them; only return a file if you change it.\n")
 
-        code_prompt += f"#########################\n\n"
+        code_prompt.add(f"#########################\n\n")
 
 
-        code_prompt += f"**Task clarification**\n"
-        code_prompt += f"So, just to clarify what I need you to do: I suspect there are one or more bugs in the code. The code is very close to being correct, but I am worried there may be some minor errors. Please ruminate on the code, and consider every possible bug, and fix them.\n"
-        code_prompt += f"#########################\n\n"
+        code_prompt.add(f"**Task clarification**\n")
+        code_prompt.add(f"So, just to clarify what I need you to do: I suspect there are one or more bugs in the code. The code is very close to being correct, but I am worried there may be some minor errors. Please ruminate on the code, and consider every possible bug, and fix them.\n")
+        code_prompt.add(f"#########################\n\n")
 
         print("Performing code review")
 
         # Get response from LLM. This response contains the code.
-        response = multi_llm_request(code_prompt, logs_folder, include_markers=True)
+        code_prompt.log_section_sizes()
+        response = multi_llm_request(code_prompt.render(), logs_folder, include_markers=True, output_phase='review')
 
         code_blocks, doc_blocks, file_blocks = parse_llm_response(response)
 
-        if code_blocks:
-            for filename, code in code_blocks.items():
-                code_file_path = os.path.join(app_folder, filename)
-                with open(code_file_path, 'w', encoding='utf-8') as file:
-                    file.write(code)
-
-        if doc_blocks:
-            for filename, doc in doc_blocks.items():
-                doc_file_path = os.path.join(app_folder, filename)
-                with open(doc_file_path, 'w', encoding='utf-8') as file:
-                    file.write(doc)
-
-        if file_blocks:
-            for filename, file_content in file_blocks.items():
-                file_path = os.path.join(app_folder, filename)
-                with open(file_path, 'w', encoding='utf-8') as file:
-                    file.write(file_content)
-                print(f"Saved file to {file_path}")  # Debugging line
+        # Write code, docs and other files together; unchanged files are not touched
+        merge_change_sets(change_set, write_extracted_files(app_folder, {**code_blocks, **doc_blocks, **file_blocks}))
 
         break
 
@@ -642,6 +734,8 @@ def generate_code_for_project(app_folder, prompt, language, main_file):
     # Create documentation
     ###############################################################################
 
+    enter_phase('documentation')
+
     create_documentation = 0
 
     if (create_documentation == 1):
@@ -655,67 +749,19 @@ def generate_code_for_project(app_folder, prompt, language, main_file):
                 f"Context:\n{full_context_prompt}\n\n"
             )
     
-            response = multi_llm_request(doc_prompt, logs_folder, include_markers=False)
+            response = multi_llm_request(doc_prompt, logs_folder, include_markers=False, output_phase='documentation')
     
             documentation = response.strip()
     
             if documentation:
-                doc_file_path = os.path.join(app_folder, 'documentation.md')
-                with open(doc_file_path, 'w', encoding='utf-8') as file:
-                    file.write(documentation)
+                merge_change_sets(change_set, write_extracted_files(app_folder, {'documentation.md': documentation}))
                 break
             else:
                 print("No documentation was generated.")
 
-###############################################################################
-# This handles the compile to an EXE file
-###############################################################################
-def compile_to_exe(app_folder, main_file):
-
-    try:
-        # Run PyInstaller
-        subprocess.run(['pyinstaller', '--onefile', '--console', main_file], cwd=app_folder, check=True)
-        print(f"Successfully compiled {main_file} to executable.")
-
-        # Move the executable from the 'dist' folder to the project folder
-        exe_name = os.path.splitext(main_file)[0] + '.exe'
-        dist_path = os.path.join(app_folder, 'dist', exe_name)
-        project_path = os.path.join(app_folder, exe_name)
-        
-        shutil.move(dist_path, project_path)
-        print(f"Moved executable to {project_path}")
-
-        # Remove the 'dist' and 'build' folders
-        shutil.rmtree(os.path.join(app_folder, 'dist'))
-        shutil.rmtree(os.path.join(app_folder, 'build'))
-        os.remove(os.path.join(app_folder, f"{os.path.splitext(main_file)[0]}.spec"))
-        print("Cleaned up PyInstaller artifacts.")
-
-    except subprocess.CalledProcessError as e:
-        print(f"Error compiling to executable: {e}")
-    except FileNotFoundError:
-        print("PyInstaller not found. Please install it using 'pip install pyinstaller'.")
-    except Exception as e:
-        print(f"An error occurred during compilation or file moving: {e}")
-
-###############################################################################
-# We want a section of text to be preceived by the LLM as containing a quote, so we 
-# burst the string into lines, prefix each line with the > prefix on each line, 
-# then reassemble the lines into a string.
-###############################################################################
-def add_blockquote_prefix(input_string):
-
-    # Split the input string into a list of lines
-    lines = input_string.split('\n')
-    
-    # Prefix each line with '> '
-    prefixed_lines = ['> ' + line for line in lines]
-    
-    # Reassemble the list of lines into a single string with line feeds
-    result_string = '\n'.join(prefixed_lines)
-    
-    return result_string
+    enter_phase(None)
 
+    return change_set
 
 class FlexibleConfigParser(configparser.ConfigParser):
     def __init__(self, *args, **kwargs):
@@ -745,16 +791,13 @@ def get_project_name():
 
     print(f"Project: {project_name}")
 
-def main():
-
-    # What LLM do we normally prefer to use
-    get_preferred_llm()
-
-    # Determine project name
-    get_project_name()
+# Sets the project folders (app_folder, config_folder, logs_folder), creating them
+# and the project parameter file if needed, and returns the project settings
+def open_project(name):
 
     # Define folder paths
-    global app_folder, config_folder, logs_folder
+    global project_name, app_folder, config_folder, logs_folder
+    project_name  = name
     app_folder    = os.path.join(os.getcwd(), 'projects', project_name, 'files')
     config_folder = os.path.join(os.getcwd(), 'projects', project_name, 'config')
     logs_folder   = os.path.join(os.getcwd(), 'projects', project_name, 'llm_logs')
@@ -767,42 +810,91 @@ def main():
     # Create project parameter file if it does not exit
     parameters_file = os.path.join(config_folder, 'project_params.txt')
     if not os.path.exists(parameters_file):
-        file_content = f"project_name:{project_name}\nlanguage:python\nmain_file=main.py\ncompile:no\n"
+        file_content = f"project_name:{project_name}\nlanguage:python\nmain_file=main.py\ncompile:no\ncompile_background:no\n"
         with open(parameters_file, "w") as file: file.write(file_content)
 
-    # Read parameters from project parameters file
-    params          = read_params_file(parameters_file)
-    language        = params.get('language', 'python').lower()
-    main_file       = params.get('main_file', 'main.py')
-    compile_option  = params.get('compile', 'no').lower()
+    # Read parameters from project parameters file. Budget keys override those of config.txt.
+    params = read_params_file(parameters_file)
+    set_project_budgets(params)
+
+    settings = {}
+    settings['parameters_file']    = parameters_file
+    settings['task_file']          = os.path.join(config_folder, 'tasks.txt')
+    settings['language']           = params.get('language', 'python').lower()
+    settings['main_file']          = params.get('main_file', 'main.py')
+    settings['compile']            = params.get('compile', 'no').lower()
+    settings['compile_background'] = params.get('compile_background', 'no').lower() in ['yes', '1']
+    settings['package_targets']    = [t.strip() for t in params.get('package_targets', '').split(',') if t.strip()]
+    settings['measure_startup']    = params.get('package_measure_startup', 'no').lower() in ['yes', '1']
+
+    return settings
+
+# Generates the code for a task in the open project, and compiles it if the
+# project parameters ask for it. With confirm=False the LLM's understanding of
+# the task is accepted without asking (eg tasks run by the daemon).
+def run_task(task, settings, confirm=True):
+
+    reset_run_usage()
+
+    main_file_path = os.path.join(app_folder, settings['main_file'])
+    workspace_settings = get_workspace_settings()
+
+    # Generate code. With workspaces, the run works on its own copy of the files, which
+    # is merged back at the end; otherwise it holds the project lock throughout.
+    if workspace_settings['enabled']:
+        workspace = create_workspace(app_folder, workspace_settings)
+        try:
+            change_set = generate_code_for_project(workspace['folder'], task, settings['language'], main_file_path, confirm=confirm, backup=False,
+                                                   project_folder=os.path.dirname(app_folder))
+        except BaseException:
+            if not workspace_settings['keep']: remove_workspace(workspace)
+            raise
+
+        merge = finish_workspace(workspace, workspace_settings, before_merge=lambda: create_code_history_backup(app_folder))
+        change_set['conflicts'] = merge['conflicts']
+    else:
+        with project_lock(os.path.dirname(app_folder)):
+            change_set = generate_code_for_project(app_folder, task, settings['language'], main_file_path, confirm=confirm)
+
+    print(f"Files added: {len(change_set['added'])}, modified: {len(change_set['modified'])}, unchanged: {len(change_set['unchanged'])}")
+
+    # Compile code (if indicated in project parameter file)
+    if settings['compile'] in ['yes', '1']:
+
+        if os.path.exists(main_file_path):
+            with span('compile_to_exe'):
+                compile_to_exe(app_folder, settings['main_file'], background=settings['compile_background'],
+                               targets=settings['package_targets'], measure_startup=settings['measure_startup'])
+        else:
+            print(f"Main file {main_file_path} not found. Skipping compilation.")
+
+    return change_set
+
+def main():
+
+    # What LLM do we normally prefer to use
+    get_preferred_llm()
+
+    # Determine project name
+    get_project_name()
+
+    settings = open_project(project_name)
 
     # Read task file
-    task_file = os.path.join(config_folder, 'tasks.txt')
-    task = read_tasks_file(task_file)
+    task = claim_tasks(settings['task_file'])
 
-    print(f"Task file: {task_file}")
-    print(f"Parameters file: {parameters_file}")
-    print(f"Language: {language}")
-    print(f"Compile: {compile_option}")
-    print(f"Main file: {main_file}")
+    print(f"Task file: {settings['task_file']}")
+    print(f"Parameters file: {settings['parameters_file']}")
+    print(f"Language: {settings['language']}")
+    print(f"Compile: {settings['compile']}")
+    print(f"Main file: {settings['main_file']}")
 
     # If no tasks, then exit
     if not task:
         print("No new tasks found or all tasks are already processed in tasks.txt.")
         exit(0)
 
-    main_file_path = os.path.join(app_folder, main_file)
-
-    # Generate code
-    generate_code_for_project(app_folder, task, language, main_file_path)
-
-    # Compile code (if indicated in project parameter file)
-    if compile_option in ['yes', '1']:
-
-        if os.path.exists(main_file_path):
-            compile_to_exe(app_folder, main_file)
-        else:
-            print(f"Main file {main_file_path} not found. Skipping compilation.")
+    run_task(task, settings)
 
 
 
@@ -810,7 +902,16 @@ if __name__ == "__main__":
 
     setup_logging()
 
-    main()
+    # --profile[=spans|cprofile|sampling] writes a timing report to projects/<name>/profiles
+    profile_mode = get_profile_mode(sys.argv)
+    if profile_mode: start_profile(profile_mode)
+
+    try:
+        main()
+    finally:
+        if profile_mode:
+            project_folder = os.path.dirname(app_folder) if 'app_folder' in globals() else os.getcwd()
+            stop_profile(project_folder)
 
 
 
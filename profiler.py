@@ -0,0 +1,328 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Profiling for `python main.py <project> --profile[=mode]`. The phases of a
+# run and its main helpers are timed as nested spans. Two optional modes add
+# more detail: 'cprofile' runs cProfile on the main thread, and 'sampling'
+# samples the main thread's stack every few milliseconds.
+#
+# The report is written to projects/<name>/profiles/:
+#   <time>_phases.txt            phase and helper breakdown table
+#   <time>.speedscope.json       spans (and samples), for https://www.speedscope.app
+#   <time>.collapsed             collapsed stacks, for flamegraph.pl and similar tools
+#   <time>.pstats, <time>_functions.txt   with 'cprofile'
+#
+# When profiling is off, span() returns a shared no-op context manager, so
+# the hooks cost next to nothing.
+###############################################################################
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import functools
+from datetime import datetime
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+PROFILE_FOLDER   = 'profiles'
+PROFILE_MODES    = ('spans', 'cprofile', 'sampling')
+SAMPLE_INTERVAL  = 0.005   # Seconds between stack samples
+TOP_FUNCTIONS    = 40      # Functions listed from cProfile
+
+NO_SPAN = contextlib.nullcontext()
+
+class RunProfile:
+
+    def __init__(self, mode):
+        self.mode       = mode
+        self.start_time = time.perf_counter()
+        self.end_time   = None
+        self.events     = []    # (thread name, 'O' or 'C', span name, seconds since start)
+        self.lock       = threading.Lock()
+        self.phase      = None
+        self.samples    = {}    # Collapsed stack -> sample count
+        self.cprofile   = None
+        self.sampler    = None
+        self.stopping   = threading.Event()
+
+    def record(self, kind, name):
+        at = time.perf_counter() - self.start_time
+        with self.lock:
+            self.events.append((threading.current_thread().name, kind, name, at))
+
+active_profile = None
+
+###############################################################################
+# Hooks used by the rest of the code
+###############################################################################
+
+@contextlib.contextmanager
+def timed_span(profile, name):
+
+    profile.record('O', name)
+    try:
+        yield
+    finally:
+        profile.record('C', name)
+
+# Times the enclosed block as a span named 'name'
+def span(name):
+
+    if active_profile is None: return NO_SPAN
+    return timed_span(active_profile, name)
+
+# Decorator: times every call of the function as a span
+def profiled(name=None):
+
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if active_profile is None: return function(*args, **kwargs)
+            with timed_span(active_profile, span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+# Marks the start of a phase of the run; the previous phase ends here.
+# enter_phase(None) ends the current phase.
+def enter_phase(name):
+
+    profile = active_profile
+    if profile is None: return
+
+    if profile.phase: profile.record('C', profile.phase)
+    profile.phase = f"phase:{name}" if name else None
+    if profile.phase: profile.record('O', profile.phase)
+
+###############################################################################
+# Profiler control
+###############################################################################
+
+# Reads and removes --profile or --profile=<mode> from the command line.
+# Returns the mode, or None if profiling was not asked for.
+def get_profile_mode(argv):
+
+    for arg in list(argv[1:]):
+        if arg == '--profile' or arg.startswith('--profile='):
+            argv.remove(arg)
+            mode = arg.partition('=')[2] or 'spans'
+            if mode not in PROFILE_MODES:
+                print(f"Unknown profile mode '{mode}'. Use one of: {', '.join(PROFILE_MODES)}.")
+                sys.exit(1)
+            return mode
+
+    return None
+
+def sample_main_thread(profile, main_thread_id):
+
+    while not profile.stopping.wait(SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(main_thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            key = ';'.join(reversed(stack))
+            profile.samples[key] = profile.samples.get(key, 0) + 1
+
+def start_profile(mode):
+
+    global active_profile
+
+    active_profile = RunProfile(mode)
+
+    if mode == 'cprofile':
+        import cProfile
+        active_profile.cprofile = cProfile.Profile()
+        active_profile.cprofile.enable()
+
+    elif mode == 'sampling':
+        active_profile.sampler = threading.Thread(target=sample_main_thread, args=(active_profile, threading.get_ident()),
+                                                  name='profile-sampler', daemon=True)
+        active_profile.sampler.start()
+
+    print(f"Profiling this run ({mode}).")
+
+###############################################################################
+# Report
+###############################################################################
+
+# Completed spans per thread: (thread, name, start, end, stack of open span names)
+def collect_spans(events, end_time):
+
+    spans, open_spans = [], {}
+    for thread, kind, name, at in events:
+        stack = open_spans.setdefault(thread, [])
+        if kind == 'O':
+            stack.append((name, at))
+        elif stack:
+            while stack:
+                open_name, start = stack.pop()
+                spans.append((thread, open_name, start, at, [s[0] for s in stack]))
+                if open_name == name: break
+
+    # Spans still open when the run ended (eg sys.exit inside a phase)
+    for thread, stack in open_spans.items():
+        while stack:
+            open_name, start = stack.pop()
+            spans.append((thread, open_name, start, end_time, [s[0] for s in stack]))
+
+    return spans
+
+# (span, self seconds) pairs. Self time excludes the spans nested inside.
+def span_self_times(spans):
+
+    children = {}
+    for thread, name, start, end, parents in spans:
+        children.setdefault((thread, tuple(parents)), []).append((start, end))
+
+    self_times = []
+    for thread, name, start, end, parents in spans:
+        nested = sum(min(c_end, end) - max(c_start, start)
+                     for c_start, c_end in children.get((thread, tuple(parents + [name])), [])
+                     if c_start < end and c_end > start)
+        self_times.append(((thread, name, start, end, parents), (end - start) - nested))
+
+    return self_times
+
+# Name -> [calls, total seconds, self seconds]
+def summarize_spans(spans):
+
+    summary = {}
+    for (thread, name, start, end, parents), self_time in span_self_times(spans):
+        entry = summary.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += end - start
+        entry[2] += self_time
+
+    return summary
+
+def format_phase_table(summary, wall_time):
+
+    lines = [f"Run time: {wall_time:.2f} s", '',
+             f"{'Span':<36}{'Calls':>7}{'Total (s)':>12}{'Self (s)':>12}{'% of run':>10}"]
+
+    ordered = sorted(summary.items(), key=lambda item: (not item[0].startswith('phase:'), -item[1][1]))
+    for name, (calls, total, self_time) in ordered:
+        lines.append(f"{name:<36}{calls:>7}{total:>12.3f}{self_time:>12.3f}{100 * total / wall_time if wall_time else 0:>9.1f}%")
+
+    lines.append('')
+    lines.append("Spans in worker threads (eg parallel LLM calls) overlap, so totals can exceed the run time.")
+    return '\n'.join(lines) + '\n'
+
+def build_speedscope(profile, wall_time, run_name):
+
+    frames, frame_index = [], {}
+    def frame(name):
+        if name not in frame_index:
+            frame_index[name] = len(frames)
+            frames.append({'name': name})
+        return frame_index[name]
+
+    profiles = []
+    threads = []
+    for thread, kind, name, at in profile.events:
+        if thread not in threads: threads.append(thread)
+
+    for thread in threads:
+        events, depth = [], []
+        for event_thread, kind, name, at in profile.events:
+            if event_thread != thread: continue
+            if kind == 'O':
+                depth.append(name)
+                events.append({'type': 'O', 'frame': frame(name), 'at': at})
+            elif name in depth:
+                while depth:
+                    open_name = depth.pop()
+                    events.append({'type': 'C', 'frame': frame(open_name), 'at': at})
+                    if open_name == name: break
+        while depth:
+            events.append({'type': 'C', 'frame': frame(depth.pop()), 'at': wall_time})
+        profiles.append({'type': 'evented', 'name': f"spans: {thread}", 'unit': 'seconds',
+                         'startValue': 0, 'endValue': wall_time, 'events': events})
+
+    if profile.samples:
+        samples, weights = [], []
+        for stack, count in profile.samples.items():
+            samples.append([frame(name) for name in stack.split(';')])
+            weights.append(count * SAMPLE_INTERVAL)
+        profiles.append({'type': 'sampled', 'name': 'samples: MainThread', 'unit': 'seconds',
+                         'startValue': 0, 'endValue': sum(weights), 'samples': samples, 'weights': weights})
+
+    return {'$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'shared': {'frames': frames}, 'profiles': profiles, 'name': run_name, 'exporter': 'firebird'}
+
+# Collapsed stacks: stack samples if there are any, otherwise the spans weighted
+# by their self time in milliseconds
+def build_collapsed(profile, spans):
+
+    if profile.samples:
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(profile.samples.items()))
+
+    weights = {}
+    for (thread, name, start, end, parents), self_time in span_self_times(spans):
+        key = ';'.join([thread] + parents + [name])
+        weights[key] = weights.get(key, 0) + self_time
+
+    return ''.join(f"{stack} {round(seconds * 1000)}\n" for stack, seconds in sorted(weights.items()) if round(seconds * 1000) > 0)
+
+# Stops profiling and writes the report into project_folder/profiles.
+# Returns the path of the phase table.
+def stop_profile(project_folder):
+
+    global active_profile
+
+    profile = active_profile
+    if profile is None: return None
+
+    enter_phase(None)
+    active_profile = None
+
+    profile.end_time = time.perf_counter()
+    wall_time = profile.end_time - profile.start_time
+
+    if profile.cprofile: profile.cprofile.disable()
+    if profile.sampler:
+        profile.stopping.set()
+        profile.sampler.join()
+
+    profile_folder = os.path.join(project_folder, PROFILE_FOLDER)
+    os.makedirs(profile_folder, exist_ok=True)
+    run_name = datetime.now().strftime("%Y%m%d_%H%M%S")
+    base_path = os.path.join(profile_folder, run_name)
+
+    spans = collect_spans(profile.events, wall_time)
+
+    table_path = base_path + '_phases.txt'
+    with open(table_path, 'w', encoding='utf-8') as f:
+        f.write(format_phase_table(summarize_spans(spans), wall_time))
+
+    with open(base_path + '.speedscope.json', 'w', encoding='utf-8') as f:
+        json.dump(build_speedscope(profile, wall_time, run_name), f)
+
+    with open(base_path + '.collapsed', 'w', encoding='utf-8') as f:
+        f.write(build_collapsed(profile, spans))
+
+    if profile.cprofile:
+        import pstats
+        profile.cprofile.dump_stats(base_path + '.pstats')
+        with open(base_path + '_functions.txt', 'w', encoding='utf-8') as f:
+            pstats.Stats(profile.cprofile, stream=f).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+
+    print(f"Profile written to {profile_folder} ({run_name}_*)")
+    return table_path
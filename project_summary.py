@@ -0,0 +1,274 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module summarizes projects too large to fit in one prompt. Each file is
+# summarized, then the file summaries of each package (folder), then the
+# package summaries into one for the whole project. Requests at each level
+# run in parallel, spread across the panel providers. Summaries are cached in
+# projects/<name>/summary_cache, keyed by a hash of their input, so only the
+# files changed since the last run (and the levels above them) are
+# summarized again.
+###############################################################################
+
+import os
+import hashlib
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+
+import api_caller
+from llm_router import choose_panel, get_model_for_role, estimate_tokens, call_within_budget, CHARS_PER_TOKEN
+from symbol_index import list_project_files, read_project_file, update_symbol_index
+from profiler import profiled
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+SUMMARY_CACHE_FOLDER = 'summary_cache'
+SUMMARY_VERSION      = '1'    # Part of every cache key; change it when the prompts change
+VERBATIM_CHARS       = 400    # Files this small are used as their own summary
+
+def get_summarization_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Summarization'] if 'Summarization' in config else {}
+
+    settings = {}
+    settings['enabled']              = section.get('enabled', 'yes').lower() in ['yes', '1']
+    settings['min_bundle_tokens']    = int(section.get('min_bundle_tokens', '60000'))
+    settings['max_input_tokens']     = int(section.get('max_input_tokens', '24000'))
+    settings['workers_per_provider'] = int(section.get('workers_per_provider', '2'))
+
+    return settings
+
+###############################################################################
+# Cache. One text file per summary, named by the hash of its inputs.
+###############################################################################
+
+# In the project folder: the parent of the files folder unless given (see symbol_index.get_index_path)
+def get_summary_cache_folder(app_folder, project_folder=None):
+
+    project_folder = project_folder or os.path.dirname(os.path.normpath(app_folder))
+    cache_folder   = os.path.join(project_folder, SUMMARY_CACHE_FOLDER)
+    os.makedirs(cache_folder, exist_ok=True)
+
+    return cache_folder
+
+def summary_key(level, name, text):
+
+    hasher = hashlib.sha256()
+    for part in (SUMMARY_VERSION, level, name, text):
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\0')
+
+    return f"{level}_{hasher.hexdigest()}"
+
+def read_cached_summary(cache_folder, key):
+
+    cache_path = os.path.join(cache_folder, key + '.txt')
+    if not os.path.exists(cache_path): return None
+
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def write_cached_summary(cache_folder, key, summary):
+
+    cache_path = os.path.join(cache_folder, key + '.txt')
+    temp_path  = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(summary)
+    os.replace(temp_path, cache_path)
+
+###############################################################################
+# Prompts
+###############################################################################
+
+def build_file_summary_prompt(path, content, signatures, max_chars):
+
+    prompt  = f"Summarize the project file below for a programmer who will change this project but cannot see the file.\n"
+    prompt += f"Describe its purpose, its main functions and classes and what they do, the data it reads or writes, and which other files it depends on.\n"
+    prompt += f"Keep the summary under 200 words. Reply with the summary only.\n\n"
+
+    if signatures:
+        prompt += f"Signatures in the file:\n" + ''.join(f"    {line}\n" for line in signatures) + "\n"
+
+    if len(content) > max_chars:
+        prompt += f"The file is long; here are its first {max_chars} characters.\n"
+        content = content[:max_chars]
+
+    prompt += f"File: {path}\n\n{content}\n"
+
+    return prompt
+
+def build_reduce_prompt(level, name, items):
+
+    if level == 'package':
+        prompt  = f"Below are summaries of the files in the folder '{name}' of a software project.\n"
+        prompt += f"Combine them into one summary of the folder: what it is for, its main modules and how they fit together, and its main entry points.\n"
+    else:
+        prompt  = f"Below are summaries of the folders of a software project.\n"
+        prompt += f"Combine them into one overview of the project: what it does, how it is organized, and how the parts depend on each other.\n"
+    prompt += f"Keep it under 400 words. Reply with the summary only.\n\n"
+
+    for label, text in items:
+        prompt += f"### {label}\n{text}\n\n"
+
+    return prompt
+
+###############################################################################
+# Requests. Each request is (key, prompt, fallback). Requests are spread
+# round-robin over the panel; if a provider returns nothing, the next one is
+# tried, and the fallback text is used if none answers or the run's budget
+# has no room for the request.
+###############################################################################
+def run_summary_requests(requests, panel_list, logs_folder, cache_folder, settings):
+
+    def summarize(number, request):
+        key, prompt, fallback = request
+        if not call_within_budget(prompt, 'summary', api_caller.get_output_options('summary', None).get('max_tokens', 0)): return fallback
+        for offset in range(len(panel_list)):
+            llm_name = panel_list[(number + offset) % len(panel_list)]
+            response = api_caller.call_llm_with_logging(prompt, logs_folder, llm_name, include_markers=False,
+                                                        model=get_model_for_role(llm_name, 'summary'),
+                                                        call_options=api_caller.get_output_options('summary', llm_name),
+                                                        phase='summary', role='summary')
+            if response and response.strip():
+                write_cached_summary(cache_folder, key, response.strip())
+                return response.strip()
+        return fallback
+
+    if not requests: return []
+    if not panel_list: return [fallback for _, _, fallback in requests]
+
+    workers = max(1, len(panel_list) * settings['workers_per_provider'])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(summarize, range(len(requests)), requests))
+
+# Splits (label, text) items into batches of at most max_tokens (estimated)
+def split_into_batches(items, max_tokens):
+
+    batches, batch, batch_tokens = [], [], 0
+    for item in items:
+        item_tokens = estimate_tokens(item[1])
+        if batch and batch_tokens + item_tokens > max_tokens:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += item_tokens
+    if batch: batches.append(batch)
+
+    return batches
+
+# Summarizes, from cache or by request, each (key, prompt, fallback) of a level
+def summarize_level(requests, panel_list, logs_folder, cache_folder, settings):
+
+    summaries = [read_cached_summary(cache_folder, key) for key, _, _ in requests]
+    missing   = [n for n, summary in enumerate(summaries) if summary is None]
+
+    logger.info(f"Summaries: {len(requests) - len(missing)} cached, {len(missing)} to request")
+
+    results = run_summary_requests([requests[n] for n in missing], panel_list, logs_folder, cache_folder, settings)
+    for n, summary in zip(missing, results): summaries[n] = summary
+
+    return summaries
+
+###############################################################################
+# Reduces groups of (label, summary) items to one summary per group. A group
+# too large for one request is first reduced in batches, in parallel with the
+# batches of the other groups, until it fits. A group of one item is used as
+# it is.
+###############################################################################
+def reduce_groups(level, groups, panel_list, logs_folder, cache_folder, settings):
+
+    groups = dict(groups)
+
+    while True:
+        batch_requests, batch_owners = [], []
+        for name, items in groups.items():
+            batches = split_into_batches(items, settings['max_input_tokens'])
+            if len(batches) == 1 or len(batches) == len(items): continue  # Fits, or cannot shrink further
+            for number, batch in enumerate(batches):
+                prompt = build_reduce_prompt(level, name, batch)
+                batch_requests.append((summary_key(level, name, prompt), prompt, '\n'.join(text for _, text in batch)))
+                batch_owners.append((name, f"{name} (part {number + 1})"))
+        if not batch_requests: break
+
+        summaries = summarize_level(batch_requests, panel_list, logs_folder, cache_folder, settings)
+        for name in set(owner for owner, _ in batch_owners): groups[name] = []
+        for (name, label), summary in zip(batch_owners, summaries): groups[name].append((label, summary))
+
+    reduced, requests, names = {}, [], []
+    for name, items in groups.items():
+        if len(items) == 1:
+            reduced[name] = items[0][1]
+            continue
+        prompt = build_reduce_prompt(level, name, items)
+        requests.append((summary_key(level, name, prompt), prompt, '\n'.join(text for _, text in items)))
+        names.append(name)
+
+    for name, summary in zip(names, summarize_level(requests, panel_list, logs_folder, cache_folder, settings)):
+        reduced[name] = summary
+
+    return reduced
+
+###############################################################################
+# Summarizes the project (file -> package -> project) and returns the text to
+# use as context: the project overview followed by the package summaries, or
+# the overview alone if the package summaries are too long.
+###############################################################################
+@profiled()
+def create_project_summary(app_folder, logs_folder, panel_size=3, project_folder=None):
+
+    settings     = get_summarization_settings()
+    cache_folder = get_summary_cache_folder(app_folder, project_folder)
+    index        = update_symbol_index(app_folder, project_folder)
+
+    api_caller.get_all_llm_info()
+    panel_list = choose_panel(api_caller.all_llm_list, logs_folder, panel_size)
+
+    print(f"Summarizing the project with {', '.join(panel_list) or 'no LLMs'}...")
+
+    # Files
+    max_chars = settings['max_input_tokens'] * CHARS_PER_TOKEN
+    file_items, requests, request_paths = {}, [], []
+    for path in list_project_files(app_folder):
+        content = read_project_file(app_folder, path)
+        entry   = index['files'][path]
+
+        if len(content) <= VERBATIM_CHARS:
+            file_items[path] = content
+            continue
+
+        signatures = [('    ' * symbol['qualname'].count('.')) + symbol['signature'] for symbol in entry['symbols']]
+        prompt = build_file_summary_prompt(path, content, signatures, max_chars)
+        requests.append((summary_key('file', path, entry['hash']), prompt, '\n'.join(signatures) or f"({len(content)} characters)"))
+        request_paths.append(path)
+
+    for path, summary in zip(request_paths, summarize_level(requests, panel_list, logs_folder, cache_folder, settings)):
+        file_items[path] = summary
+
+    # Packages
+    packages = {}
+    for path in sorted(file_items):
+        packages.setdefault(os.path.dirname(path) or '.', []).append((path, file_items[path]))
+    package_summaries = reduce_groups('package', packages, panel_list, logs_folder, cache_folder, settings)
+
+    # Project
+    project_items = [(name, package_summaries[name]) for name in sorted(package_summaries)]
+    project_summary = reduce_groups('project', {'project': project_items}, panel_list, logs_folder, cache_folder, settings)['project']
+
+    context = f"Project overview:\n{project_summary}\n"
+    packages_text = ''.join(f"\n### Folder: {name}\n{summary}\n" for name, summary in project_items)
+    if len(project_items) > 1 and estimate_tokens(packages_text) <= settings['max_input_tokens']:
+        context += packages_text
+
+    return context
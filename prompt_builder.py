@@ -0,0 +1,77 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module assembles prompts from named sections. Each section is a list of
+# string segments; large shared segments such as the code bundle are held by
+# reference, not copied, and the prompt is joined into one string only when
+# it is rendered. Section sizes can be reported to see where a prompt's bytes
+# and tokens go.
+###############################################################################
+
+from llm_router import estimate_tokens
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+# Size in bytes of a string once encoded as UTF-8, without encoding ASCII text
+def utf8_size(text):
+
+    if text.isascii(): return len(text)
+    return len(text.encode('utf-8'))
+
+class PromptBuilder:
+
+    def __init__(self, name='prompt'):
+        self.name     = name
+        self.sections = []   # List of (section name, list of segments)
+        self.rendered = None
+
+    # Starts a new named section. Later add() calls go into it.
+    def section(self, section_name):
+        self.sections.append((section_name, []))
+        return self
+
+    # Appends text to the current section
+    def add(self, text):
+        if not self.sections: self.section('main')
+        self.sections[-1][1].append(text)
+        self.rendered = None
+        return self
+
+    # Joins every segment into the prompt string, once
+    def render(self):
+        if self.rendered is None:
+            self.rendered = ''.join(segment for section_name, segments in self.sections for segment in segments)
+        return self.rendered
+
+    # List of (section name, bytes, estimated tokens)
+    def section_sizes(self):
+
+        sizes = []
+        for section_name, segments in self.sections:
+            size_bytes  = sum(utf8_size(segment) for segment in segments)
+            size_tokens = sum(estimate_tokens(segment) for segment in segments)
+            sizes.append((section_name, size_bytes, size_tokens))
+
+        return sizes
+
+    def log_section_sizes(self):
+
+        sizes = self.section_sizes()
+        total_bytes  = sum(size[1] for size in sizes)
+        total_tokens = sum(size[2] for size in sizes)
+
+        lines = [f"Prompt '{self.name}': {total_bytes} bytes, ~{total_tokens} tokens"]
+        for section_name, size_bytes, size_tokens in sizes:
+            lines.append(f"  {section_name:<28}{size_bytes:>12} bytes{size_tokens:>10} tokens")
+
+        logger.info('\n'.join(lines))
+
+    def __len__(self):
+        return sum(len(segment) for section_name, segments in self.sections for segment in segments)
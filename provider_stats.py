@@ -0,0 +1,159 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module keeps a history of our own LLM calls for each provider (latency,
+# success/failure, and how often its answer won the panel vote), stored as
+# provider_stats.json in the project's llm_logs folder. The history is used to
+# decide when a call is running slow and which providers sit on the panel.
+#
+# Several processes may share one file (the daemon, workers, concurrent runs),
+# so each update re-reads the file under an OS file lock (see workspace.py)
+# before saving, and reads pick up the file again when another process has
+# changed it.
+###############################################################################
+
+import os
+import json
+import math
+import tempfile
+import threading
+import contextlib
+
+from workspace import lock_file, unlock_file
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+STATS_FILE  = 'provider_stats.json'
+LOCK_FILE   = 'provider_stats.lock'
+MAX_SAMPLES = 200  # Latency samples kept per provider
+
+# Stats already loaded in this process, keyed by folder, with the file's
+# modification time when they were read
+loaded_stats = {}
+loaded_times = {}
+stats_lock   = threading.Lock()
+
+def new_provider_entry():
+    return {'latencies': [], 'calls': 0, 'errors': 0, 'panels': 0, 'wins': 0}
+
+###############################################################################
+# Loads the stats for a folder, reading the file again only when it has
+# changed since it was last read
+###############################################################################
+def load_provider_stats(stats_folder):
+
+    stats_path = os.path.join(stats_folder, STATS_FILE)
+
+    try:
+        modified = os.stat(stats_path).st_mtime_ns
+    except OSError:
+        modified = None
+
+    if stats_folder in loaded_stats and loaded_times.get(stats_folder) == modified: return loaded_stats[stats_folder]
+
+    stats = {}
+    if modified is not None:
+        try:
+            with open(stats_path, 'r', encoding='utf-8') as f:
+                stats = json.load(f)
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not read {stats_path}: {e}. Starting a new history.")
+
+    loaded_stats[stats_folder] = stats
+    loaded_times[stats_folder] = modified
+    return stats
+
+def save_provider_stats(stats_folder):
+
+    stats_path = os.path.join(stats_folder, STATS_FILE)
+    descriptor, temp_path = tempfile.mkstemp(dir=stats_folder, prefix=STATS_FILE + '.', suffix='.tmp')
+
+    with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+        json.dump(loaded_stats[stats_folder], f, indent=2)
+    os.replace(temp_path, stats_path)
+
+    loaded_times[stats_folder] = os.stat(stats_path).st_mtime_ns
+
+# Holds this process's lock and the folder's file lock while the stats are
+# read, changed and saved, so no other process's update is lost. Yields the
+# stats as they are on disk.
+@contextlib.contextmanager
+def updating_provider_stats(stats_folder):
+
+    with stats_lock:
+        with open(os.path.join(stats_folder, LOCK_FILE), 'a+') as lock:
+            lock_file(lock, blocking=True)
+            try:
+                loaded_stats.pop(stats_folder, None)
+                yield load_provider_stats(stats_folder)
+                save_provider_stats(stats_folder)
+            finally:
+                unlock_file(lock)
+
+###############################################################################
+# Records the outcome of one call. Only successful calls add a latency sample.
+###############################################################################
+def record_call(stats_folder, llm_name, latency, success):
+
+    with updating_provider_stats(stats_folder) as stats:
+        entry = stats.setdefault(llm_name, new_provider_entry())
+
+        entry['calls'] += 1
+        if success:
+            entry['latencies'].append(round(latency, 3))
+            del entry['latencies'][:-MAX_SAMPLES]
+        else:
+            entry['errors'] += 1
+
+###############################################################################
+# Returns the given latency percentile for a provider, or None when there are
+# fewer than min_samples calls on record to base it on.
+###############################################################################
+def get_latency_percentile(stats_folder, llm_name, percentile=95, min_samples=20):
+
+    with stats_lock:
+        entry = load_provider_stats(stats_folder).get(llm_name, new_provider_entry())
+        latencies = sorted(entry['latencies'])
+
+    if len(latencies) < max(min_samples, 1): return None
+
+    # Nearest-rank percentile
+    rank = math.ceil(percentile / 100 * len(latencies))
+    return latencies[max(rank, 1) - 1]
+
+###############################################################################
+# Records the result of a panel vote: every panelist sat on the panel, and the
+# provider whose candidate got the most votes won it.
+###############################################################################
+def record_vote_result(stats_folder, panel_list, winner_llm_name):
+
+    with updating_provider_stats(stats_folder) as stats:
+        for llm_name in panel_list:
+            entry = stats.setdefault(llm_name, new_provider_entry())
+            entry['panels'] = entry.get('panels', 0) + 1
+            if llm_name == winner_llm_name: entry['wins'] = entry.get('wins', 0) + 1
+
+###############################################################################
+# Summary figures for one provider. Rates are smoothed towards neutral values,
+# so a provider with little history is neither favoured nor written off.
+###############################################################################
+def get_provider_summary(stats_folder, llm_name):
+
+    with stats_lock:
+        entry = dict(new_provider_entry(), **load_provider_stats(stats_folder).get(llm_name, {}))
+        latencies = list(entry['latencies'])
+
+    summary = {}
+    summary['calls']        = entry['calls']
+    summary['mean_latency'] = sum(latencies) / len(latencies) if latencies else None
+    summary['error_rate']   = entry['errors'] / (entry['calls'] + 2)
+    summary['win_rate']     = (entry['wins'] + 1) / (entry['panels'] + 2)
+
+    return summary
@@ -0,0 +1,193 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module is a similarity-based cache of past LLM responses, stored in the
+# project's response_cache folder. Prompts are compared with a MinHash-style
+# bottom-k sketch of their shingles, so a prompt that differs only by a
+# reworded task line or changed whitespace can still reuse a prior response.
+#
+# Concurrent runs, the daemon and workers may share a project's cache, so the
+# index is re-read and saved under an OS file lock (see workspace.py), and
+# files are written under unique temp names and moved into place.
+###############################################################################
+
+import re
+import os
+import json
+import zlib
+import hashlib
+import tempfile
+import threading
+import contextlib
+from datetime import datetime
+
+from workspace import lock_file, unlock_file
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+CACHE_FOLDER     = 'response_cache'
+INDEX_FILE       = 'index.json'
+LOCK_FILE        = 'index.lock'
+SIGNATURE_SIZE   = 128  # Number of smallest shingle hashes kept per prompt
+SHINGLE_WORDS    = 3    # Words per shingle
+CHAR_SHINGLE     = 4    # Characters per shingle for short texts
+SHORT_TEXT_WORDS = 50   # Texts with fewer words use character shingles
+MAX_ENTRIES      = 500  # Oldest entries are dropped beyond this
+
+cache_lock = threading.Lock()
+
+###############################################################################
+# The cache lives beside the llm_logs folder (projects/<name>/response_cache)
+###############################################################################
+def get_response_cache_folder(logs_folder):
+
+    cache_folder = os.path.join(os.path.dirname(os.path.normpath(logs_folder)), CACHE_FOLDER)
+    os.makedirs(cache_folder, exist_ok=True)
+
+    return cache_folder
+
+###############################################################################
+# Signatures. Text is lower-cased and reduced to its words (dropping
+# punctuation and whitespace differences), cut into overlapping shingles, and
+# the smallest shingle hashes are kept. Short texts such as a task line use
+# character shingles, so one changed word doesn't sink the similarity.
+###############################################################################
+def compute_signature(text):
+
+    words      = re.findall(r'\w+', (text or '').lower())
+    normalized = ' '.join(words)
+
+    if len(words) < SHORT_TEXT_WORDS:
+        shingles = (normalized[i:i + CHAR_SHINGLE] for i in range(max(len(normalized) - CHAR_SHINGLE + 1, 1)))
+    else:
+        shingles = (' '.join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1))
+
+    hashes = {zlib.crc32(shingle.encode('utf-8')) for shingle in shingles}
+
+    return sorted(hashes)[:SIGNATURE_SIZE]
+
+# Estimated Jaccard similarity of the two shingle sets (0.0 to 1.0)
+def estimate_similarity(signature_a, signature_b):
+
+    if not signature_a or not signature_b: return 0.0
+
+    set_a, set_b = set(signature_a), set(signature_b)
+    union_sketch = sorted(set_a | set_b)[:SIGNATURE_SIZE]
+    shared       = sum(1 for h in union_sketch if h in set_a and h in set_b)
+
+    return shared / len(union_sketch)
+
+###############################################################################
+# Index of cached responses
+###############################################################################
+def load_index(cache_folder):
+
+    index_path = os.path.join(cache_folder, INDEX_FILE)
+    if not os.path.exists(index_path): return []
+
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, OSError) as e:
+        logger.warning(f"Could not read {index_path}: {e}. Starting a new response cache.")
+        return []
+
+# Writes a file in the cache folder through a unique temp file
+def write_cache_file(cache_folder, file_name, write):
+
+    descriptor, temp_path = tempfile.mkstemp(dir=cache_folder, prefix=file_name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f: write(f)
+        os.replace(temp_path, os.path.join(cache_folder, file_name))
+    except BaseException:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        raise
+
+def save_index(cache_folder, entries):
+
+    write_cache_file(cache_folder, INDEX_FILE, lambda f: json.dump(entries, f))
+
+# Holds this process's lock and the folder's file lock while the index is
+# read, changed and saved, so no other process's entries are lost. Yields the
+# entries as they are on disk; the list is saved as the block leaves it.
+@contextlib.contextmanager
+def updating_index(cache_folder):
+
+    with cache_lock:
+        with open(os.path.join(cache_folder, LOCK_FILE), 'a+') as lock:
+            lock_file(lock, blocking=True)
+            try:
+                entries = load_index(cache_folder)
+                yield entries
+                save_index(cache_folder, entries)
+            finally:
+                unlock_file(lock)
+
+###############################################################################
+# Finds the most similar cached response for this phase, LLM and role. Both
+# the whole prompt and the anchor text (eg the task wording) must reach the
+# threshold, so a small change to the task inside a large code bundle is not
+# mistaken for the same request. Entries stored without a role may be
+# reflections or votes, and are not used. Returns (response, similarity) or
+# (None, 0.0).
+###############################################################################
+def find_similar_response(cache_folder, phase, llm_name, signature, anchor_signature, threshold, role):
+
+    with cache_lock:
+        entries = load_index(cache_folder)
+
+    best_entry, best_similarity = None, 0.0
+
+    for entry in entries:
+        if entry['phase'] != phase or entry['llm_name'] != llm_name or entry.get('role') != role: continue
+
+        similarity = min(estimate_similarity(signature, entry['signature']),
+                         estimate_similarity(anchor_signature, entry['anchor_signature']))
+
+        if similarity >= threshold and similarity > best_similarity:
+            best_entry, best_similarity = entry, similarity
+
+    if best_entry is None: return None, 0.0
+
+    response_path = os.path.join(cache_folder, best_entry['response_file'])
+    if not os.path.exists(response_path): return None, 0.0
+
+    with open(response_path, 'r', encoding='utf-8') as f:
+        return f.read(), best_similarity
+
+###############################################################################
+# Adds a response to the cache
+###############################################################################
+def store_response(cache_folder, phase, llm_name, prompt, signature, anchor_signature, response, role):
+
+    prompt_hash   = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    response_file = f"{phase}_{role}_{llm_name}_{prompt_hash[:16]}.txt"
+
+    with updating_index(cache_folder) as entries:
+        write_cache_file(cache_folder, response_file, lambda f: f.write(response))
+        entries[:] = [e for e in entries if e['response_file'] != response_file]
+
+        entries.append({
+            'phase':            phase,
+            'llm_name':         llm_name,
+            'role':             role,
+            'prompt_hash':      prompt_hash,
+            'signature':        signature,
+            'anchor_signature': anchor_signature,
+            'response_file':    response_file,
+            'created':          datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        })
+
+        # Drop the oldest entries (and their response files) beyond the limit
+        for old_entry in entries[:-MAX_ENTRIES]:
+            old_path = os.path.join(cache_folder, old_entry['response_file'])
+            if os.path.exists(old_path): os.remove(old_path)
+
+        del entries[:-MAX_ENTRIES]
@@ -0,0 +1,88 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module builds the code bundle for the review phase. Instead of every
+# file in the project, the review sees the files changed by the current task
+# and the files that directly import them, in full. The remaining code files
+# are listed by their signatures only, and other files by name. Imports and
+# signatures come from the project's symbol index.
+###############################################################################
+
+import os
+import configparser
+
+from symbol_index import CODE_EXTENSIONS, list_project_files, read_project_file, module_name, update_symbol_index
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+# The architecture plan has its own prompt section
+EXCLUDED_FILES = ('technical_architecture.txt',)
+
+def get_review_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Review'] if 'Review' in config else {}
+
+    settings = {}
+    settings['scope'] = section.get('scope', 'changed').strip().lower()
+
+    return settings
+
+# True if the indexed file imports one of the changed files
+def imports_any(entry, changed_paths):
+
+    if entry['language'] == 'python':
+        changed_modules = [module_name(path) for path in changed_paths if path.endswith('.py')]
+        return any(name == module or name.startswith(module + '.') for name in entry['imports'] for module in changed_modules)
+
+    # Other languages: an imported name ending in the changed file's name
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in changed_paths]
+    return any(stem in name.split('.') for name in entry['imports'] for stem in stems)
+
+def file_signatures(entry):
+
+    return [('    ' * symbol['qualname'].count('.')) + symbol['signature'] for symbol in entry['symbols']]
+
+###############################################################################
+# Builds the review bundle. Returns the bundle and the list of files it holds
+# in full; the list is empty when the task changed no reviewable files.
+###############################################################################
+def create_review_bundle(app_folder, changed_paths, project_folder=None):
+
+    index = update_symbol_index(app_folder, project_folder)
+    project_files = [path for path in list_project_files(app_folder) if os.path.basename(path) not in EXCLUDED_FILES]
+
+    in_scope = [path for path in project_files if path in changed_paths]
+    if not in_scope:
+        return '', []
+
+    importers = [path for path in project_files
+                 if path not in in_scope and path.endswith(CODE_EXTENSIONS) and imports_any(index['files'][path], in_scope)]
+
+    review_bundle = ''
+    for path in in_scope:
+        review_bundle += f"\n\n---\n\nFile: {path} (changed in this task)\n\n{read_project_file(app_folder, path)}\n\n"
+    for path in importers:
+        review_bundle += f"\n\n---\n\nFile: {path} (imports a changed file)\n\n{read_project_file(app_folder, path)}\n\n"
+
+    others = [path for path in project_files if path not in in_scope and path not in importers]
+    if others:
+        review_bundle += f"\n\n---\n\nOther project files, not changed in this task (signatures only):\n"
+        for path in others:
+            if path.endswith(CODE_EXTENSIONS):
+                review_bundle += f"\nFile: {path}\n" + ''.join(f"    {line}\n" for line in file_signatures(index['files'][path]))
+            else:
+                review_bundle += f"\nFile: {path} (contents not shown)\n"
+
+    logger.info(f"Review scope: {len(in_scope)} changed, {len(importers)} importing, {len(others)} summarized")
+
+    return review_bundle, in_scope + importers
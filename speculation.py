@@ -0,0 +1,79 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Speculative requests (opt-in). A request whose prompt is already known can
+# start in a background thread while the user is still reading the previous
+# response, eg the architecture request while the understanding waits for
+# confirmation. If the user declines, the request is cancelled: its call in
+# flight is aborted (with the async adapters) and no further calls are made.
+###############################################################################
+
+import threading
+import configparser
+
+from api_caller import set_cancel_event, RequestCancelled
+from profiler import span
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+CANCEL_WAIT = 2   # Seconds to wait for a cancelled request to stop
+
+def get_speculation_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Speculation'] if 'Speculation' in config else {}
+
+    settings = {}
+    settings['architecture'] = section.get('architecture', 'no').lower() in ['yes', '1']
+
+    return settings
+
+class SpeculativeRequest:
+
+    def __init__(self, name, function, args, kwargs):
+        self.name         = name
+        self.response     = None
+        self.cancel_event = threading.Event()
+        self.thread       = threading.Thread(target=self.run, args=(function, args, kwargs),
+                                             name=f"speculative-{name}", daemon=True)
+
+    def run(self, function, args, kwargs):
+
+        set_cancel_event(self.cancel_event)
+        try:
+            with span(f"speculative:{self.name}"):
+                self.response = function(*args, **kwargs)
+        except RequestCancelled:
+            logger.info(f"Speculative {self.name} request cancelled.")
+        except Exception as e:
+            logger.error(f"Speculative {self.name} request failed: {e}")
+
+    # Waits for the request. Returns its response, or None if it failed.
+    def result(self):
+
+        self.thread.join()
+        return self.response
+
+    # Cancels the request and waits briefly for its call in flight to be aborted
+    def cancel(self):
+
+        self.cancel_event.set()
+        self.thread.join(CANCEL_WAIT)
+
+# Starts function(*args, **kwargs) in a background thread
+def start_speculative_request(name, function, *args, **kwargs):
+
+    request = SpeculativeRequest(name, function, args, kwargs)
+    request.thread.start()
+    logger.info(f"Started speculative {name} request.")
+
+    return request
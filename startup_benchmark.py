@@ -0,0 +1,85 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Startup benchmark. Imports main.py under "python -X importtime" several
+# times, reports the slowest imports, and exits with an error if a provider
+# SDK is imported at startup or the median import time is over budget.
+#
+# Usage: python startup_benchmark.py [--runs N] [--max-ms MS]
+###############################################################################
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+# Modules that must only be imported when a provider is first called
+LAZY_MODULES = ('openai', 'google.generativeai', 'groq', 'requests', 'httpx')
+
+###############################################################################
+# Runs one import of main.py and returns {module: (self_us, cumulative_us)}
+# for every module imported, keyed by its full dotted name.
+###############################################################################
+def measure_import(module_name='main'):
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+
+    timings = {}
+    for line in result.stderr.splitlines():
+
+        # Lines look like: "import time:       123 |        456 |   package.module"
+        if not line.startswith('import time:') or '|' not in line: continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit(): continue  # Header line
+
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+
+    return timings
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Measure the import time of main.py.")
+    parser.add_argument('--runs',   type=int,   default=5,     help="Number of measured imports (default 5)")
+    parser.add_argument('--max-ms', type=float, default=300.0, help="Budget for the median import time of main, in milliseconds")
+    args = parser.parse_args()
+
+    runs = [measure_import() for _ in range(args.runs)]
+
+    totals    = [timings['main'][1] / 1000 for timings in runs]
+    median_ms = statistics.median(totals)
+
+    print(f"main.py import time over {args.runs} runs: median {median_ms:.1f} ms, min {min(totals):.1f} ms, max {max(totals):.1f} ms")
+
+    # Slowest modules by self time in the last run
+    print("\nSlowest imports (self time):")
+    for name, (self_us, cumulative_us) in sorted(runs[-1].items(), key=lambda item: -item[1][0])[:10]:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+    failed = False
+
+    eager_modules = sorted(name for name in runs[-1] if name in LAZY_MODULES)
+    if eager_modules:
+        print(f"\nFAIL: provider modules imported at startup: {', '.join(eager_modules)}")
+        failed = True
+
+    if median_ms > args.max_ms:
+        print(f"\nFAIL: median import time {median_ms:.1f} ms is over the {args.max_ms:.0f} ms budget")
+        failed = True
+
+    if not failed: print("\nOK")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,570 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module keeps an on-disk index of the symbols in a project: modules,
+# classes, functions and their signatures, imports, and the calls each
+# function makes. Python files are read with ast; Java and Perl files with a
+# small tokenizer; the data and document files by their headings, keys,
+# tables or columns. The index is kept in projects/<name>/symbol_index.json
+# and only files whose hash changed are parsed again; files whose size and
+# modification time are unchanged are not even read.
+#
+# The index gives prompts targeted slices of the code (the functions reachable
+# from the ones a task mentions) and lets a plan be checked against the
+# symbols that really exist.
+###############################################################################
+
+import os
+import re
+import ast
+import json
+import hashlib
+import tempfile
+import configparser
+
+from profiler import profiled
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+INDEX_FILE    = 'symbol_index.json'
+INDEX_VERSION = 1
+
+# Same extensions as create_file_bundle in main.py
+ALLOWED_EXTENSIONS = ('.txt','.py','.md','.sql','.json','.xml','.csv','.tsv','.pl','.java','.yml','.yaml')
+CODE_EXTENSIONS    = ('.py','.pl','.java')
+EXCLUDED_FOLDERS   = ('code_history',)
+
+CODE_KINDS = ('class', 'function', 'method')
+
+# Indexes loaded by this process, by index path, so repeated updates (and the
+# daemon's later tasks) don't read the JSON file again
+loaded_indexes = {}
+
+def get_symbol_index_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['SymbolIndex'] if 'SymbolIndex' in config else {}
+
+    settings = {}
+    settings['enabled']     = section.get('enabled', 'yes').lower() in ['yes', '1']
+    settings['slice_depth'] = int(section.get('slice_depth', '2'))
+    settings['max_symbols'] = int(section.get('max_symbols', '40'))
+
+    return settings
+
+# Relative paths of the project files that are indexed and bundled
+def list_project_files(app_folder):
+
+    project_files = []
+    for root, dirs, files in os.walk(app_folder):
+        dirs[:] = [d for d in dirs if d not in EXCLUDED_FOLDERS]
+        for file in files:
+            if file.lower().endswith(ALLOWED_EXTENSIONS):
+                project_files.append(os.path.relpath(os.path.join(root, file), app_folder))
+
+    return sorted(project_files)
+
+def read_project_file(app_folder, relative_path):
+
+    with open(os.path.join(app_folder, relative_path), 'r', encoding='utf-8') as f:
+        return f.read()
+
+# Dotted module name of a file, eg 'pkg/util.py' -> 'pkg.util'
+def module_name(relative_path):
+
+    parts = os.path.splitext(relative_path)[0].split(os.sep)
+    if parts[-1] == '__init__': parts = parts[:-1]
+    return '.'.join(parts)
+
+def new_symbol(name, qualname, kind, signature, line, end_line):
+    return {'name': name, 'qualname': qualname, 'kind': kind, 'signature': signature,
+            'line': line, 'end_line': end_line, 'calls': []}
+
+###############################################################################
+# Python, with ast
+###############################################################################
+
+def python_signature(node):
+
+    prefix = 'async def' if isinstance(node, ast.AsyncFunctionDef) else 'def'
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns else ''
+    return f"{prefix} {node.name}({ast.unparse(node.args)}){returns}"
+
+# Name of a called function as written, eg 'helper', 'os.path.join', 'self.run'
+def call_name(node):
+
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name): return None
+    parts.append(node.id)
+
+    return '.'.join(reversed(parts))
+
+def python_calls(node):
+
+    calls = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            name = call_name(child.func)
+            if name: calls.add(name)
+
+    return sorted(calls)
+
+def index_python(relative_path, content):
+
+    tree = ast.parse(content)
+
+    package = module_name(relative_path).split('.')
+    if not relative_path.endswith('__init__.py'): package = package[:-1]
+
+    # Imported module names, and the local names imports bind
+    imports, aliases, star_imports = set(), {}, []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                imports.add(alias.name)
+                if alias.asname: aliases[alias.asname] = alias.name
+                else:            aliases[alias.name.split('.')[0]] = alias.name.split('.')[0]
+        elif isinstance(node, ast.ImportFrom):
+            base = package[:len(package) - node.level + 1] if node.level else []
+            module = '.'.join(base + ([node.module] if node.module else []))
+            if module: imports.add(module)
+            for alias in node.names:
+                if alias.name == '*':
+                    star_imports.append(module)
+                    continue
+                target = f"{module}.{alias.name}" if module else alias.name
+                imports.add(target)
+                aliases[alias.asname or alias.name] = target
+
+    symbols = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            symbol = new_symbol(node.name, node.name, 'function', python_signature(node), node.lineno, node.end_lineno)
+            symbol['calls'] = python_calls(node)
+            symbols.append(symbol)
+        elif isinstance(node, ast.ClassDef):
+            bases = ', '.join(ast.unparse(base) for base in node.bases)
+            signature = f"class {node.name}({bases}):" if bases else f"class {node.name}:"
+            symbols.append(new_symbol(node.name, node.name, 'class', signature, node.lineno, node.end_lineno))
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    symbol = new_symbol(item.name, f"{node.name}.{item.name}", 'method', python_signature(item), item.lineno, item.end_lineno)
+                    symbol['calls'] = python_calls(item)
+                    symbols.append(symbol)
+
+    return {'language': 'python', 'imports': sorted(imports), 'aliases': aliases,
+            'star_imports': star_imports, 'symbols': symbols}
+
+###############################################################################
+# Java and Perl, with a tokenizer. Strings and comments are skipped; braces
+# give the nesting of classes and function bodies.
+###############################################################################
+
+LINE_COMMENTS = {'java': r'//[^\n]*', 'perl': r'\#[^\n]*'}
+
+JAVA_KEYWORDS = {'if', 'for', 'while', 'switch', 'catch', 'synchronized', 'return', 'new', 'throw',
+                 'else', 'do', 'try', 'super', 'this', 'assert'}
+PERL_KEYWORDS = {'if', 'unless', 'for', 'foreach', 'while', 'until', 'my', 'our', 'local', 'return',
+                 'print', 'die', 'push', 'shift', 'defined', 'scalar', 'keys', 'values', 'sub'}
+
+def make_token_pattern(language):
+
+    return re.compile(
+        r'"(?:\\.|[^"\\])*"'             # Double quoted strings
+        r"|'(?:\\.|[^'\\])*'"            # Single quoted strings
+        r'|/\*.*?\*/'                    # Block comments
+        r'|' + LINE_COMMENTS[language] + # Line comments
+        r'|[A-Za-z_]\w*(?:(?:\.|::)[A-Za-z_]\w*)*'  # Names, dotted or Perl packages
+        r'|[{}();=,@]', re.S)
+
+TOKEN_PATTERNS = {language: make_token_pattern(language) for language in LINE_COMMENTS}
+
+# (token, line number, offset) tuples, without strings and comments
+def tokenize(content, language):
+
+    tokens = []
+    line, position = 1, 0
+    for match in TOKEN_PATTERNS[language].finditer(content):
+        line += content.count('\n', position, match.start())
+        position = match.start()
+        text = match.group(0)
+        if text[0] in '"\'/#': continue
+        tokens.append((text, line, position))
+
+    return tokens
+
+def is_name(token):
+    return token[0].isalpha() or token[0] == '_'
+
+# Source text of the declaration at an offset: from the start of its statement
+# on that line up to the '{' or ';' that follows it
+def declaration_text(content, offset):
+
+    line_start = content.rfind('\n', 0, offset) + 1
+    start = max(content.rfind(mark, line_start, offset) for mark in '{};') + 1
+    ends  = [end for end in (content.find(mark, offset) for mark in '{;\n') if end != -1]
+    end   = min(ends) if ends else len(content)
+
+    return content[max(start, line_start):end].strip()
+
+def index_braced(relative_path, content, language):
+
+    tokens   = tokenize(content, language)
+    keywords = JAVA_KEYWORDS if language == 'java' else PERL_KEYWORDS
+
+    imports, symbols = set(), []
+    scopes  = []      # (symbol, brace depth of its body)
+    pending = None    # Declared symbol waiting for the '{' of its body
+    depth   = 0
+
+    def current(kind):
+        for symbol, _ in reversed(scopes):
+            if symbol['kind'] in kind: return symbol
+        return None
+
+    for i, (text, line, offset) in enumerate(tokens):
+        following = tokens[i + 1][0] if i + 1 < len(tokens) else ''
+        previous  = tokens[i - 1][0] if i else ''
+
+        if text == '{':
+            depth += 1
+            if pending:
+                scopes.append((pending, depth))
+                pending = None
+        elif text == '}':
+            if scopes and scopes[-1][1] == depth:
+                scopes.pop()[0]['end_line'] = line
+            depth -= 1
+        elif text == ';':
+            pending = None
+
+        elif text in ('import', 'use', 'require') and previous in ('', ';', '{', '}'):
+            names = [token[0] for token in tokens[i + 1:i + 3] if is_name(token[0]) and token[0] != 'static']
+            if names: imports.add(names[0])
+
+        elif language == 'java' and text in ('class', 'interface', 'enum') and is_name(following):
+            owner = current(('class',))
+            qualname = f"{owner['qualname']}.{following}" if owner else following
+            pending = new_symbol(following, qualname, 'class', declaration_text(content, offset), line, line)
+            symbols.append(pending)
+
+        elif language == 'perl' and text == 'sub' and is_name(following):
+            pending = new_symbol(following, following, 'function', declaration_text(content, offset), line, line)
+            symbols.append(pending)
+
+        elif is_name(text) and following == '(' and text.split('.')[-1] not in keywords and previous not in ('sub', '@'):
+            owner = scopes[-1][0] if scopes else None
+
+            # In Java, a name and '(' directly inside a class body declares a method
+            if language == 'java' and owner and owner['kind'] == 'class' and previous not in ('=', '.', ',', '(', 'new', 'return'):
+                pending = new_symbol(text, f"{owner['qualname']}.{text}", 'method', declaration_text(content, offset), line, line)
+                symbols.append(pending)
+                continue
+
+            caller = current(('function', 'method'))
+            if caller and previous != 'new' and text not in caller['calls']:
+                caller['calls'].append(text.replace('::', '.'))
+
+    for symbol in symbols: symbol['calls'].sort()
+
+    return {'language': language, 'imports': sorted(name.replace('::', '.') for name in imports),
+            'aliases': {}, 'star_imports': [], 'symbols': symbols}
+
+###############################################################################
+# Data and document files: the names a task or plan may refer to
+###############################################################################
+
+SQL_PATTERN     = re.compile(r'\bCREATE\s+(?:OR\s+REPLACE\s+)?(TABLE|VIEW|FUNCTION|PROCEDURE|INDEX|TRIGGER)\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w.]+)', re.I)
+HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$', re.M)
+YAML_PATTERN    = re.compile(r'^([A-Za-z_][\w-]*)\s*:', re.M)
+XML_PATTERN     = re.compile(r'<([A-Za-z_][\w:.-]*)[\s>/]')
+
+def index_data(relative_path, content):
+
+    extension = os.path.splitext(relative_path)[1].lower()
+    symbols = []
+
+    def add(name, kind, signature, position):
+        line = content.count('\n', 0, position) + 1
+        symbols.append(new_symbol(name, name, kind, signature, line, line))
+
+    if extension == '.sql':
+        for match in SQL_PATTERN.finditer(content):
+            add(match.group(2), match.group(1).lower(), f"{match.group(1).upper()} {match.group(2)}", match.start())
+    elif extension == '.md':
+        for match in HEADING_PATTERN.finditer(content):
+            add(match.group(2), 'heading', match.group(0).strip(), match.start())
+    elif extension in ('.yml', '.yaml'):
+        for match in YAML_PATTERN.finditer(content):
+            add(match.group(1), 'key', match.group(1), match.start())
+    elif extension == '.json':
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            for key in data: add(str(key), 'key', str(key), content.find(json.dumps(key)))
+    elif extension in ('.csv', '.tsv'):
+        header = content.split('\n', 1)[0]
+        for column in header.split('\t' if extension == '.tsv' else ','):
+            if column.strip(): add(column.strip().strip('"'), 'column', column.strip(), 0)
+    elif extension == '.xml':
+        for match in XML_PATTERN.finditer(content):
+            if match.group(1) != 'xml':
+                add(match.group(1), 'element', f"<{match.group(1)}>", match.start())
+                break
+
+    return {'language': extension.lstrip('.'), 'imports': [], 'aliases': {}, 'star_imports': [], 'symbols': symbols}
+
+def index_file(relative_path, content):
+
+    extension = os.path.splitext(relative_path)[1].lower()
+
+    try:
+        if extension == '.py':   return index_python(relative_path, content)
+        if extension == '.java': return index_braced(relative_path, content, 'java')
+        if extension == '.pl':   return index_braced(relative_path, content, 'perl')
+    except (SyntaxError, ValueError, RecursionError) as e:
+        logger.warning(f"Could not index {relative_path}: {e}")
+        return {'language': extension.lstrip('.'), 'imports': [], 'aliases': {}, 'star_imports': [], 'symbols': []}
+
+    return index_data(relative_path, content)
+
+###############################################################################
+# Index storage. Files are parsed again only when their hash changes. The
+# index is kept in the project folder, which is the parent of the files folder
+# unless given (a run in a workspace indexes the workspace's copy of the files,
+# and shares the project's index).
+###############################################################################
+
+def get_index_path(app_folder, project_folder=None):
+
+    project_folder = project_folder or os.path.dirname(os.path.normpath(app_folder))
+    return os.path.join(project_folder, INDEX_FILE)
+
+def load_symbol_index(app_folder, project_folder=None):
+
+    index_path = get_index_path(app_folder, project_folder)
+    if index_path in loaded_indexes: return loaded_indexes[index_path]
+
+    index = {'version': INDEX_VERSION, 'files': {}}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                saved_index = json.load(f)
+            if saved_index.get('version') == INDEX_VERSION: index = saved_index
+        except (ValueError, OSError) as e:
+            logger.warning(f"Could not read {index_path}: {e}. Rebuilding the symbol index.")
+
+    loaded_indexes[index_path] = index
+    return index
+
+# Saved through a temp file of its own, as concurrent runs may save at once
+def save_symbol_index(app_folder, index, project_folder=None):
+
+    index_path = get_index_path(app_folder, project_folder)
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), prefix=INDEX_FILE + '.', suffix='.tmp')
+
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=1)
+        os.replace(temp_path, index_path)
+    except BaseException:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        raise
+
+# Size and modification time of a file. A file whose stat is unchanged since it
+# was indexed is not read or hashed again.
+def file_stat(app_folder, relative_path):
+
+    stat = os.stat(os.path.join(app_folder, relative_path))
+    return [stat.st_size, stat.st_mtime_ns]
+
+# Brings the index up to date with the project folder and returns it
+@profiled()
+def update_symbol_index(app_folder, project_folder=None):
+
+    index = load_symbol_index(app_folder, project_folder)
+    files = index['files']
+
+    project_files = list_project_files(app_folder)
+    updated = restated = 0
+
+    for relative_path in project_files:
+        stat = file_stat(app_folder, relative_path)
+        if relative_path in files and files[relative_path].get('stat') == stat: continue
+
+        content = read_project_file(app_folder, relative_path)
+        file_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+        if relative_path in files and files[relative_path]['hash'] == file_hash:
+            files[relative_path]['stat'] = stat
+            restated += 1
+            continue
+
+        entry = index_file(relative_path, content)
+        entry['hash']   = file_hash
+        entry['stat']   = stat
+        entry['module'] = module_name(relative_path)
+        files[relative_path] = entry
+        updated += 1
+
+    removed = [path for path in files if path not in project_files]
+    for path in removed: del files[path]
+
+    if updated or restated or removed or not os.path.exists(get_index_path(app_folder, project_folder)):
+        save_symbol_index(app_folder, index, project_folder)
+        logger.info(f"Symbol index: {updated} files indexed, {len(removed)} removed, {len(project_files)} total")
+
+    return index
+
+###############################################################################
+# Queries
+###############################################################################
+
+# Symbol id ('module.qualname') -> (file path, symbol)
+def get_symbol_table(index):
+
+    table = {}
+    for path, entry in index['files'].items():
+        for symbol in entry['symbols']:
+            table[f"{entry['module']}.{symbol['qualname']}"] = (path, symbol)
+
+    return table
+
+# Symbol ids a call made from one symbol can refer to
+def resolve_call(index, table, path, symbol, call):
+
+    entry = index['files'][path]
+    parts = call.split('.')
+    candidates = []
+
+    if parts[0] in ('self', 'cls', 'this') and '.' in symbol['qualname']:
+        owner = symbol['qualname'].rsplit('.', 1)[0]
+        candidates.append(f"{entry['module']}.{owner}.{'.'.join(parts[1:])}")
+    elif parts[0] in entry['aliases']:
+        candidates.append('.'.join([entry['aliases'][parts[0]]] + parts[1:]))
+    else:
+        candidates.append(f"{entry['module']}.{call}")
+        candidates.extend(f"{module}.{call}" for module in entry['star_imports'])
+
+    found = [candidate for candidate in candidates if candidate in table]
+    if found: return found
+
+    # Fall back to the only code symbol with that name, if there is exactly one
+    name = parts[-1]
+    matches = [symbol_id for symbol_id, (_, other) in table.items() if other['name'] == name and other['kind'] in CODE_KINDS]
+    return matches if len(matches) == 1 else []
+
+# Ids of the code symbols named in a piece of text (eg a task description)
+def find_mentioned_symbols(index, text, table=None):
+
+    table = table or get_symbol_table(index)
+    words = set(re.findall(r'[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*', text))
+
+    mentioned = []
+    for symbol_id, (_, symbol) in table.items():
+        if symbol['kind'] not in CODE_KINDS or len(symbol['name']) < 3: continue
+        if symbol['name'] in words or symbol['qualname'] in words or symbol_id in words:
+            mentioned.append(symbol_id)
+
+    return mentioned
+
+# Symbol ids reachable from the start symbols through calls, nearest first
+def find_reachable_symbols(index, start_ids, max_depth=2, table=None):
+
+    table = table or get_symbol_table(index)
+
+    reached  = [symbol_id for symbol_id in start_ids if symbol_id in table]
+    frontier = list(reached)
+    for _ in range(max_depth):
+        next_frontier = []
+        for symbol_id in frontier:
+            path, symbol = table[symbol_id]
+            for call in symbol['calls']:
+                for target in resolve_call(index, table, path, symbol, call):
+                    if target not in reached:
+                        reached.append(target)
+                        next_frontier.append(target)
+        frontier = next_frontier
+
+    return reached
+
+# Signatures of the given symbols, grouped by file in source order
+def format_symbol_slice(index, symbol_ids, table=None):
+
+    table = table or get_symbol_table(index)
+
+    # Methods are shown under their class
+    symbol_ids = list(symbol_ids)
+    for symbol_id in list(symbol_ids):
+        owner = symbol_id.rsplit('.', 1)[0]
+        while owner in table and table[owner][1]['kind'] == 'class':
+            if owner not in symbol_ids: symbol_ids.append(owner)
+            owner = owner.rsplit('.', 1)[0]
+
+    by_file = {}
+    for symbol_id in symbol_ids:
+        path, symbol = table[symbol_id]
+        by_file.setdefault(path, []).append(symbol)
+
+    text = ''
+    for path in sorted(by_file):
+        text += f"\nFile: {path}\n"
+        for symbol in sorted(by_file[path], key=lambda symbol: symbol['line']):
+            indent = '    ' * (1 + symbol['qualname'].count('.'))
+            text += f"{indent}{symbol['signature']}\n"
+
+    return text
+
+###############################################################################
+# Plan check: the names a plan writes as code, split into those that exist in
+# the project and those that do not (new or mistaken). Only code-formatted
+# names count: calls written with no space before the parenthesis, like
+# load_index(), and backticked names, like `Parser.parse`. Prose such as
+# "a list (of files)" or "file(s)" is not read as a call.
+###############################################################################
+def check_plan_symbols(index, plan_text):
+
+    table = get_symbol_table(index)
+    known_names = {}
+    for symbol_id, (_, symbol) in table.items():
+        if symbol['kind'] in CODE_KINDS:
+            for name in (symbol['name'], symbol['qualname'], symbol_id):
+                known_names.setdefault(name, symbol_id)
+
+    referenced = set(re.findall(r'(?<![\w.])([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)\((?!s\))', plan_text))
+    referenced.update(re.findall(r'`([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)(?:\(.*?\))?`', plan_text))
+
+    found, unknown = [], []
+    for name in sorted(referenced):
+        if name in known_names or name.split('.')[-1] in known_names:
+            found.append(name)
+        else:
+            unknown.append(name)
+
+    return found, unknown
+
+# Signatures of the code symbols a task names and the symbols they call, or ''
+# if the task names none
+def create_task_slice(index, text, max_depth=2, max_symbols=40):
+
+    table = get_symbol_table(index)
+
+    mentioned = find_mentioned_symbols(index, text, table)
+    if not mentioned: return ''
+
+    reachable = find_reachable_symbols(index, mentioned, max_depth, table)[:max_symbols]
+    return format_symbol_slice(index, reachable, table)
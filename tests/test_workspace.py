@@ -0,0 +1,155 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Tests of the three-way merge of a run's workspace back into the project.
+# Run with: python -m pytest tests
+###############################################################################
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workspace import merge_lines, create_workspace, merge_workspace, finish_workspace
+
+SETTINGS = {'enabled': True, 'link_files': True, 'keep': False}
+
+BASE = ['a\n', 'b\n', 'c\n', 'd\n', 'e\n']
+
+###############################################################################
+# merge_lines
+###############################################################################
+
+def test_merge_takes_one_sided_change():
+
+    ours = ['a\n', 'B\n', 'c\n', 'd\n', 'e\n']
+    assert merge_lines(BASE, ours, BASE) == ours
+    assert merge_lines(BASE, BASE, ours) == ours
+
+def test_merge_combines_changes_to_different_lines():
+
+    ours   = ['a\n', 'B\n', 'c\n', 'd\n', 'e\n']
+    theirs = ['a\n', 'b\n', 'c\n', 'D\n', 'e\n']
+    assert merge_lines(BASE, ours, theirs) == ['a\n', 'B\n', 'c\n', 'D\n', 'e\n']
+
+def test_merge_combines_insertions_and_deletions():
+
+    ours   = ['x\n', 'a\n', 'b\n', 'c\n', 'd\n', 'e\n']
+    theirs = ['a\n', 'b\n', 'c\n', 'e\n']
+    assert merge_lines(BASE, ours, theirs) == ['x\n', 'a\n', 'b\n', 'c\n', 'e\n']
+
+def test_merge_takes_the_same_change_once():
+
+    both = ['a\n', 'b\n', 'C\n', 'd\n', 'e\n']
+    assert merge_lines(BASE, both, list(both)) == both
+
+def test_merge_conflicts_on_the_same_lines():
+
+    ours   = ['a\n', 'b\n', 'OURS\n', 'd\n', 'e\n']
+    theirs = ['a\n', 'b\n', 'THEIRS\n', 'd\n', 'e\n']
+    assert merge_lines(BASE, ours, theirs) is None
+
+def test_merge_conflicts_on_overlapping_regions():
+
+    ours   = ['a\n', 'B\n', 'C\n', 'd\n', 'e\n']
+    theirs = ['a\n', 'b\n', 'X\n', 'D\n', 'e\n']
+    assert merge_lines(BASE, ours, theirs) is None
+
+def test_merge_conflicts_on_insertions_at_the_same_place():
+
+    ours   = ['a\n', 'b\n', 'ours\n', 'c\n', 'd\n', 'e\n']
+    theirs = ['a\n', 'b\n', 'theirs\n', 'c\n', 'd\n', 'e\n']
+    assert merge_lines(BASE, ours, theirs) is None
+
+###############################################################################
+# merge_workspace and finish_workspace
+###############################################################################
+
+def write(path, text):
+
+    # Writers replace files by rename, so a hard-linked workspace copy is not changed in place
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.new', 'w', encoding='utf-8', newline='') as f: f.write(text)
+    os.replace(path + '.new', path)
+
+def read(path):
+
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+def make_project(tmp_path, files):
+
+    app_folder = os.path.join(str(tmp_path), 'project', 'files')
+    for name, text in files.items(): write(os.path.join(app_folder, name), text)
+    return app_folder
+
+def test_workspace_changes_are_merged_back(tmp_path):
+
+    app_folder = make_project(tmp_path, {'only_run.py': 'a\nb\n', 'both.py': ''.join(BASE), 'untouched.py': 'same\n'})
+    workspace  = create_workspace(app_folder, SETTINGS)
+    folder     = workspace['folder']
+
+    # The run changes two files and adds one; meanwhile the project changes another line of both.py
+    write(os.path.join(folder, 'only_run.py'), 'a\nB\n')
+    write(os.path.join(folder, 'both.py'), 'a\nB\nc\nd\ne\n')
+    write(os.path.join(folder, 'pkg', 'new.py'), 'new\n')
+    write(os.path.join(app_folder, 'both.py'), 'a\nb\nc\nd\nE\n')
+
+    result = merge_workspace(workspace)
+
+    assert sorted(result['merged']) == ['only_run.py', os.path.join('pkg', 'new.py')]
+    assert result['line_merged'] == ['both.py']
+    assert result['conflicts'] == []
+
+    assert read(os.path.join(app_folder, 'only_run.py')) == 'a\nB\n'
+    assert read(os.path.join(app_folder, 'both.py')) == 'a\nB\nc\nd\nE\n'
+    assert read(os.path.join(app_folder, 'pkg', 'new.py')) == 'new\n'
+    assert read(os.path.join(app_folder, 'untouched.py')) == 'same\n'
+
+def test_workspace_conflict_keeps_the_project_version(tmp_path):
+
+    app_folder = make_project(tmp_path, {'main.py': ''.join(BASE), 'other.py': 'x\n'})
+    workspace  = create_workspace(app_folder, SETTINGS)
+
+    write(os.path.join(workspace['folder'], 'main.py'), 'a\nb\nRUN\nd\ne\n')
+    write(os.path.join(workspace['folder'], 'other.py'), 'y\n')
+    write(os.path.join(app_folder, 'main.py'), 'a\nb\nPROJECT\nd\ne\n')
+
+    result = finish_workspace(workspace, SETTINGS)
+
+    assert result['conflicts'] == ['main.py']
+    assert result['merged'] == ['other.py']
+    assert read(os.path.join(app_folder, 'main.py')) == 'a\nb\nPROJECT\nd\ne\n'
+    assert read(os.path.join(app_folder, 'other.py')) == 'y\n'
+
+    # The run's version stays in its workspace, which is kept
+    assert read(os.path.join(workspace['folder'], 'main.py')) == 'a\nb\nRUN\nd\ne\n'
+    assert workspace['conflicts'] == ['main.py']
+
+def test_clean_workspace_is_removed(tmp_path):
+
+    app_folder = make_project(tmp_path, {'main.py': 'a\n'})
+    workspace  = create_workspace(app_folder, SETTINGS)
+
+    write(os.path.join(workspace['folder'], 'main.py'), 'b\n')
+    result = finish_workspace(workspace, SETTINGS)
+
+    assert result == {'merged': ['main.py'], 'line_merged': [], 'conflicts': []}
+    assert read(os.path.join(app_folder, 'main.py')) == 'b\n'
+    assert not os.path.exists(workspace['folder'])
+    assert not os.path.exists(workspace['base_folder'])
+
+def test_same_change_in_project_and_workspace_is_not_a_conflict(tmp_path):
+
+    app_folder = make_project(tmp_path, {'main.py': 'a\n'})
+    workspace  = create_workspace(app_folder, SETTINGS)
+
+    write(os.path.join(workspace['folder'], 'main.py'), 'b\n')
+    write(os.path.join(app_folder, 'main.py'), 'b\n')
+
+    assert merge_workspace(workspace) == {'merged': [], 'line_merged': [], 'conflicts': []}
@@ -0,0 +1,114 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# This module holds the text transforms applied to prompts, responses and
+# extracted files. The line transforms are generators, so they can be chained
+# without holding a full list of lines for each step, and the common cases use
+# bulk string operations that never split the text into lines at all.
+###############################################################################
+
+import io
+
+###############################################################################
+# Line generators
+###############################################################################
+
+# Yields the lines of a string (split on '\n', like str.split) one at a time
+def iter_lines(text):
+
+    start = 0
+    while True:
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+# Joins lines back into a string with '\n' between them
+def join_lines(lines):
+
+    buffer = io.StringIO()
+    first  = True
+    for line in lines:
+        if not first: buffer.write('\n')
+        buffer.write(line)
+        first = False
+
+    return buffer.getvalue()
+
+# Prefixes each line with '> '
+def blockquote_lines(lines, prefix='> '):
+
+    for line in lines:
+        yield prefix + line
+
+# Drops backtick fence lines and the line after a fence with a language
+# specifier, and strips leading and trailing backticks from the other lines
+def clean_lines(lines):
+
+    skip_next = False
+
+    for line in lines:
+        if skip_next:
+            skip_next = False
+            continue
+
+        # Remove lines that are just backticks
+        if line.strip() == '```' or line.strip() == '`':
+            continue
+
+        # Remove language specifier lines
+        if line.strip().startswith('```'):
+            skip_next = True
+            continue
+
+        # Remove leading and trailing backticks from each line
+        yield line.strip('`')
+
+# Drops blank lines at the end. Blank lines are held back until a non-blank
+# line shows they are not trailing.
+def strip_trailing_blank_lines(lines):
+
+    pending = []
+    for line in lines:
+        if not line.strip():
+            pending.append(line)
+            continue
+        yield from pending
+        pending = []
+        yield line
+
+###############################################################################
+# We want a section of text to be preceived by the LLM as containing a quote,
+# so we prefix each line with '> '. This is one bulk replace, with the same
+# result as splitting into lines, prefixing and re-joining.
+###############################################################################
+def add_blockquote_prefix(input_string):
+
+    return '> ' + input_string.replace('\n', '\n> ')
+
+###############################################################################
+# This removes backticks ```` from files extracted from LLM response.
+###############################################################################
+def clean_content(content):
+    """
+    Clean the content by removing surrounding and internal backticks,
+    as well as language specifiers.
+    """
+
+    # Without backticks, only trailing blank lines need removing. Cut after the
+    # line holding the last non-whitespace character, found without copying.
+    if '`' not in content:
+        last = len(content)
+        while last and content[last - 1].isspace(): last -= 1
+        if not last: return ''
+        end = content.find('\n', last)
+        return content if end == -1 else content[:end]
+
+    return join_lines(strip_trailing_blank_lines(clean_lines(iter_lines(content))))
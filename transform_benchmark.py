@@ -0,0 +1,124 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Benchmark for the text transforms in text_transforms.py. Each transform runs
+# in a fresh process on a generated multi-MB response, and the peak RSS it
+# adds on top of the input is reported next to the previous list-based
+# implementation (split into a list of lines, transform, re-join).
+#
+# Usage: python transform_benchmark.py [--size-mb N]
+###############################################################################
+
+import sys
+import time
+import argparse
+import resource
+import subprocess
+
+###############################################################################
+# Previous implementations, kept here only for comparison
+###############################################################################
+def list_add_blockquote_prefix(input_string):
+
+    lines = input_string.split('\n')
+    prefixed_lines = ['> ' + line for line in lines]
+    return '\n'.join(prefixed_lines)
+
+def list_clean_content(content):
+
+    lines = content.split('\n')
+    cleaned_lines = []
+    skip_next = False
+
+    for line in lines:
+        if skip_next:
+            skip_next = False
+            continue
+        if line.strip() == '```' or line.strip() == '`':
+            continue
+        if line.strip().startswith('```'):
+            skip_next = True
+            continue
+        cleaned_lines.append(line.strip('`'))
+
+    while cleaned_lines and not cleaned_lines[-1].strip():
+        cleaned_lines.pop()
+
+    return '\n'.join(cleaned_lines)
+
+# Transform name -> (function, whether the input has backtick fences)
+def get_transforms():
+
+    from text_transforms import add_blockquote_prefix, clean_content
+
+    return {
+        'blockquote (list)':          (list_add_blockquote_prefix, False),
+        'blockquote (bulk)':          (add_blockquote_prefix,      False),
+        'clean, no fences (list)':    (list_clean_content,         False),
+        'clean, no fences (fast)':    (clean_content,              False),
+        'clean, fenced (list)':       (list_clean_content,         True),
+        'clean, fenced (generators)': (clean_content,              True),
+    }
+
+# A response of roughly size_mb megabytes made of short code-like lines. The
+# pieces are returned too, so they stay allocated and the memory they use is
+# not handed back for the transform to reuse, which would hide its own usage.
+def make_input(size_mb, fenced):
+
+    line = "    result = compute_value(items[index], options)  # comment\n"
+    body = line * (size_mb * 1024 * 1024 // len(line))
+
+    if fenced: return "```python\n" + body + "```\n\n", body
+    return body + "\n\n", body
+
+# Peak resident set size of this process so far, in MB
+def peak_rss_mb():
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return peak / (1024 * 1024)  # Bytes on macOS
+    return peak / 1024                                         # Kilobytes on Linux
+
+###############################################################################
+# Child process: build the input, run one transform, print the added peak RSS
+###############################################################################
+def run_child(name, size_mb):
+
+    function, fenced = get_transforms()[name]
+    text, body = make_input(size_mb, fenced)
+
+    rss_before = peak_rss_mb()
+    start_time = time.perf_counter()
+    result     = function(text)
+    seconds    = time.perf_counter() - start_time
+
+    print(f"{peak_rss_mb() - rss_before:.1f} {seconds:.3f} {len(result)}")
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Compare peak memory of the text transforms.")
+    parser.add_argument('--size-mb', type=int, default=20, help="Input size in MB (default 20)")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.size_mb)
+        return
+
+    print(f"Input size: {args.size_mb} MB\n")
+    print(f"{'Transform':<30}{'Added peak RSS (MB)':>21}{'Time (s)':>10}")
+
+    for name in get_transforms():
+        result = subprocess.run([sys.executable, __file__, '--child', name, '--size-mb', str(args.size_mb)],
+                                capture_output=True, text=True, check=True)
+        added_mb, seconds, _ = result.stdout.split()
+        print(f"{name:<30}{float(added_mb):>21.1f}{float(seconds):>10.3f}")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,146 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Worker for the job queue: `python worker.py [--threads N]`. Leases jobs from
+# the queue set in the [JobQueue] section of config.txt and runs them:
+#   llm_call  one provider call, made with this host's API keys
+#   task      a whole task of a project, as main.py runs it without the
+#             confirmation prompt. The projects folder must be shared with
+#             the coordinator.
+# While a job runs, its lease is renewed every third of lease_seconds. If the
+# lease is lost (the coordinator cancelled the job), its call is cancelled.
+###############################################################################
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+
+import api_caller
+from api_caller import RequestCancelled, set_cancel_event
+from job_queue import get_job_queue_settings, get_job_queue
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+worker_name = f"{socket.gethostname()}-{os.getpid()}"
+
+# A task uses main.py's module state (project folders, run usage), so a worker
+# runs one task at a time; its other threads take LLM calls meanwhile
+task_lock = threading.Lock()
+
+def run_llm_call(payload):
+
+    api_caller.wait_for_rate_limit(payload['llm_name'])
+
+    start_time = time.perf_counter()
+    response = api_caller.call_provider(payload['prompt'], payload['llm_name'], payload['model'], payload['call_options'])
+
+    return {'response': response, 'seconds': time.perf_counter() - start_time}
+
+def run_project_task(payload):
+
+    import main as firebird
+
+    settings   = firebird.open_project(payload['project'])
+    change_set = firebird.run_task(payload['task'], settings, confirm=False)
+
+    return {kind: len(paths) for kind, paths in change_set.items()}
+
+JOB_HANDLERS = {'llm_call': run_llm_call, 'task': run_project_task}
+
+def run_leased_job(queue, job, settings):
+
+    finished     = threading.Event()
+    cancel_event = threading.Event()
+
+    def renew_lease():
+        while not finished.wait(settings['lease_seconds'] / 3):
+            if not queue.heartbeat(job['id'], worker_name):
+                logger.warning(f"Lost the lease on job {job['id']} (cancelled or expired). Stopping it.")
+                cancel_event.set()
+                return
+
+    threading.Thread(target=renew_lease, name=f"lease-{job['id']}", daemon=True).start()
+    set_cancel_event(cancel_event)
+
+    try:
+        result = JOB_HANDLERS[job['kind']](job['payload'])
+    except RequestCancelled:
+        return
+    except (Exception, SystemExit) as e:
+        logger.error(f"Job {job['id']} ({job['kind']}) failed: {e!r}")
+        queue.fail(job['id'], worker_name, repr(e))
+        return
+    finally:
+        finished.set()
+        set_cancel_event(None)
+
+    if not queue.complete(job['id'], worker_name, result):
+        logger.warning(f"Job {job['id']} finished after its lease was lost. The result is discarded.")
+
+def run_worker_thread(queue, settings):
+
+    while True:
+        holds_task_lock = task_lock.acquire(blocking=False)
+        try:
+            job = queue.lease(worker_name, ['llm_call', 'task'] if holds_task_lock else ['llm_call'])
+            if job is None:
+                time.sleep(settings['poll_interval'])
+                continue
+
+            if job['kind'] != 'task' and holds_task_lock:
+                task_lock.release()
+                holds_task_lock = False
+
+            if job['kind'] not in JOB_HANDLERS:
+                queue.fail(job['id'], worker_name, f"Unknown job kind: {job['kind']}")
+                continue
+
+            run_leased_job(queue, job, settings)
+        except Exception as e:
+            logger.error(f"Job queue error: {e!r}")
+            time.sleep(settings['poll_interval'])
+        finally:
+            if holds_task_lock: task_lock.release()
+
+def run_worker_pool(thread_count=None):
+
+    settings = get_job_queue_settings()
+    queue    = get_job_queue(settings)
+    if queue is None:
+        print("No job queue is set. Set backend in the [JobQueue] section of config.txt.")
+        sys.exit(1)
+
+    api_caller.make_calls_locally = True
+    api_caller.warm_up_clients()
+
+    thread_count = thread_count or settings['worker_threads']
+    for number in range(thread_count):
+        threading.Thread(target=run_worker_thread, args=(queue, settings), name=f"worker-{number + 1}", daemon=True).start()
+
+    print(f"Worker {worker_name} running {thread_count} threads on the {settings['backend']} job queue.")
+
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping the worker. Jobs in progress will be queued again when their leases expire.")
+
+if __name__ == "__main__":
+
+    import main as firebird
+    firebird.setup_logging()
+
+    parser = argparse.ArgumentParser(description="Run jobs from the Firebird job queue.")
+    parser.add_argument('--threads', type=int, help="Jobs run at once (default: worker_threads in config.txt)")
+    args = parser.parse_args()
+
+    run_worker_pool(args.threads)
@@ -0,0 +1,322 @@
+###############################################################################
+# Firebird Code Generator
+# Copyright (c) 2024 James Stakelum
+# Licensed under the Apache License, Version 2.0
+# http://www.apache.org/licenses/LICENSE-2.0
+###############################################################################
+
+###############################################################################
+# Concurrent runs on one project. Every run takes the project's advisory lock
+# (projects/<name>/project.lock) while it claims its task from tasks.txt and
+# while it writes to the project files.
+#
+# With [Workspaces] enabled, a run works in its own copy of the files folder,
+# projects/<name>/workspaces/<run id>/, so several task variants can run on
+# one project at once. The copy is made of hard links where the filesystem
+# allows it: every writer replaces files by rename (see file_writer), so a
+# link is copied on write. Only the copy and the merge hold the lock.
+#
+# When the run finishes, each file it changed is merged back:
+#   - unchanged in the project since the copy: the run's version is taken
+#   - changed in the project too: the two are merged line by line (diff3),
+#     unless they change the same lines. That is a conflict: the project's
+#     version is kept, and the run's version stays in its workspace.
+###############################################################################
+
+import os
+import json
+import time
+import shutil
+import difflib
+import tempfile
+import threading
+import contextlib
+import configparser
+from datetime import datetime
+
+from file_writer import file_hash, write_file_if_changed
+
+# Logging handler
+import logging
+logger = logging.getLogger(__name__)
+
+LOCK_FILE         = 'project.lock'
+WORKSPACES_FOLDER = 'workspaces'
+SKIPPED_FOLDERS   = ('code_history', '__pycache__', 'build', 'dist')
+LOCK_POLL         = 0.2   # Seconds between attempts on Windows
+
+# Locks held by this process, by lock file path. The OS lock is taken once per
+# process; threads wait on the RLock, and a thread may take it again.
+held_locks       = {}
+held_locks_guard = threading.Lock()
+
+def get_workspace_settings():
+
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+
+    section = config['Workspaces'] if 'Workspaces' in config else {}
+
+    settings = {}
+    settings['enabled']    = section.get('enabled', 'no').lower() in ['yes', '1']
+    settings['link_files'] = section.get('link_files', 'yes').lower() in ['yes', '1']
+    settings['keep']       = section.get('keep', 'no').lower() in ['yes', '1']
+
+    return settings
+
+###############################################################################
+# Project lock
+###############################################################################
+
+def lock_file(f, blocking):
+
+    if os.name == 'nt':
+        import msvcrt
+        while True:
+            try:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking: return False
+                time.sleep(LOCK_POLL)
+
+    import fcntl
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+def unlock_file(f):
+
+    if os.name == 'nt':
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        return
+
+    import fcntl
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# Holds the project's lock for the enclosed block and yields True. With
+# blocking=False it yields False at once, holding nothing, if another thread or
+# process has the project.
+@contextlib.contextmanager
+def project_lock(project_folder, blocking=True):
+
+    lock_path = os.path.join(os.path.abspath(project_folder), LOCK_FILE)
+
+    with held_locks_guard:
+        entry = held_locks.setdefault(lock_path, {'lock': threading.RLock(), 'depth': 0, 'file': None})
+
+    if not entry['lock'].acquire(blocking=blocking):
+        yield False
+        return
+
+    try:
+        if entry['depth'] == 0:
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            f = open(lock_path, 'a+')
+            if not lock_file(f, blocking=False):
+                if not blocking:
+                    f.close()
+                    yield False
+                    return
+                print(f"Waiting for another run on {os.path.basename(os.path.dirname(lock_path))} to release the project...")
+                lock_file(f, blocking=True)
+            entry['file'] = f
+
+        entry['depth'] += 1
+        try:
+            yield True
+        finally:
+            entry['depth'] -= 1
+            if entry['depth'] == 0:
+                unlock_file(entry['file'])
+                entry['file'].close()
+                entry['file'] = None
+    finally:
+        entry['lock'].release()
+
+###############################################################################
+# Workspaces
+###############################################################################
+
+def link_or_copy(source, target, link):
+
+    if link:
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+
+    shutil.copy2(source, target)
+
+def project_files(folder):
+
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if d not in SKIPPED_FOLDERS]
+        for file in files:
+            path = os.path.join(root, file)
+            yield os.path.relpath(path, folder), path
+
+def workspace_info_path(workspace):
+
+    return os.path.join(os.path.dirname(workspace['folder']), workspace['run_id'] + '.json')
+
+def save_workspace_info(workspace):
+
+    info_path = workspace_info_path(workspace)
+    temp_path = info_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f: json.dump(workspace, f, indent=1)
+    os.replace(temp_path, info_path)
+
+# Copies the project files into a new workspace. Each file is also linked
+# into <run id>.base, which keeps the version the run started from for the
+# line merge (the workspace file is replaced when the run writes it).
+def create_workspace(app_folder, settings):
+
+    app_folder     = os.path.abspath(app_folder)
+    project_folder = os.path.dirname(app_folder)
+    run_id         = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}"
+    folder         = os.path.join(project_folder, WORKSPACES_FOLDER, run_id)
+    base_folder    = folder + '.base'
+
+    base = {}
+    with project_lock(project_folder):
+        for relative_path, source in project_files(app_folder):
+            target = os.path.join(folder, relative_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            link_or_copy(source, target, settings['link_files'])
+
+            base_copy = os.path.join(base_folder, relative_path)
+            os.makedirs(os.path.dirname(base_copy), exist_ok=True)
+            link_or_copy(target, base_copy, True)
+
+            base[relative_path] = file_hash(target)
+
+    os.makedirs(folder, exist_ok=True)
+
+    workspace = {'run_id': run_id, 'folder': folder, 'base_folder': base_folder, 'app_folder': app_folder, 'base': base,
+                 'created': datetime.now().isoformat(timespec='seconds'), 'conflicts': []}
+    save_workspace_info(workspace)
+
+    print(f"Working in {folder}")
+    return workspace
+
+def remove_workspace(workspace):
+
+    shutil.rmtree(workspace['folder'], ignore_errors=True)
+    shutil.rmtree(workspace['base_folder'], ignore_errors=True)
+    if os.path.exists(workspace_info_path(workspace)): os.remove(workspace_info_path(workspace))
+
+###############################################################################
+# Merging
+###############################################################################
+
+# The changed regions of 'other' against 'base', as (start, end, new lines)
+def changed_regions(base, other):
+
+    matcher = difflib.SequenceMatcher(None, base, other, autojunk=False)
+    return [(i1, i2, other[j1:j2]) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+# Three-way merge of lists of lines. Returns the merged lines, or None if both
+# sides change the same lines (or insert at the same place) differently.
+def merge_lines(base, ours, theirs):
+
+    regions = []
+    for start, end, lines in sorted(changed_regions(base, ours) + changed_regions(base, theirs), key=lambda region: region[:2]):
+        if regions and start <= regions[-1][1] and (start < regions[-1][1] or start == regions[-1][0] or start == end):
+            if (start, end, lines) == regions[-1]: continue   # The same change on both sides
+            return None
+        regions.append((start, end, lines))
+
+    merged = list(base)
+    for start, end, lines in reversed(regions):
+        merged[start:end] = lines
+
+    return merged
+
+def read_lines(path):
+
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return f.read().splitlines(keepends=True)
+
+# Copies a file into place by rename, so the project never has a half-written file
+def replace_file(source, target):
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.' + os.path.basename(target) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copy2(source, temp_path)
+        os.replace(temp_path, target)
+    except BaseException:
+        if os.path.exists(temp_path): os.remove(temp_path)
+        raise
+
+# Merges the files changed in the workspace back into the project. The caller
+# holds the project lock. Returns {'merged': [...], 'line_merged': [...],
+# 'conflicts': [...]} of relative paths.
+def merge_workspace(workspace):
+
+    result = {'merged': [], 'line_merged': [], 'conflicts': []}
+
+    for relative_path, source in project_files(workspace['folder']):
+        source_hash = file_hash(source)
+        base_hash   = workspace['base'].get(relative_path)
+        if source_hash == base_hash: continue
+
+        target       = os.path.join(workspace['app_folder'], relative_path)
+        current_hash = file_hash(target) if os.path.exists(target) else None
+
+        if current_hash == source_hash: continue
+
+        if current_hash == base_hash:
+            replace_file(source, target)
+            result['merged'].append(relative_path)
+            continue
+
+        merged = None
+        if base_hash is not None and current_hash is not None:
+            try:
+                merged = merge_lines(read_lines(os.path.join(workspace['base_folder'], relative_path)), read_lines(target), read_lines(source))
+            except (UnicodeDecodeError, OSError):
+                merged = None
+
+        if merged is None:
+            result['conflicts'].append(relative_path)
+            continue
+
+        # The merged lines were read with newline='', so they keep their own line endings
+        write_file_if_changed(target, ''.join(merged), 0o644, newline='')
+        result['line_merged'].append(relative_path)
+
+    return result
+
+# Merges the workspace back, then removes it unless there were conflicts (or
+# keep is set). before_merge is called under the lock when there is anything
+# to merge, eg to back up the project files.
+def finish_workspace(workspace, settings, before_merge=None):
+
+    project_folder = os.path.dirname(workspace['app_folder'])
+
+    with project_lock(project_folder):
+        if before_merge: before_merge()
+        result = merge_workspace(workspace)
+
+    for relative_path in result['line_merged']:
+        print(f"Merged with changes made by another run: {relative_path}")
+
+    if result['conflicts']:
+        workspace['conflicts'] = result['conflicts']
+        save_workspace_info(workspace)
+        print("Conflicts with changes made by another run. The project's version was kept for:")
+        for relative_path in result['conflicts']:
+            print(f"  {relative_path} (this run's version: {os.path.join(workspace['folder'], relative_path)})")
+    elif not settings['keep']:
+        remove_workspace(workspace)
+
+    return result